@@ -0,0 +1,115 @@
+# coding=utf-8
+"""
+Compare the per-sample augmentation chain of Build_Dataset.__data_aug (four transforms, each on a
+copy) with dataAug.ComposedAffine (one warpAffine into a reused uint8 buffer) and with the batched
+engine of utils/batch_augment.py.
+
+Reports the time per sample, the peak of the numpy allocations per sample (tracemalloc) and
+checks that the boxes are identical and the images close.
+
+usage: python benchmark/augment_benchmark.py [--img_size 416] [--samples 64]
+"""
+import sys
+import os
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+import argparse
+import random
+import time
+import tracemalloc
+import numpy as np
+import cv2
+import torch
+import config.yolov4_config as cfg
+import utils.data_augment as dataAug
+from utils.batch_augment import BatchAugment
+
+
+def chain_aug(img, bboxes, img_size):
+    """
+    Build_Dataset.__data_aug without COMPOSED_AUGMENT.
+    """
+    img, bboxes = dataAug.RandomHorizontalFilp()(np.copy(img), np.copy(bboxes))
+    img, bboxes = dataAug.RandomCrop()(np.copy(img), np.copy(bboxes))
+    img, bboxes = dataAug.RandomAffine()(np.copy(img), np.copy(bboxes))
+    img, bboxes = dataAug.Resize((img_size, img_size), True)(np.copy(img), np.copy(bboxes))
+    return img, bboxes
+
+
+def random_sample(rng, num_classes=20):
+    """
+    A VOC sized image with smooth content and a few boxes.
+    """
+    h, w = rng.randint(300, 500), rng.randint(300, 500)
+    img = cv2.GaussianBlur(rng.randint(0, 256, (h, w, 3)).astype(np.uint8), (15, 15), 5)
+    n = rng.randint(1, 8)
+    xy = rng.uniform(0, [w - 40, h - 40], (n, 2))
+    wh = rng.uniform(10, 200, (n, 2))
+    bboxes = np.concatenate([xy, np.minimum(xy + wh, [w - 1, h - 1]), rng.randint(0, num_classes, (n, 1))], axis=-1)
+    return img, bboxes
+
+
+def run(aug_fn, samples, seed):
+    random.seed(seed)
+    np.random.seed(seed)
+    return [aug_fn(img, bboxes) for img, bboxes in samples]
+
+
+def measure(aug_fn, samples, repeat):
+    run(aug_fn, samples[:2], 0)
+    start = time.time()
+    for r in range(repeat):
+        run(aug_fn, samples, r)
+    elapsed = (time.time() - start) / repeat / len(samples) * 1000
+
+    tracemalloc.start()
+    peaks = []
+    for img, bboxes in samples:
+        tracemalloc.reset_peak()
+        base = tracemalloc.get_traced_memory()[0]
+        aug_fn(img, bboxes)
+        peaks.append(tracemalloc.get_traced_memory()[1] - base)
+    tracemalloc.stop()
+    return elapsed, max(peaks) / 2 ** 20
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--img_size', type=int, default=416)
+    parser.add_argument('--samples', type=int, default=64)
+    parser.add_argument('--batch', type=int, default=8, help='images per call of the batched engine')
+    parser.add_argument('--repeat', type=int, default=3)
+    opt = parser.parse_args()
+
+    rng = np.random.RandomState(0)
+    samples = [random_sample(rng) for _ in range(opt.samples)]
+    composed = dataAug.ComposedAffine((opt.img_size, opt.img_size))
+
+    t_chain, m_chain = measure(lambda img, bboxes: chain_aug(img, bboxes, opt.img_size), samples, opt.repeat)
+    t_composed, m_composed = measure(composed, samples, opt.repeat)
+
+    chain = run(lambda img, bboxes: chain_aug(img, bboxes, opt.img_size), samples, 0)
+    comp = run(composed, samples, 0)
+    boxes_equal = all(np.array_equal(a[1], b[1]) for a, b in zip(chain, comp))
+    diff = np.concatenate([np.abs(a[0] - b[0]).ravel() for a, b in zip(chain, comp)])
+
+    print('{:>10} | {:>14} | {:>18}'.format('', 'ms / sample', 'peak alloc (MB)'))
+    print('{:>10} | {:>14.2f} | {:>18.2f}'.format('chain', t_chain, m_chain))
+    print('{:>10} | {:>14.2f} | {:>18.2f}'.format('composed', t_composed, m_composed))
+    print('boxes equal: {}, image abs diff mean {:.5f} p99 {:.5f}'.format(
+        boxes_equal, diff.mean(), np.percentile(diff, 99)))
+
+    device = 'cuda' if torch.cuda.is_available() else 'cpu'
+    batch_aug = BatchAugment(cfg.MODEL["ANCHORS"], cfg.MODEL["STRIDES"], 20, device=device)
+    batches = [samples[i:i + opt.batch] for i in range(0, len(samples) - opt.batch + 1, opt.batch)]
+
+    def batch_run():
+        for batch in batches:
+            imgs, bboxes = [s[0] for s in batch], [s[1] for s in batch]
+            batch_aug(imgs, bboxes, imgs[::-1], bboxes[::-1], opt.img_size)
+        if device == 'cuda':
+            torch.cuda.synchronize()
+    batch_run()
+    start = time.time()
+    batch_run()
+    print('batched ({}, with mixup): {:.2f} ms / sample'.format(
+        device, (time.time() - start) / (len(batches) * opt.batch) * 1000))
@@ -0,0 +1,112 @@
+# coding=utf-8
+"""
+Check the analytic backward of utils/box_iou.BoxIoUFunction with torch.autograd.gradcheck (float64,
+overlapping, disjoint and negative-size boxes) and against autograd through tools.GIOU_xywh_torch
+and tools.CIOU_xywh_torch, then compare the peak memory of the CIoU term of the loss at several
+input sizes: tools.CIOU_xywh_torch on the whole grid, BoxIoUFunction on the whole grid and
+BoxIoUFunction on the positive cells only (YoloV4Loss): the bytes autograd saves for the backward
+pass and, on CUDA, the peak allocated memory. Every pass runs in a fresh process.
+
+usage: python benchmark/box_iou_benchmark.py [--sizes 416 512 608] [--batch_size 8] [--boxes 3]
+"""
+import sys
+import os
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+import argparse
+import multiprocessing as mp
+import numpy as np
+import torch
+from utils import tools
+from utils.box_iou import box_iou_xywh, KINDS
+from ignore_mask_benchmark import random_inputs, decode
+
+
+def random_boxes(n, rng):
+    xy = rng.uniform(0, 100, (n, 2))
+    wh = rng.uniform(1, 60, (n, 2))
+    boxes1 = np.concatenate([xy, wh], -1)
+    boxes2 = np.concatenate([rng.uniform(0, 100, (n, 2)), rng.uniform(1, 60, (n, 2))], -1)
+    boxes2[:n // 2] = boxes1[:n // 2] + rng.normal(0, 2, (n // 2, 4))
+    boxes1[:n // 8, 2:] *= -1
+    return torch.from_numpy(boxes1).requires_grad_(), torch.from_numpy(boxes2).requires_grad_()
+
+
+def check_gradients(rng):
+    boxes1, boxes2 = random_boxes(64, rng)
+    reference = {'giou': tools.GIOU_xywh_torch, 'ciou': tools.CIOU_xywh_torch}
+    for kind in KINDS:
+        line = '{:5s} gradcheck: {}'.format(kind, torch.autograd.gradcheck(
+            lambda a, b: box_iou_xywh(a, b, kind), (boxes1, boxes2)))
+        if kind in reference:
+            value = box_iou_xywh(boxes1, boxes2, kind)
+            grads = torch.autograd.grad(value.sum(), (boxes1, boxes2))
+            ref_value = reference[kind](boxes1, boxes2)
+            ref_grads = torch.autograd.grad(ref_value.sum(), (boxes1, boxes2))
+            line += ', max diff to tools: value {:.2e} gradient {:.2e}'.format(
+                (value - ref_value).abs().max().item(),
+                max((g - r).abs().max().item() for g, r in zip(grads, ref_grads)))
+        print(line)
+
+
+def run(img_size, batch_size, boxes_per_layer, mode):
+    """
+    :return: (saved, peak, loss) bytes of the tensors saved for backward, other than the inputs,
+             peak allocated memory over the inputs (CUDA only, else None) and the loss
+    """
+    device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
+    p, labels, _ = random_inputs(img_size, batch_size, boxes_per_layer, device, np.random.RandomState(0))
+    with torch.no_grad():
+        p_d = [p_d_i[..., :4].contiguous().requires_grad_() for p_d_i in decode(p, img_size)]
+    del p
+    inputs = set(t.untyped_storage().data_ptr() for t in p_d + labels)
+    saved = {}
+
+    def pack(tensor):
+        storage = tensor.untyped_storage()
+        if storage.data_ptr() not in inputs:
+            saved[storage.data_ptr()] = storage.nbytes()
+        return tensor
+
+    if device.type == 'cuda':
+        torch.cuda.reset_peak_memory_stats(device)
+    base = torch.cuda.memory_allocated(device) if device.type == 'cuda' else 0
+    with torch.autograd.graph.saved_tensors_hooks(pack, lambda tensor: tensor):
+        loss = 0
+        for p_d_xywh, label in zip(p_d, labels):
+            label_xywh, obj_mask = label[..., :4], label[..., 4:5]
+            if mode == 'tools':
+                ciou = tools.CIOU_xywh_torch(p_d_xywh, label_xywh).unsqueeze(-1)
+            elif mode == 'function':
+                ciou = box_iou_xywh(p_d_xywh, label_xywh, 'ciou').unsqueeze(-1)
+            else:
+                obj = obj_mask[..., 0] > 0
+                p_d_xywh, label_xywh, obj_mask = p_d_xywh[obj], label_xywh[obj], obj_mask[obj]
+                ciou = box_iou_xywh(p_d_xywh, label_xywh, 'ciou').unsqueeze(-1)
+            loss = loss + torch.sum(obj_mask * (1.0 - ciou))
+    loss.backward()
+    peak = torch.cuda.max_memory_allocated(device) - base if device.type == 'cuda' else None
+    return sum(saved.values()), peak, loss.item()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--sizes', type=int, nargs='+', default=[416, 512, 608])
+    parser.add_argument('--batch_size', type=int, default=8)
+    parser.add_argument('--boxes', type=float, default=3, help='mean GT boxes per image and layer')
+    opt = parser.parse_args()
+
+    check_gradients(np.random.RandomState(0))
+
+    modes = ('tools', 'function', 'positive')
+    ctx = mp.get_context('spawn')
+    print('memory of the CIoU loss term (MB), saved for backward / peak (CUDA only)')
+    print('{:>6s} {:>16s} {:>16s} {:>16s} {:>10s}'.format('size', *modes, 'same loss'))
+    for img_size in opt.sizes:
+        columns, losses = [], []
+        for mode in modes:
+            with ctx.Pool(1) as pool:
+                saved, peak, loss = pool.apply(run, (img_size, opt.batch_size, opt.boxes, mode))
+            columns.append('{:.1f} / {}'.format(saved / 2 ** 20, '-' if peak is None else '{:.1f}'.format(peak / 2 ** 20)))
+            losses.append(loss)
+        print('{:6d} {:>16s} {:>16s} {:>16s} {:>10s}'.format(img_size, *columns,
+                                                           str(np.allclose(losses, losses[0], rtol=1e-5))))
@@ -0,0 +1,76 @@
+# coding=utf-8
+"""
+Compare the fused YoloV4Loss (one pass over the rows of the three layers) with the pass per layer:
+time of a forward/backward step, operators run (torch.profiler) and autograd nodes of the loss
+graph. The losses and gradients must match.
+
+usage: python benchmark/fused_loss_benchmark.py [--img_size 416] [--batch_size 4] [--repeat 20]
+"""
+import sys
+import os
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+import argparse
+import time
+import numpy as np
+import torch
+from torch.profiler import profile
+import config.yolov4_config as cfg
+from model.loss.yolo_loss import YoloV4Loss
+from ignore_mask_benchmark import random_inputs, decode
+
+
+def graph_nodes(tensor):
+    seen, stack = set(), [tensor.grad_fn]
+    while stack:
+        node = stack.pop()
+        if node is None or node in seen:
+            continue
+        seen.add(node)
+        stack.extend(next_node for next_node, _ in node.next_functions)
+    return len(seen)
+
+
+def step(criterion, p, labels, bboxes, img_size):
+    for p_i in p:
+        p_i.grad = None
+    losses = criterion(p, decode(p, img_size), *labels, *bboxes)
+    losses[0].backward()
+    return losses
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--img_size', type=int, default=416)
+    parser.add_argument('--batch_size', type=int, default=4)
+    parser.add_argument('--boxes', type=float, default=3, help='mean GT boxes per image and layer')
+    parser.add_argument('--repeat', type=int, default=20)
+    opt = parser.parse_args()
+
+    device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
+    p, labels, bboxes = random_inputs(opt.img_size, opt.batch_size, opt.boxes, device, np.random.RandomState(0))
+    results = {}
+    for fused in (False, True):
+        criterion = YoloV4Loss(cfg.MODEL["ANCHORS"], cfg.MODEL["STRIDES"], fused=fused)
+        losses = step(criterion, p, labels, bboxes, opt.img_size)
+        grads = [p_i.grad.clone() for p_i in p]
+        nodes = graph_nodes(criterion(p, decode(p, opt.img_size), *labels, *bboxes)[0])
+        with profile() as prof:
+            step(criterion, p, labels, bboxes, opt.img_size)
+        ops = len([e for e in prof.events() if e.name.startswith('aten::')])
+        if device.type == 'cuda':
+            torch.cuda.synchronize()
+        start = time.time()
+        for _ in range(opt.repeat):
+            step(criterion, p, labels, bboxes, opt.img_size)
+        if device.type == 'cuda':
+            torch.cuda.synchronize()
+        results[fused] = ([l.item() for l in losses], grads, nodes, ops, (time.time() - start) / opt.repeat * 1000)
+
+    print('{:>10s} {:>10s} {:>10s} {:>10s}'.format('', 'ms/step', 'aten ops', 'graph'))
+    for fused in (False, True):
+        _, _, nodes, ops, ms = results[fused]
+        print('{:>10s} {:10.2f} {:10d} {:10d}'.format('fused' if fused else 'per layer', ms, ops, nodes))
+    print('losses {} / {}'.format(results[False][0], results[True][0]))
+    print('losses match: {}, gradients match: {}'.format(
+        np.allclose(results[False][0], results[True][0], rtol=1e-5),
+        all(torch.allclose(a, b, rtol=1e-4, atol=1e-6) for a, b in zip(results[False][1], results[True][1]))))
@@ -0,0 +1,107 @@
+# coding=utf-8
+"""
+Latency of the eval decode of the three Yolo_head layers: the former decode (grid rebuilt and
+repeated over the batch, anchors moved to the device and the outputs concatenated on every call)
+against the cached grids and the decode into one output of Build_Model. The outputs may differ by
+an ulp of the sigmoid, which is vectorized over other runs of elements.
+
+usage: python benchmark/head_decode_benchmark.py [--sizes 416 608] [--batch_size 1] [--repeat 200]
+"""
+import sys
+import os
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+import argparse
+import time
+import torch
+import config.yolov4_config as cfg
+from model.head.yolo_head import Yolo_head
+
+
+def reference_decode(p, anchors, stride, nC):
+    """
+    The former Yolo_head.__decode, kept here as the reference implementation.
+    """
+    batch_size, output_size = p.shape[:2]
+
+    device = p.device
+    anchors = (1.0 * anchors).to(device)
+
+    conv_raw_dxdy = p[:, :, :, :, 0:2]
+    conv_raw_dwdh = p[:, :, :, :, 2:4]
+    conv_raw_conf = p[:, :, :, :, 4:5]
+    conv_raw_prob = p[:, :, :, :, 5:]
+
+    y = torch.arange(0, output_size).unsqueeze(1).repeat(1, output_size)
+    x = torch.arange(0, output_size).unsqueeze(0).repeat(output_size, 1)
+    grid_xy = torch.stack([x, y], dim=-1)
+    grid_xy = grid_xy.unsqueeze(0).unsqueeze(3).repeat(batch_size, 1, 1, 3, 1).float().to(device)
+
+    pred_xy = (torch.sigmoid(conv_raw_dxdy) + grid_xy) * stride
+    pred_wh = (torch.exp(conv_raw_dwdh) * anchors) * stride
+    pred_xywh = torch.cat([pred_xy, pred_wh], dim=-1)
+    pred_conf = torch.sigmoid(conv_raw_conf)
+    pred_prob = torch.sigmoid(conv_raw_prob)
+    pred_bbox = torch.cat([pred_xywh, pred_conf, pred_prob], dim=-1)
+
+    return pred_bbox.view(-1, 5 + nC)
+
+
+def reference(features, anchors, strides, nC):
+    nA = len(anchors[0])
+    p_d = []
+    for x, anchors_i, stride in zip(features, anchors, strides):
+        bs, nG = x.shape[0], x.shape[-1]
+        p = x.view(bs, nA, 5 + nC, nG, nG).permute(0, 3, 4, 1, 2)
+        p_d.append(reference_decode(p.clone(), anchors_i, stride, nC))
+    return torch.cat(p_d, 0)
+
+
+def cached(features, heads, nC):
+    """
+    The eval path of Build_Model.forward.
+    """
+    nA = cfg.MODEL["ANCHORS_PER_SCLAE"]
+    rows = [x.shape[0] * x.shape[2] * x.shape[3] * nA for x in features]
+    p_d = features[0].new_empty((sum(rows), 5 + nC))
+    start = 0
+    for head, x, n in zip(heads, features, rows):
+        bs, nG = x.shape[0], x.shape[-1]
+        head(x, p_d[start:start + n].view(bs, nG, nG, nA, 5 + nC))
+        start += n
+    return p_d
+
+
+def timeit(fn, repeat, device):
+    fn()
+    if device.type == 'cuda':
+        torch.cuda.synchronize()
+    start = time.time()
+    for _ in range(repeat):
+        fn()
+    if device.type == 'cuda':
+        torch.cuda.synchronize()
+    return (time.time() - start) / repeat * 1000
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--sizes', type=int, nargs='+', default=[416, 608])
+    parser.add_argument('--batch_size', type=int, default=1)
+    parser.add_argument('--repeat', type=int, default=200)
+    opt = parser.parse_args()
+
+    device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
+    nC = cfg.VOC_DATA["NUM"]
+    anchors = torch.FloatTensor(cfg.MODEL["ANCHORS"])
+    strides = torch.FloatTensor(cfg.MODEL["STRIDES"])
+    heads = [Yolo_head(nC=nC, anchors=anchors[i], stride=strides[i]).eval() for i in range(3)]
+    print('{:>6s} {:>14s} {:>14s} {:>8s} {:>10s}'.format('size', 'reference ms', 'cached ms', 'speedup', 'max diff'))
+    with torch.no_grad():
+        for img_size in opt.sizes:
+            features = [torch.randn(opt.batch_size, 3 * (5 + nC), img_size // int(s), img_size // int(s), device=device)
+                        for s in strides]
+            diff = (reference(features, anchors, strides, nC) - cached(features, heads, nC)).abs().max().item()
+            ms_reference = timeit(lambda: reference(features, anchors, strides, nC), opt.repeat, device)
+            ms_cached = timeit(lambda: cached(features, heads, nC), opt.repeat, device)
+            print('{:6d} {:14.3f} {:14.3f} {:8.2f} {:10.2e}'.format(img_size, ms_reference, ms_cached,
+                                                                   ms_reference / ms_cached, diff))
@@ -0,0 +1,105 @@
+# coding=utf-8
+"""
+Peak memory of a forward/backward pass of YoloV4Loss with the chunked, autograd-free ignore mask
+of model/loss/yolo_loss.iou_max against the former IoU product with all 150 GT slots, at several
+input sizes. The losses must be identical.
+
+Every pass runs in a fresh process: the peak is the growth of max_memory_allocated on CUDA, of
+the max resident set size on the CPU, over the memory of the inputs.
+
+usage: python benchmark/ignore_mask_benchmark.py [--sizes 416 512 608] [--batch_size 4] [--boxes 3]
+"""
+import sys
+import os
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+import argparse
+import resource
+import multiprocessing as mp
+import numpy as np
+import torch
+from utils import tools
+import config.yolov4_config as cfg
+from model.loss import yolo_loss
+
+
+def dense_iou_max(p_d_xywh, bboxes):
+    """
+    The former ignore mask IoU of YoloV4Loss, kept here as the reference implementation.
+    """
+    iou = tools.iou_xywh_torch(p_d_xywh.unsqueeze(4), bboxes.unsqueeze(1).unsqueeze(1).unsqueeze(1))
+    return iou.max(-1, keepdim=True)[0]
+
+
+def random_inputs(img_size, batch_size, boxes_per_layer, device, rng=np.random):
+    """
+    Predictions of the three layers and dense labels with boxes_per_layer objects per image and
+    layer on average, like utils.datasets.
+    """
+    num_classes = cfg.VOC_DATA["NUM"]
+    p, labels, bboxes = [], [], []
+    for stride in cfg.MODEL["STRIDES"]:
+        grid = img_size // stride
+        p.append(torch.from_numpy(rng.normal(0, 1, (batch_size, grid, grid, 3, 5 + num_classes))).float())
+        label = torch.zeros((batch_size, grid, grid, 3, 6 + num_classes))
+        layer_bboxes = torch.zeros((batch_size, 150, 4))
+        for i in range(batch_size):
+            n = rng.poisson(boxes_per_layer)
+            xy = rng.uniform(0, img_size, (n, 2))
+            wh = rng.uniform(stride, 8 * stride, (n, 2))
+            layer_bboxes[i, :n] = torch.from_numpy(np.concatenate([xy, wh], -1)).float()
+            cells = (xy // stride).astype(np.int64)
+            anchors = rng.randint(0, 3, n)
+            label[i, cells[:, 1], cells[:, 0], anchors, :4] = layer_bboxes[i, :n]
+            label[i, cells[:, 1], cells[:, 0], anchors, 4:6] = 1.0
+            label[i, cells[:, 1], cells[:, 0], anchors, 6 + rng.randint(0, num_classes, n)] = 1.0
+        labels.append(label.to(device))
+        bboxes.append(layer_bboxes.to(device))
+    return [v.to(device).requires_grad_() for v in p], labels, bboxes
+
+
+def decode(p, img_size):
+    p_d = []
+    for p_i, stride in zip(p, cfg.MODEL["STRIDES"]):
+        xy = torch.sigmoid(p_i[..., :2]) * img_size
+        wh = torch.exp(p_i[..., 2:4].clamp(max=4)) * stride
+        p_d.append(torch.cat([xy, wh, torch.sigmoid(p_i[..., 4:])], -1))
+    return p_d
+
+
+def peak_memory(device):
+    if device.type == 'cuda':
+        return torch.cuda.max_memory_allocated(device)
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def run(img_size, batch_size, boxes_per_layer, dense):
+    device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
+    if dense:
+        yolo_loss.iou_max = dense_iou_max
+    p, labels, bboxes = random_inputs(img_size, batch_size, boxes_per_layer, device, np.random.RandomState(0))
+    criterion = yolo_loss.YoloV4Loss(cfg.MODEL["ANCHORS"], cfg.MODEL["STRIDES"])
+    if device.type == 'cuda':
+        torch.cuda.reset_peak_memory_stats(device)
+    base = peak_memory(device)
+    loss, loss_ciou, loss_conf, loss_cls = criterion(p, decode(p, img_size), *labels, *bboxes)
+    loss.backward()
+    return peak_memory(device) - base, [loss.item(), loss_ciou.item(), loss_conf.item(), loss_cls.item()]
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--sizes', type=int, nargs='+', default=[416, 512, 608])
+    parser.add_argument('--batch_size', type=int, default=4)
+    parser.add_argument('--boxes', type=float, default=3, help='mean GT boxes per image and layer')
+    opt = parser.parse_args()
+
+    ctx = mp.get_context('spawn')
+    print('{:>6s} {:>12s} {:>12s} {:>8s} {:>9s}'.format('size', 'dense MB', 'chunked MB', 'ratio', 'same loss'))
+    for img_size in opt.sizes:
+        result = {}
+        for dense in (True, False):
+            with ctx.Pool(1) as pool:
+                result[dense] = pool.apply(run, (img_size, opt.batch_size, opt.boxes, dense))
+        (dense_peak, dense_loss), (peak, loss) = result[True], result[False]
+        print('{:6d} {:12.1f} {:12.1f} {:8.2f} {:>9s}'.format(img_size, dense_peak / 2 ** 20, peak / 2 ** 20,
+                                                               dense_peak / max(peak, 1), str(dense_loss == loss)))
@@ -0,0 +1,157 @@
+# coding=utf-8
+"""
+Compare the vectorized anchor assignment (utils/label_assign.py) with the former per-box loop
+of Build_Dataset.__creat_label at several box counts.
+
+The two only differ on anchors hit by several boxes: the loop gives them to the last box, the
+vectorized routine to the box with the highest IoU. "match" compares the labels outside of
+those collisions, "collisions" counts the anchors concerned.
+
+usage: python benchmark/label_assign_benchmark.py [--counts 10 100 500] [--img_size 416]
+"""
+import sys
+import os
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+import argparse
+import time
+import numpy as np
+import torch
+import config.yolov4_config as cfg
+import utils.tools as tools
+import utils.data_augment as dataAug
+from utils.label_assign import assign_labels, densify_labels
+
+
+def loop_creat_label(bboxes, img_size, num_classes):
+    """
+    The former Build_Dataset.__creat_label, kept here as the reference implementation.
+    """
+    anchors = np.array(cfg.MODEL["ANCHORS"])
+    strides = np.array(cfg.MODEL["STRIDES"])
+    train_output_size = img_size / strides
+    anchors_per_scale = cfg.MODEL["ANCHORS_PER_SCLAE"]
+
+    label = [np.zeros((int(train_output_size[i]), int(train_output_size[i]), anchors_per_scale, 6+num_classes))
+             for i in range(3)]
+    for i in range(3):
+        label[i][..., 5] = 1.0
+
+    bboxes_xywh = [np.zeros((150, 4)) for _ in range(3)]
+    bbox_count = np.zeros((3,))
+
+    for bbox in bboxes:
+        bbox_coor = bbox[:4]
+        bbox_class_ind = int(bbox[4])
+        bbox_mix = bbox[5] if len(bbox) >= 6 else None
+
+        one_hot = np.zeros(num_classes, dtype=np.float32)
+        one_hot[bbox_class_ind] = 1.0
+        one_hot_smooth = dataAug.LabelSmooth()(one_hot, num_classes)
+
+        bbox_xywh = np.concatenate([(bbox_coor[2:] + bbox_coor[:2]) * 0.5, bbox_coor[2:] - bbox_coor[:2]], axis=-1)
+        bbox_xywh_scaled = 1.0 * bbox_xywh[np.newaxis, :] / strides[:, np.newaxis]
+
+        iou = []
+        exist_positive = False
+        for i in range(3):
+            anchors_xywh = np.zeros((anchors_per_scale, 4))
+            anchors_xywh[:, 0:2] = np.floor(bbox_xywh_scaled[i, 0:2]).astype(np.int32) + 0.5
+            anchors_xywh[:, 2:4] = anchors[i]
+
+            iou_scale = tools.iou_xywh_numpy(bbox_xywh_scaled[i][np.newaxis, :], anchors_xywh)
+            iou.append(iou_scale)
+            iou_mask = iou_scale > 0.3
+
+            if np.any(iou_mask):
+                xind, yind = np.floor(bbox_xywh_scaled[i, 0:2]).astype(np.int32)
+                label[i][yind, xind, iou_mask, 0:4] = bbox_xywh
+                label[i][yind, xind, iou_mask, 4:5] = 1.0
+                label[i][yind, xind, iou_mask, 5:6] = bbox_mix
+                label[i][yind, xind, iou_mask, 6:] = one_hot_smooth
+
+                bbox_ind = int(bbox_count[i] % 150)
+                bboxes_xywh[i][bbox_ind, :4] = bbox_xywh
+                bbox_count[i] += 1
+                exist_positive = True
+
+        if not exist_positive:
+            best_anchor_ind = np.argmax(np.array(iou).reshape(-1), axis=-1)
+            best_detect = int(best_anchor_ind / anchors_per_scale)
+            best_anchor = int(best_anchor_ind % anchors_per_scale)
+            xind, yind = np.floor(bbox_xywh_scaled[best_detect, 0:2]).astype(np.int32)
+
+            label[best_detect][yind, xind, best_anchor, 0:4] = bbox_xywh
+            label[best_detect][yind, xind, best_anchor, 4:5] = 1.0
+            label[best_detect][yind, xind, best_anchor, 5:6] = bbox_mix
+            label[best_detect][yind, xind, best_anchor, 6:] = one_hot_smooth
+
+            bbox_ind = int(bbox_count[best_detect] % 150)
+            bboxes_xywh[best_detect][bbox_ind, :4] = bbox_xywh
+            bbox_count[best_detect] += 1
+
+    return label + bboxes_xywh
+
+
+def vectorized_creat_label(bboxes, img_size, num_classes):
+    rows, layer_boxes = assign_labels(bboxes, cfg.MODEL["ANCHORS"], cfg.MODEL["STRIDES"],
+                                      cfg.MODEL["ANCHORS_PER_SCLAE"])
+    return densify_labels(rows, layer_boxes, bboxes, img_size, num_classes, cfg.MODEL["STRIDES"],
+                          cfg.MODEL["ANCHORS_PER_SCLAE"])
+
+
+def random_bboxes(num, num_classes, img_size=416, rng=np.random):
+    """
+    Boxes of every size, with mixup weights like the train set.
+    """
+    xy = rng.uniform(0, img_size - 8, (num, 2))
+    wh = np.exp(rng.uniform(np.log(4), np.log(img_size / 2), (num, 2)))
+    classes = rng.randint(0, num_classes, (num, 1))
+    mix = rng.uniform(0.5, 1.0, (num, 1))
+    return np.concatenate([xy, np.minimum(xy + wh, img_size - 1), classes, mix], axis=-1)
+
+
+def compare(reference, labels):
+    """
+    :return: (match outside of the collisions, number of collided anchors)
+    """
+    collisions, match = 0, True
+    for ref, label in zip(reference[:3], labels[:3]):
+        label = label.numpy()
+        differ = np.any(np.abs(ref - label) > 1e-4, axis=-1)
+        collisions += int(differ.sum())
+        match = match and np.array_equal(ref[..., 4], label[..., 4])
+    for ref, label in zip(reference[3:], labels[3:]):
+        match = match and np.allclose(ref, label.numpy(), atol=1e-4)
+    return match, collisions
+
+
+def timeit(fn, repeat):
+    fn()
+    start = time.time()
+    for _ in range(repeat):
+        fn()
+    return (time.time() - start) / repeat * 1000
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--counts', type=int, nargs='+', default=[1, 10, 50, 100, 300, 1000])
+    parser.add_argument('--img_size', type=int, default=416)
+    parser.add_argument('--classes', type=int, default=20)
+    parser.add_argument('--repeat', type=int, default=20)
+    opt = parser.parse_args()
+
+    rng = np.random.RandomState(0)
+    print('{:>6} | {:>10} | {:>12} | {:>16} | {:>7} | {:>10}'.format(
+        'boxes', 'loop(ms)', 'assign(ms)', 'assign+dense(ms)', 'match', 'collisions'))
+    for num in opt.counts:
+        bboxes = random_bboxes(num, opt.classes, opt.img_size, rng=rng)
+        # the former __getitem__ converted the float64 labels to float tensors as well
+        t_loop = timeit(lambda: [torch.from_numpy(label).float()
+                                 for label in loop_creat_label(bboxes, opt.img_size, opt.classes)], opt.repeat)
+        t_assign = timeit(lambda: assign_labels(bboxes, cfg.MODEL["ANCHORS"], cfg.MODEL["STRIDES"]), opt.repeat)
+        t_dense = timeit(lambda: vectorized_creat_label(bboxes, opt.img_size, opt.classes), opt.repeat)
+        match, collisions = compare(loop_creat_label(bboxes, opt.img_size, opt.classes),
+                                    vectorized_creat_label(bboxes, opt.img_size, opt.classes))
+        print('{:>6d} | {:>10.2f} | {:>12.2f} | {:>16.2f} | {:>7} | {:>10d}'.format(
+            num, t_loop, t_assign, t_dense, str(match), collisions))
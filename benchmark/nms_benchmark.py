@@ -0,0 +1,137 @@
+# coding=utf-8
+"""
+Compare the batched NMS engine (utils/nms.py) with the former per-class while-loop of
+utils.tools.nms at several candidate counts, then on skewed candidates where one or two classes
+get all the boxes (multi-scale or flip test at a low CONF_THRESH), with the peak memory of numpy.
+
+usage: python benchmark/nms_benchmark.py [--counts 500 2000 5000] [--classes 20] [--skewed 10000,1 20000,2]
+"""
+import sys
+import os
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+import argparse
+import time
+import tracemalloc
+import numpy as np
+import torch
+from utils.nms import multiclass_nms, batched_multiclass_nms
+from utils.tools import iou_xyxy_numpy
+
+
+def loop_nms(bboxes, score_threshold, iou_threshold, sigma=0.3, method='nms'):
+    """
+    The former utils.tools.nms, kept here as the reference implementation.
+    """
+    classes_in_img = list(set(bboxes[:, 5].astype(np.int32)))
+    best_bboxes = []
+
+    for cls in classes_in_img:
+        cls_mask = (bboxes[:, 5].astype(np.int32) == cls)
+        cls_bboxes = bboxes[cls_mask]
+        while len(cls_bboxes) > 0:
+            max_ind = np.argmax(cls_bboxes[:, 4])
+            best_bbox = cls_bboxes[max_ind]
+            best_bboxes.append(best_bbox)
+            cls_bboxes = np.concatenate([cls_bboxes[: max_ind], cls_bboxes[max_ind + 1:]])
+            iou = iou_xyxy_numpy(best_bbox[np.newaxis, :4], cls_bboxes[:, :4])
+            weight = np.ones((len(iou),), dtype=np.float32)
+            if method == 'nms':
+                iou_mask = iou > iou_threshold
+                weight[iou_mask] = 0.0
+            if method == 'soft-nms':
+                weight = np.exp(-(1.0 * iou ** 2 / sigma))
+            cls_bboxes[:, 4] = cls_bboxes[:, 4] * weight
+            score_mask = cls_bboxes[:, 4] > score_threshold
+            cls_bboxes = cls_bboxes[score_mask]
+    return np.array(best_bboxes)
+
+
+def random_candidates(num, num_classes, img_size=416, rng=np.random):
+    """
+    Clustered boxes, similar to the raw output of a detector: a few objects with many
+    jittered candidates around each of them.
+    """
+    centers = rng.uniform(0, img_size, (max(num // 50, 1), 2))
+    sizes = rng.uniform(16, img_size / 3, (len(centers), 2))
+    ind = rng.randint(0, len(centers), num)
+    xy = centers[ind] + rng.normal(0, 8, (num, 2))
+    wh = sizes[ind] * rng.uniform(0.8, 1.2, (num, 2))
+    scores = rng.uniform(0.005, 1.0, (num, 1))
+    classes = rng.randint(0, num_classes, (num, 1))
+    return np.concatenate([xy - wh / 2, xy + wh / 2, scores, classes], axis=-1)
+
+
+def timeit(fn, repeat):
+    fn()
+    start = time.time()
+    for _ in range(repeat):
+        fn()
+    return (time.time() - start) / repeat * 1000
+
+
+def peak_mb(fn):
+    tracemalloc.start()
+    fn()
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return peak / 2 ** 20
+
+
+def same_result(a, b):
+    if len(a) != len(b):
+        return False
+    key = lambda x: x[np.lexsort((x[:, 0], -x[:, 4], x[:, 5]))]
+    return len(a) == 0 or np.allclose(key(a), key(b))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--counts', type=int, nargs='+', default=[100, 500, 1000, 2000, 5000])
+    parser.add_argument('--classes', type=int, default=20)
+    parser.add_argument('--batch', type=int, default=8, help='images per call of the batched engine')
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--conf_thresh', type=float, default=0.005)
+    parser.add_argument('--nms_thresh', type=float, default=0.45)
+    parser.add_argument('--skewed', type=str, nargs='+', default=['10000,1', '20000,2', '20000,1'],
+                        help='boxes,classes of the skewed cases')
+    opt = parser.parse_args()
+
+    rng = np.random.RandomState(0)
+    device = 'cuda' if torch.cuda.is_available() else 'cpu'
+    print('{:>8} | {:>10} | {:>12} | {:>12} | {:>18} | {:>7}'.format(
+        'boxes', 'loop(ms)', 'numpy(ms)', 'torch(ms)', 'batched/img(ms)', 'match'))
+    for num in opt.counts:
+        bboxes = random_candidates(num, opt.classes, rng=rng)
+        batch = [random_candidates(num, opt.classes, rng=rng) for _ in range(opt.batch)]
+        bboxes_t = torch.from_numpy(bboxes).to(device)
+        batch_t = [torch.from_numpy(b).to(device) for b in batch]
+
+        t_loop = timeit(lambda: loop_nms(bboxes.copy(), opt.conf_thresh, opt.nms_thresh), opt.repeat)
+        t_numpy = timeit(lambda: multiclass_nms(bboxes, opt.conf_thresh, opt.nms_thresh), opt.repeat)
+        t_torch = timeit(lambda: multiclass_nms(bboxes_t, opt.conf_thresh, opt.nms_thresh), opt.repeat)
+        t_batch = timeit(lambda: batched_multiclass_nms(batch_t, opt.conf_thresh, opt.nms_thresh),
+                         opt.repeat) / opt.batch
+        match = same_result(loop_nms(bboxes.copy(), opt.conf_thresh, opt.nms_thresh),
+                            multiclass_nms(bboxes, opt.conf_thresh, opt.nms_thresh))
+        print('{:>8d} | {:>10.2f} | {:>12.2f} | {:>12.2f} | {:>18.2f} | {:>7}'.format(
+            num, t_loop, t_numpy, t_torch, t_batch, str(match)))
+
+    print('\nsoft-nms, {} boxes'.format(opt.counts[-1]))
+    bboxes = random_candidates(opt.counts[-1], opt.classes, rng=rng)
+    for method in ['soft-nms', 'linear', 'diou', 'matrix']:
+        t = timeit(lambda: multiclass_nms(bboxes, opt.conf_thresh, opt.nms_thresh, method=method), opt.repeat)
+        print('  {:>14}: {:.2f} ms'.format(method, t))
+    t = timeit(lambda: loop_nms(bboxes.copy(), opt.conf_thresh, opt.nms_thresh, method='soft-nms'), opt.repeat)
+    print('  {:>14}: {:.2f} ms'.format('loop soft-nms', t))
+
+    print('\nskewed classes, one call')
+    print('{:>8} | {:>7} | {:>10} | {:>12} | {:>14} | {:>15} | {:>7}'.format(
+        'boxes', 'classes', 'loop(ms)', 'numpy(ms)', 'loop peak(MB)', 'numpy peak(MB)', 'match'))
+    for case in opt.skewed:
+        num, num_classes = map(int, case.split(','))
+        bboxes = random_candidates(num, num_classes, rng=rng)
+        loop = lambda: loop_nms(bboxes.copy(), opt.conf_thresh, opt.nms_thresh)
+        engine = lambda: multiclass_nms(bboxes, opt.conf_thresh, opt.nms_thresh)
+        print('{:>8d} | {:>7d} | {:>10.2f} | {:>12.2f} | {:>14.1f} | {:>15.1f} | {:>7}'.format(
+            num, num_classes, timeit(loop, 1), timeit(engine, 1), peak_mb(loop), peak_mb(engine),
+            str(same_result(loop(), engine()))))
@@ -0,0 +1,94 @@
+# coding=utf-8
+"""
+Compare the postprocess of Evaluator on the model device (score, threshold, top-k and letterbox
+rescaling as tensor ops, only the kept rows copied to the host) with the former copy of the whole
+decoded tensor to numpy, per image, on random decoded predictions. The boxes must be identical.
+
+usage: python benchmark/postprocess_benchmark.py [--sizes 416 608] [--classes 20 80] [--conf 0.005] [--repeat 50]
+"""
+import sys
+import os
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+import argparse
+import time
+import numpy as np
+import torch
+import torch.nn as nn
+from utils.tools import xywh2xyxy
+from eval.evaluator import Evaluator
+
+
+def reference_convert(pred_bbox, test_input_size, org_img_shape, valid_scale, score_threshold):
+    """
+    The former Evaluator.__convert_pred on the numpy copy of the predictions, kept here as the
+    reference implementation.
+    """
+    pred_coor = xywh2xyxy(pred_bbox[:, :4])
+    pred_conf = pred_bbox[:, 4]
+    pred_prob = pred_bbox[:, 5:]
+
+    org_h, org_w = org_img_shape
+    resize_ratio = min(1.0 * test_input_size / org_w, 1.0 * test_input_size / org_h)
+    dw = (test_input_size - resize_ratio * org_w) / 2
+    dh = (test_input_size - resize_ratio * org_h) / 2
+    pred_coor[:, 0::2] = 1.0 * (pred_coor[:, 0::2] - dw) / resize_ratio
+    pred_coor[:, 1::2] = 1.0 * (pred_coor[:, 1::2] - dh) / resize_ratio
+
+    pred_coor = np.concatenate([np.maximum(pred_coor[:, :2], [0, 0]),
+                                np.minimum(pred_coor[:, 2:], [org_w - 1, org_h - 1])], axis=-1)
+    invalid_mask = np.logical_or((pred_coor[:, 0] > pred_coor[:, 2]), (pred_coor[:, 1] > pred_coor[:, 3]))
+    pred_coor[invalid_mask] = 0
+
+    bboxes_scale = np.sqrt(np.multiply.reduce(pred_coor[:, 2:4] - pred_coor[:, 0:2], axis=-1))
+    scale_mask = np.logical_and((valid_scale[0] < bboxes_scale), (bboxes_scale < valid_scale[1]))
+
+    classes = np.argmax(pred_prob, axis=-1)
+    scores = pred_conf * pred_prob[np.arange(len(pred_coor)), classes]
+    score_mask = scores > score_threshold
+
+    mask = np.logical_and(scale_mask, score_mask)
+    return np.concatenate([pred_coor[mask], scores[mask][:, np.newaxis], classes[mask][:, np.newaxis]], axis=-1)
+
+
+def random_predictions(img_size, num_classes, device, rng=np.random):
+    """
+    Decoded predictions [1, N, 5 + nC] of the three layers, scores mostly low like a trained model.
+    """
+    n = sum(3 * (img_size // stride) ** 2 for stride in (8, 16, 32))
+    pred = np.concatenate([rng.uniform(-20, img_size + 20, (1, n, 2)), rng.uniform(0, img_size / 2, (1, n, 2)),
+                           rng.beta(0.05, 20, (1, n, 1)), rng.beta(0.5, 4, (1, n, num_classes))], -1)
+    return torch.from_numpy(pred.astype(np.float32)).to(device)
+
+
+def timeit(fn, repeat):
+    fn()
+    start = time.time()
+    for _ in range(repeat):
+        fn()
+    return (time.time() - start) / repeat * 1000
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--sizes', type=int, nargs='+', default=[416, 608])
+    parser.add_argument('--classes', type=int, nargs='+', default=[20, 80])
+    parser.add_argument('--conf', type=float, default=0.005)
+    parser.add_argument('--repeat', type=int, default=50)
+    opt = parser.parse_args()
+
+    device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
+    evaluator = Evaluator(nn.Conv2d(1, 1, 1).to(device), showatt=False)
+    convert = evaluator._Evaluator__convert_pred
+    org_shape = (375, 500)
+    print('{:>6s} {:>8s} {:>8s} {:>12s} {:>12s} {:>8s} {:>6s}'.format('size', 'classes', 'kept', 'numpy ms',
+                                                                       'device ms', 'speedup', 'same'))
+    for img_size in opt.sizes:
+        for num_classes in opt.classes:
+            pred = random_predictions(img_size, num_classes, device, np.random.RandomState(0))
+            reference = lambda: reference_convert(pred[0].cpu().numpy(), img_size, org_shape, (0, np.inf), opt.conf)
+            device_side = lambda: convert(pred, img_size, [org_shape], (0, np.inf), opt.conf)[0]
+            bboxes = device_side()
+            same = np.array_equal(reference(), bboxes)
+            ms_reference, ms_device = timeit(reference, opt.repeat), timeit(device_side, opt.repeat)
+            print('{:6d} {:8d} {:8d} {:12.3f} {:12.3f} {:8.2f} {:>6s}'.format(
+                img_size, num_classes, len(bboxes), ms_reference, ms_device, ms_reference / ms_device, str(same)))
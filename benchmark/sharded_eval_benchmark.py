@@ -0,0 +1,91 @@
+# coding=utf-8
+"""
+Throughput of the sharded CPU evaluation (eval/sharded_eval.py) with 1..N worker processes, each
+with the cores split evenly between the workers. The detections of every worker count must be the
+same as those of a single process. Uses the first --images images of the VOC test set, or random
+images written to a temporary directory when it is not found; random weights unless --weight_path.
+
+usage: python benchmark/sharded_eval_benchmark.py [--max_workers 4] [--images 64] [--batch_size 1]
+"""
+import sys
+import os
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+import argparse
+import shutil
+import tempfile
+import time
+import cv2
+import numpy as np
+import torch
+from model.build_model import Build_Model
+from eval.evaluator import Evaluator
+from eval.sharded_eval import default_threads
+
+
+def synthetic_test_set(root, num_images, rng=np.random):
+    """
+    VOC2007-like directory of random images: JPEGImages and ImageSets/Main/test.txt.
+    """
+    os.makedirs(os.path.join(root, 'JPEGImages'))
+    os.makedirs(os.path.join(root, 'ImageSets', 'Main'))
+    img_inds = ['%06d' % i for i in range(num_images)]
+    for img_ind in img_inds:
+        h, w = rng.randint(300, 500, 2)
+        cv2.imwrite(os.path.join(root, 'JPEGImages', img_ind + '.jpg'), rng.randint(0, 255, (h, w, 3), dtype=np.uint8))
+    with open(os.path.join(root, 'ImageSets', 'Main', 'test.txt'), 'w') as f:
+        f.write('\n'.join(img_inds) + '\n')
+
+
+def same_predictions(a, b):
+    return len(a) == len(b) and all(ia == ib and np.allclose(ba, bb, atol=1e-3) for (ia, ba), (ib, bb) in zip(a, b))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--max_workers', type=int, default=4)
+    parser.add_argument('--images', type=int, default=64, help='test images predicted per run')
+    parser.add_argument('--batch_size', type=int, default=1, help='test images per forward pass')
+    parser.add_argument('--weight_path', type=str, default=None, help='weights, random when None')
+    opt = parser.parse_args()
+
+    model = Build_Model()
+    if opt.weight_path:
+        model.load_state_dict(torch.load(opt.weight_path, map_location='cpu'))
+    model.eval()
+    evaluator = Evaluator(model, showatt=False)
+    evaluator.progress = False
+    tmp_root = None
+    if not os.path.isfile(os.path.join(evaluator.val_data_path, 'ImageSets', 'Main', 'test.txt')):
+        tmp_root = tempfile.mkdtemp()
+        evaluator.val_data_path = os.path.join(tmp_root, 'VOC2007')
+        synthetic_test_set(evaluator.val_data_path, opt.images, np.random.RandomState(0))
+        print('VOC test set not found, {} random images'.format(opt.images))
+    if opt.weight_path is None:
+        # random weights score most anchors close to 0.2 to 0.3, keeps a few thousand candidates per image
+        evaluator.conf_thresh = 0.2
+    positions = np.arange(opt.images)
+
+    try:
+        reference, rows = None, []
+        for workers in range(1, opt.max_workers + 1):
+            start = time.time()
+            with evaluator.sharded_predictor(workers, default_threads(workers)) as predictor:
+                # starts the workers and maps the weights, not timed
+                predictor.predict(positions[:workers], batch_size=opt.batch_size)
+                startup = time.time() - start
+                start = time.time()
+                predictions, _ = predictor.predict(positions, batch_size=opt.batch_size)
+                elapsed = time.time() - start
+            if reference is None:
+                reference = predictions
+            rows.append((workers, predictor.num_threads, startup, opt.images / elapsed,
+                         same_predictions(reference, predictions)))
+    finally:
+        if tmp_root:
+            shutil.rmtree(tmp_root)
+
+    print('{:>8s} {:>8s} {:>10s} {:>10s} {:>8s} {:>6s}'.format('workers', 'threads', 'startup s', 'images/s',
+                                                             'speedup', 'same'))
+    for workers, threads, startup, throughput, same in rows:
+        print('{:8d} {:8d} {:10.2f} {:10.2f} {:8.2f} {:>6s}'.format(workers, threads, startup, throughput,
+                                                                    throughput / rows[0][3], str(same)))
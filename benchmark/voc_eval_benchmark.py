@@ -0,0 +1,121 @@
+# coding=utf-8
+"""
+Compare the vectorized TP/FP matching of eval/voc_eval.match_detections with the former loop over
+detections of voc_eval, at several detection counts. rec/prec/AP must be bit-identical.
+
+usage: python benchmark/voc_eval_benchmark.py [--counts 1000 10000 50000] [--images 4952]
+"""
+import sys
+import os
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+import argparse
+import time
+import numpy as np
+from eval.voc_eval import match_detections, voc_ap
+
+
+def loop_match(image_ids, BB, class_recs, ovthresh=0.5):
+    """
+    The former matching loop of voc_eval, kept here as the reference implementation.
+    """
+    nd = len(image_ids)
+    tp = np.zeros(nd)
+    fp = np.zeros(nd)
+    for d in range(nd):
+        R = class_recs[image_ids[d]]
+        bb = BB[d, :].astype(float)
+        ovmax = -np.inf
+        BBGT = R['bbox'].astype(float)
+
+        if BBGT.size > 0:
+            ixmin = np.maximum(BBGT[:, 0], bb[0])
+            iymin = np.maximum(BBGT[:, 1], bb[1])
+            ixmax = np.minimum(BBGT[:, 2], bb[2])
+            iymax = np.minimum(BBGT[:, 3], bb[3])
+            iw = np.maximum(ixmax - ixmin + 1., 0.)
+            ih = np.maximum(iymax - iymin + 1., 0.)
+            inters = iw * ih
+            uni = ((bb[2] - bb[0] + 1.) * (bb[3] - bb[1] + 1.) +
+                   (BBGT[:, 2] - BBGT[:, 0] + 1.) *
+                   (BBGT[:, 3] - BBGT[:, 1] + 1.) - inters)
+            overlaps = inters / uni
+            ovmax = np.max(overlaps)
+            jmax = np.argmax(overlaps)
+
+        if ovmax > ovthresh:
+            if not R['difficult'][jmax]:
+                if not R['det'][jmax]:
+                    tp[d] = 1.
+                    R['det'][jmax] = 1
+                else:
+                    fp[d] = 1.
+        else:
+            fp[d] = 1.
+    return tp, fp
+
+
+def random_class(num_dets, num_images, rng=np.random):
+    """
+    Ground truth of one class and detections around it: jittered copies of GT boxes (several per
+    box, so duplicates become FPs), background boxes and detections on images without GT.
+    """
+    class_recs = {}
+    gt = []
+    for i in range(num_images):
+        n = rng.poisson(0.6)
+        xy = rng.randint(0, 400, (n, 2))
+        bbox = np.concatenate([xy, xy + rng.randint(8, 200, (n, 2))], axis=-1)
+        class_recs['%06d' % i] = {'bbox': bbox, 'difficult': rng.rand(n) < 0.1, 'det': [False] * n}
+        gt.extend(('%06d' % i, b) for b in bbox)
+
+    image_ids, BB = [], []
+    for _ in range(num_dets):
+        if gt and rng.rand() < 0.6:
+            image_id, box = gt[rng.randint(len(gt))]
+            box = box + rng.normal(0, 6, 4)
+        else:
+            image_id = '%06d' % rng.randint(num_images)
+            xy = rng.uniform(0, 400, 2)
+            box = np.concatenate([xy, xy + rng.uniform(8, 200, 2)])
+        image_ids.append(image_id)
+        BB.append(box)
+    confidence = np.round(rng.rand(num_dets), 3)  # ties, like the written result files
+    return class_recs, image_ids, np.array(BB), confidence
+
+
+def pr_ap(tp, fp, npos):
+    fp = np.cumsum(fp)
+    tp = np.cumsum(tp)
+    rec = tp / float(npos)
+    prec = tp / np.maximum(tp + fp, np.finfo(np.float64).eps)
+    return rec, prec, voc_ap(rec, prec)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--counts', type=int, nargs='+', default=[1000, 5000, 20000, 50000])
+    parser.add_argument('--images', type=int, default=4952)
+    parser.add_argument('--ovthresh', type=float, default=0.5)
+    opt = parser.parse_args()
+
+    rng = np.random.RandomState(0)
+    print('{:>8} | {:>10} | {:>14} | {:>8} | {:>9}'.format('dets', 'loop(ms)', 'vectorized(ms)', 'speedup',
+                                                            'identical'))
+    for num in opt.counts:
+        class_recs, image_ids, BB, confidence = random_class(num, opt.images, rng=rng)
+        npos = sum(int(np.sum(~R['difficult'])) for R in class_recs.values())
+        sorted_ind = np.argsort(-confidence)
+        BB = BB[sorted_ind, :]
+        image_ids = [image_ids[x] for x in sorted_ind]
+
+        start = time.time()
+        tp_loop, fp_loop = loop_match(image_ids, BB, class_recs, opt.ovthresh)
+        t_loop = (time.time() - start) * 1000
+        start = time.time()
+        tp_vec, fp_vec = match_detections(image_ids, BB, class_recs, opt.ovthresh)
+        t_vec = (time.time() - start) * 1000
+
+        ref, new = pr_ap(tp_loop, fp_loop, npos), pr_ap(tp_vec, fp_vec, npos)
+        identical = all(np.array_equal(a, b) for a, b in zip(ref, new))
+        print('{:>8d} | {:>10.1f} | {:>14.1f} | {:>7.1f}x | {:>9}'.format(
+            num, t_loop, t_vec, t_loop / t_vec, str(identical)))
@@ -25,7 +25,17 @@ TRAIN = {
          "WEIGHT_DECAY": 0.0005,
          "LR_INIT": 1e-4,
          "LR_END": 1e-6,
-         "WARMUP_EPOCHS": 2  # or None
+         "WARMUP_EPOCHS": 2,  # or None
+         "LABEL_CACHE": False,  # cache parsed annotations and label assignment under PROJECT_PATH/cache
+         "SPARSE_LABEL": False,  # sparse targets + YoloV4SparseLoss instead of dense label grids
+         "FUSED_LOSS": False,  # YoloV4Loss in one pass over the rows of the three layers instead of one per layer
+         "BATCH_AUGMENT": False,  # augment whole batches on the training device (utils/batch_augment.py)
+         "COMPOSED_AUGMENT": False,  # flip/crop/affine/resize as one cv2.warpAffine (dataAug.ComposedAffine)
+         "MOSAIC": 0.,  # probability of a mosaic sample
+         "MOSAIC_CACHE": 256,  # decoded mosaic tiles kept per worker, ~img_size**2*3/4 bytes each
+         "IMAGE_CACHE": False,  # decoded train images shared by all workers (utils/image_cache.py)
+         "IMAGE_CACHE_SIDE": 608,  # longer side of the cached images
+         "IMAGE_CACHE_MB": 4096  # byte budget of the image cache, CLOCK eviction beyond it, on disk when /dev/shm is smaller
          }
 
 
@@ -34,8 +44,27 @@ VAL = {
         "TEST_IMG_SIZE": 416,
         "BATCH_SIZE": 1,
         "NUMBER_WORKERS": 6,
+        "PREFETCH_IMAGES": 16,  #images decoded/letterboxed ahead of the forward pass in evaluation
+        "TEST_CACHE": False,  #keep the letterboxed uint8 test set memory-mapped in cache/test, single-scale evaluation reads it instead of the JPEGs
         "CONF_THRESH": 0.005,
         "NMS_THRESH": 0.45,
+        "NMS_METHOD": 'nms',  #nms, soft-nms, linear, diou, matrix or matrix-linear
+        "POSTPROCESS_TOPK": 0,  #max boxes per image above CONF_THRESH kept before NMS (highest scores, selected on the model device), 0 for all
+        "AP_WORKERS": 0,  #processes computing the per-class APs, 0 for the serial loop
+        "EXPORT_DETECTIONS": False,  #also write the detections as text files (pred_result, output/detection-results)
+        "STREAMING_MAP": False,  #update the APs with every predicted image, no AP pass after the last one
+        "SWEEP_SCORE_FLOOR": 0.001,  #lowest score of the cached pre-NMS candidates (eval/pred_cache.py)
+        "SWEEP_TOPK": 1000,  #max cached candidates per image
+        "SEQUENTIAL_VAL": False,  #training validation: bootstrap the mAP of a subset first, full test set only if it may beat the best
+        "SEQUENTIAL_FRACTION": 0.2,  #fraction of the test images in the stratified subset
+        "SEQUENTIAL_CONFIDENCE": 0.95,  #confidence of the bootstrap interval
+        "SEQUENTIAL_RESAMPLES": 200,  #bootstrap resamples
+        "ASYNC_EVAL": False,  #training validation in a background process (eval/async_eval.py), full APs_voc / COCO evaluation
+        "ASYNC_EVAL_DEVICE": 'cpu',  #device of the evaluation worker, e.g. 'cuda:1'
+        "ASYNC_EVAL_THREADS": 4,  #torch threads of the evaluation worker, 0 for the default
+        "ASYNC_EVAL_PENDING": 1,  #max snapshots waiting or in evaluation, training waits beyond it
+        "EVAL_WORKERS": 0,  #CPU evaluation: processes sharing the model, each predicting shards of the test set (eval/sharded_eval.py), 0 or 1 for a single process
+        "EVAL_WORKER_THREADS": 0,  #torch threads per evaluation worker, 0 to split the cores evenly
         "MULTI_SCALE_VAL": True,
         "FLIP_VAL": True,
         "Visual": True
@@ -0,0 +1,152 @@
+# coding=utf-8
+"""
+Validation in a background process, so that training goes on with the next epoch while a
+snapshot of the weights is evaluated.
+
+The trainer saves the state_dict of the model to a snapshot file and submits its path. A worker
+process started with spawn loads it into its own model on its own device (a second GPU or the
+CPU, with a limited number of threads) and returns the APs through a queue. The snapshot stays on
+disk until the trainer has handled the result, so the weights of a new best epoch can be copied to
+best.pt. At most max_pending snapshots are queued or being evaluated; submit blocks until the
+oldest one is done when the worker falls behind.
+
+The worker is not daemonic, so that the evaluation can start its own processes (AP_WORKERS,
+EVAL_WORKERS). It is stopped by close, or when the trainer exits without it (e.g. on an
+exception): the running evaluation is then interrupted.
+"""
+import os
+import sys
+import queue
+import atexit
+import signal
+import traceback
+import torch
+import torch.multiprocessing as mp
+
+
+def _evaluate(model, data_type):
+    import config.yolov4_config as cfg
+    if data_type == 'COCO':
+        from eval.cocoapi_evaluator import COCOAPIEvaluator
+        evaluator = COCOAPIEvaluator(model_type='YOLOv4',
+                                     data_dir=cfg.DATA_PATH,
+                                     img_size=cfg.VAL["TEST_IMG_SIZE"],
+                                     confthre=0.08,
+                                     nmsthre=cfg.VAL["NMS_THRESH"])
+        ap50_95, ap50 = evaluator.evaluate(model)
+        return {'ap50_95': ap50_95, 'ap50': ap50, 'mAP': ap50}
+    from eval.evaluator import Evaluator
+    APs, inference_time = Evaluator(model, showatt=False).APs_voc()
+    return {'APs': APs, 'mAP': sum(APs.values()) / len(APs), 'inference_time': inference_time}
+
+
+def _worker(tasks, results, device, num_threads, data_type):
+    from model.build_model import Build_Model
+    # terminate unwinds the evaluation, so that the process pools it started are shut down
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    if num_threads > 0:
+        torch.set_num_threads(num_threads)
+    device = torch.device(device)
+    model = Build_Model().to(device)
+    while True:
+        task = tasks.get()
+        if task is None:
+            break
+        epoch, path = task
+        try:
+            model.load_state_dict(torch.load(path, map_location=device))
+            with torch.no_grad():
+                result = _evaluate(model, data_type)
+        except Exception:
+            result = {'error': traceback.format_exc()}
+        result.update({'epoch': epoch, 'path': path})
+        results.put(result)
+
+
+class AsyncEvaluator(object):
+    def __init__(self, snapshot_dir, data_type='VOC', device='cpu', num_threads=4, max_pending=1):
+        """
+        :param snapshot_dir: directory of the weight snapshots
+        :param data_type: cfg.TRAIN["DATA_TYPE"], COCO is evaluated with COCOAPIEvaluator, else APs_voc
+        :param device: device of the worker model, e.g. 'cpu' or 'cuda:1'
+        :param num_threads: torch threads of the worker, 0 for the default
+        :param max_pending: max snapshots submitted and not yet returned
+        """
+        self.snapshot_dir = snapshot_dir
+        self.max_pending = max(1, max_pending)
+        self.pending = 0
+        if not os.path.exists(snapshot_dir):
+            os.makedirs(snapshot_dir)
+        ctx = mp.get_context('spawn')
+        self.__tasks = ctx.Queue()
+        self.__results = ctx.Queue()
+        self.__process = ctx.Process(target=_worker, args=(self.__tasks, self.__results, device, num_threads, data_type))
+        self.__process.start()
+        # registered after multiprocessing's own exit handler, so it runs before that one joins the worker
+        atexit.register(self.__stop, 5)
+
+    def submit(self, epoch, model):
+        """
+        Snapshot the weights of model and queue their evaluation.
+        :return: list of the results returned meanwhile, see poll
+        """
+        done = []
+        while self.pending >= self.max_pending:
+            done.append(self.__get(block=True))
+        path = os.path.join(self.snapshot_dir, 'epoch{}.pt'.format(epoch))
+        torch.save({k: v.detach().cpu() for k, v in model.state_dict().items()}, path)
+        self.__tasks.put((epoch, path))
+        self.pending += 1
+        return done + self.poll()
+
+    def poll(self):
+        """
+        :return: list of the results returned so far, without waiting. A result is a dict with
+                 'epoch', 'path' (the snapshot, to be removed by the caller), 'mAP' and 'APs' (VOC)
+                 or 'ap50_95'/'ap50' (COCO), or 'error' with the traceback of the worker
+        """
+        done = []
+        while self.pending > 0:
+            result = self.__get(block=False)
+            if result is None:
+                break
+            done.append(result)
+        return done
+
+    def close(self):
+        """
+        Wait for the pending evaluations and stop the worker.
+        :return: list of their results
+        """
+        done = []
+        while self.pending > 0:
+            done.append(self.__get(block=True))
+        self.__stop()
+        return done
+
+    def __stop(self, timeout=None):
+        """
+        Ask the worker to exit after its current evaluation, terminate it after timeout seconds.
+        """
+        if not self.__process.is_alive():
+            return
+        self.__tasks.put(None)
+        self.__process.join(timeout)
+        if self.__process.is_alive():
+            self.__process.terminate()
+            self.__process.join(timeout)
+        if self.__process.is_alive():
+            self.__process.kill()
+            self.__process.join()
+
+    def __get(self, block):
+        while True:
+            try:
+                result = self.__results.get(block=block, timeout=10 if block else None)
+                self.pending -= 1
+                return result
+            except queue.Empty:
+                if not block:
+                    return None
+                if not self.__process.is_alive():
+                    raise RuntimeError('the evaluation worker exited with {}'.format(self.__process.exitcode))
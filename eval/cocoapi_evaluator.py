@@ -6,6 +6,7 @@ from torch.autograd import Variable
 import config.yolov4_config as cfg
 from utils.cocodataset import *
 from utils.utils import *
+from eval.pred_cache import top_candidates, replay
 
 
 class COCOAPIEvaluator():
@@ -90,7 +91,65 @@ class COCOAPIEvaluator():
                      "score": score, "segmentation": []} # COCO json format
                 data_dict.append(A)
 
+        return self.__coco_eval(data_dict, ids)
 
+    def predict_candidates(self, model, score_floor=0.001, topk=1000):
+        """
+        The pre-NMS candidates of every val2017 image, for eval.pred_cache.PredictionCache.
+        As in postprocess, every (box, class) pair whose object score * class score is above
+        score_floor is a candidate. The replay runs NMS in the coordinates of the original image
+        instead of the letterboxed ones, the same up to the rounding of the letterbox size.
+        Args:
+            model : model object
+            score_floor (float): lowest score kept, below the confidence thresholds to sweep
+            topk (int): max candidates per image
+        Returns:
+            ids (list) : image ids
+            candidates (list of numpy.ndarray) : per image [n, 6] (x1, y1, x2, y2, score,
+                class index) in the coordinates of the original image
+        """
+        model.eval()
+        cuda = torch.cuda.is_available()
+        Tensor = torch.cuda.FloatTensor if cuda else torch.FloatTensor
+        ids = []
+        candidates = []
+        for img, _, info_img, id_ in self.dataloader:
+            h, w, nh, nw, dx, dy = [float(info) for info in info_img]
+            ids.append(int(id_))
+            with torch.no_grad():
+                _, outputs = model(img.type(Tensor))
+            pred = outputs.cpu().numpy()
+            scores = pred[:, 4:5] * pred[:, 5:]
+            box_ind, cls_ind = np.nonzero(scores > score_floor)
+            xc, yc, bw, bh = pred[box_ind, :4].T
+            # yolobox2label of every box at once
+            x1 = (xc - bw / 2 - dx) / nw * w
+            y1 = (yc - bh / 2 - dy) / nh * h
+            bboxes = np.stack([x1, y1, x1 + bw / nw * w, y1 + bh / nh * h, scores[box_ind, cls_ind], cls_ind], -1)
+            candidates.append(top_candidates(bboxes.astype(np.float64), score_floor, topk))
+        return ids, candidates
+
+    def evaluate_candidates(self, ids, candidates, confthre=None, nmsthre=None, nms_method='nms'):
+        """
+        COCO AP of one confidence/NMS setting applied to cached candidates, without running the model.
+        Args:
+            ids, candidates : see predict_candidates and eval.pred_cache.PredictionCache.load
+            confthre, nmsthre (float): the thresholds of the evaluator when None
+            nms_method (str): one of utils.nms.METHODS
+        Returns:
+            ap50_95 (float), ap50 (float) : as evaluate
+        """
+        confthre = self.confthre if confthre is None else confthre
+        nmsthre = self.nmsthre if nmsthre is None else nmsthre
+        data_dict = []
+        for id_, outputs in zip(ids, replay(candidates, confthre, nmsthre, nms_method)):
+            for x1, y1, x2, y2, score, class_ind in outputs:
+                data_dict.append({"image_id": int(id_), "category_id": self.dataset.class_ids[int(class_ind)],
+                                  "bbox": [float(x1), float(y1), float(x2 - x1), float(y2 - y1)],
+                                  "score": float(score), "segmentation": []})
+        return self.__coco_eval(data_dict, [int(id_) for id_ in ids])
+
+    def __coco_eval(self, data_dict, ids):
         annType = ['segm', 'bbox', 'keypoints']
 
         # Evaluate the Dt (detection) json comparing with the ground truth
@@ -0,0 +1,108 @@
+# coding=utf-8
+"""
+In-memory store of the detections of an evaluation run.
+
+Every class keeps preallocated columns that double when full:
+    img       [n] int32 index into image_names
+    score     [n] float64 confidence
+    box       [n, 4] int32 (xmin, ymin, xmax, ymax)
+
+The rows are kept in insertion order and hold the same values as the comp4_det_test_<class>.txt
+lines of the former per box appends (integer boxes, scores rounded to 4 decimals when read), so
+the APs computed from the store are the same as from the text files. The files are only written
+by export.
+"""
+import os
+import numpy as np
+
+
+class DetectionStore(object):
+    def __init__(self, classes, capacity=1024):
+        """
+        :param classes: class names, index of the class column of the added bboxes
+        :param capacity: initial rows per class
+        """
+        self.classes = list(classes)
+        self.__capacity = capacity
+        self.clear()
+
+    def clear(self):
+        num_classes = len(self.classes)
+        self.image_names = []
+        self.__image_index = {}
+        self.__img = [np.zeros(self.__capacity, dtype=np.int32) for _ in range(num_classes)]
+        self.__score = [np.zeros(self.__capacity, dtype=np.float64) for _ in range(num_classes)]
+        self.__box = [np.zeros((self.__capacity, 4), dtype=np.int32) for _ in range(num_classes)]
+        self.__count = np.zeros(num_classes, dtype=np.int64)
+
+    def __len__(self):
+        return int(self.__count.sum())
+
+    def add(self, img_ind, bboxes):
+        """
+        :param img_ind: image name
+        :param bboxes: [n, 6] (xmin, ymin, xmax, ymax, score, class) predictions of the image
+        """
+        if img_ind not in self.__image_index:
+            self.__image_index[img_ind] = len(self.image_names)
+            self.image_names.append(img_ind)
+        i = self.__image_index[img_ind]
+        bboxes = np.asarray(bboxes).reshape(-1, 6)
+        classes = bboxes[:, 5].astype(np.int64)
+        for c in np.unique(classes):
+            rows = bboxes[classes == c]
+            start = self.__count[c]
+            end = start + len(rows)
+            self.__reserve(c, end)
+            self.__img[c][start:end] = i
+            self.__score[c][start:end] = rows[:, 4]
+            self.__box[c][start:end] = rows[:, :4].astype(np.int32)
+            self.__count[c] = end
+
+    def __reserve(self, c, size):
+        capacity = len(self.__img[c])
+        if size <= capacity:
+            return
+        while capacity < size:
+            capacity *= 2
+        n = self.__count[c]
+        for columns in (self.__img, self.__score, self.__box):
+            grown = np.zeros((capacity,) + columns[c].shape[1:], dtype=columns[c].dtype)
+            grown[:n] = columns[c][:n]
+            columns[c] = grown
+
+    def class_detections(self, classname):
+        """
+        The detections of voc_eval.eval_detections, read from memory instead of the text file.
+        :return: (image_ids, confidence, BB) [n] image names, [n] scores rounded like the text
+                 files, [n, 4] float64 boxes, in insertion order
+        """
+        c = self.classes.index(classname)
+        n = self.__count[c]
+        image_ids = np.asarray(self.image_names)[self.__img[c][:n]]
+        confidence = np.char.mod('%.4f', self.__score[c][:n]).astype(np.float64)
+        return image_ids, confidence, self.__box[c][:n].astype(np.float64)
+
+    def export(self, pred_result_path, per_image_path=None):
+        """
+        Write the text files of the former evaluator.
+        :param pred_result_path: directory of the comp4_det_test_<class>.txt files
+        :param per_image_path: directory of the <image>.txt files "class score xmin ymin xmax ymax",
+                               one per added image (empty when it has no detection), the lines of an
+                               image are grouped by class
+        """
+        lines = [[] for _ in self.image_names]
+        for c, class_name in enumerate(self.classes):
+            n = self.__count[c]
+            if n == 0:
+                continue
+            with open(os.path.join(pred_result_path, 'comp4_det_test_' + class_name + '.txt'), 'w') as f:
+                for i, score, box in zip(self.__img[c][:n], self.__score[c][:n], self.__box[c][:n]):
+                    score = '%.4f' % score
+                    xmin, ymin, xmax, ymax = map(str, box)
+                    f.write(' '.join([self.image_names[i], score, xmin, ymin, xmax, ymax]) + '\n')
+                    lines[i].append(' '.join([class_name, score, xmin, ymin, xmax, ymax]) + '\n')
+        if per_image_path is not None:
+            for img_ind, img_lines in zip(self.image_names, lines):
+                with open(os.path.join(per_image_path, img_ind + '.txt'), 'w') as f:
+                    f.writelines(img_lines)
@@ -1,15 +1,26 @@
 import shutil
 from eval import voc_eval
+from eval.gt_store import VOCGTStore, eval_class_arrays
+from eval.det_store import DetectionStore
+from eval.streaming_map import StreamingMAP
+from eval.pred_cache import top_candidates, replay
+from eval.sequential_val import stratified_subset, match_subset, bootstrap_map
+from eval.sharded_eval import ShardedPredictor
+from concurrent.futures import ProcessPoolExecutor
 from utils.data_augment import *
 from utils.tools import *
+from utils.nms import batched_multiclass_nms
+from utils.prefetch_loader import PrefetchLoader, read_image
+from utils.letterbox_cache import LetterboxCache
 from tqdm import tqdm
 from utils.visualize import *
 from utils.heatmap import imshowAtt
 import config.yolov4_config as cfg
 import time
+import functools
 current_milli_time = lambda: int(round(time.time() * 1000))
 class Evaluator(object):
-    def __init__(self, model, showatt, exp_name):
+    def __init__(self, model, showatt, exp_name=''):
         if cfg.TRAIN["DATA_TYPE"] == 'VOC':
             self.classes = cfg.VOC_DATA["CLASSES"]
         elif cfg.TRAIN["DATA_TYPE"] == 'COCO':
@@ -20,91 +31,258 @@ class Evaluator(object):
         self.val_data_path = os.path.join(cfg.DATA_PATH, 'VOCtest-2007', 'VOCdevkit', 'VOC2007')
         self.conf_thresh = cfg.VAL["CONF_THRESH"]
         self.nms_thresh = cfg.VAL["NMS_THRESH"]
+        self.nms_method = cfg.VAL["NMS_METHOD"]
         self.val_shape = cfg.VAL["TEST_IMG_SIZE"]
         self.model = model
-        self.device = 'cuda'#next(model.parameters()).device
+        self.device = next(model.parameters()).device
         self.__visual_imgs = 0
         self.showatt = showatt
         self.inference_time = 0.
+        self.prefetch_workers = cfg.VAL["NUMBER_WORKERS"]
+        self.prefetch_images = cfg.VAL["PREFETCH_IMAGES"]
+        self.export_detections = cfg.VAL["EXPORT_DETECTIONS"]
+        self.detections = DetectionStore(self.classes)
+        self.streaming = cfg.VAL["STREAMING_MAP"]
+        self.test_cache = cfg.VAL["TEST_CACHE"]
+        self.eval_workers = cfg.VAL["EVAL_WORKERS"]
+        self.eval_threads = cfg.VAL["EVAL_WORKER_THREADS"]
+        self.postprocess_topk = cfg.VAL["POSTPROCESS_TOPK"]
+        self.progress = True
+        self.__gt_store = None
+        self.__streaming_map = None
 
-    def APs_voc(self, multi_test=False, flip_test=False):
+    def APs_voc(self, multi_test=False, flip_test=False, batch_size=1):
+        """
+        :param batch_size: number of test images per forward pass. Batching is only used
+                           for single-scale, non-flipped evaluation without attention maps.
+        The test set is sharded across EVAL_WORKERS processes (eval/sharded_eval.py) when the
+        model is on the CPU.
+        """
+        img_inds = self.__test_image_inds()
+
+        self.clear_predict_file()
+        print('val img size is {}'.format(self.val_shape))
+        if self.eval_workers > 1 and self.device.type == 'cpu' and not self.showatt:
+            self.__predict_sharded(img_inds, np.arange(len(img_inds)), multi_test, flip_test, batch_size)
+        else:
+            self.__predict_positions(img_inds, np.arange(len(img_inds)), multi_test, flip_test, batch_size)
+        if self.export_detections:
+            self.write_detections()
+        self.inference_time = 1.0 * self.inference_time / len(img_inds)
+        return self.current_APs(), self.inference_time
+
+    def APs_voc_sequential(self, best_mAP, multi_test=False, flip_test=False, batch_size=1):
+        """
+        Sequential validation (eval/sequential_val.py): predict a stratified subset of
+        SEQUENTIAL_FRACTION of the test images, estimate the mAP with a bootstrap interval and
+        predict the other images only when the upper end of the interval reaches best_mAP.
+        The subset is drawn with a fixed seed, so every epoch is estimated on the same images.
+        :return: (APs, mAP, inference_time, info) APs is None when the evaluation stopped on the
+                 subset, mAP is the full test set mAP, else the subset estimate.
+                 info = {'full', 'subset_mAP', 'interval', 'subset_images'}
+        """
+        img_inds = self.__test_image_inds()
+        gt_store = self.get_gt_store()
+        subset = stratified_subset(gt_store, cfg.VAL["SEQUENTIAL_FRACTION"], np.random.RandomState(0))
+
+        self.clear_predict_file()
+        print('val img size is {}, subset of {} images'.format(self.val_shape, len(subset)))
+        self.__predict_positions(img_inds, subset, multi_test, flip_test, batch_size)
+        matches, npos = match_subset(gt_store, self.detections, subset)
+        subset_mAP, interval = bootstrap_map(matches, npos, cfg.VAL["SEQUENTIAL_RESAMPLES"],
+                                             cfg.VAL["SEQUENTIAL_CONFIDENCE"], rng=np.random.RandomState(1))
+        info = {'full': interval[1] >= best_mAP, 'subset_mAP': subset_mAP, 'interval': interval,
+                'subset_images': len(subset)}
+        if not info['full']:
+            self.inference_time = 1.0 * self.inference_time / len(subset)
+            return None, subset_mAP, self.inference_time, info
+
+        rest = np.setdiff1d(np.arange(len(img_inds)), subset)
+        self.__predict_positions(img_inds, rest, multi_test, flip_test, batch_size)
+        if self.export_detections:
+            self.write_detections()
+        self.inference_time = 1.0 * self.inference_time / len(img_inds)
+        APs = self.current_APs()
+        return APs, sum(APs.values()) / len(APs), self.inference_time, info
+
+    def __predict_positions(self, img_inds, positions, multi_test, flip_test, batch_size):
+        """
+        Predict and store the test images img_inds[positions].
+        """
+        for img_ind, bboxes_prd in self.__iter_predictions(img_inds, positions, multi_test, flip_test, batch_size):
+            self.store_bbox(img_ind, bboxes_prd)
+
+    def __predict_sharded(self, img_inds, positions, multi_test, flip_test, batch_size):
+        if self.test_cache and not multi_test:
+            # built once here, not by every worker
+            self.__letterbox_cache(img_inds)
+        with self.sharded_predictor() as predictor:
+            print('sharded over {} workers x {} threads'.format(predictor.workers, predictor.num_threads))
+            predictions, inference_time = predictor.predict(positions, multi_test, flip_test, batch_size)
+        for img_ind, bboxes_prd in predictions:
+            self.store_bbox(img_ind, bboxes_prd)
+        self.inference_time += inference_time
+
+    def sharded_predictor(self, workers=None, num_threads=None):
+        """
+        Worker processes predicting with the model and the settings of this evaluator.
+        :param workers, num_threads: EVAL_WORKERS and EVAL_WORKER_THREADS when None
+        """
+        settings = {'val_data_path': self.val_data_path, 'conf_thresh': self.conf_thresh,
+                    'nms_thresh': self.nms_thresh, 'nms_method': self.nms_method, 'val_shape': self.val_shape,
+                    'test_cache': self.test_cache, 'postprocess_topk': self.postprocess_topk, 'progress': False,
+                    'prefetch_workers': max(1, self.prefetch_workers // max(1, self.eval_workers))}
+        return ShardedPredictor(self.model, workers or self.eval_workers,
+                                self.eval_threads if num_threads is None else num_threads, settings)
+
+    def __iter_predictions(self, img_inds, positions, multi_test, flip_test, batch_size):
+        if self.test_cache and not multi_test and not self.showatt:
+            return self.__predict_cached(img_inds, positions, batch_size)
+        return self.__predict_images([img_inds[i] for i in positions], multi_test, flip_test, batch_size)
+
+    def predict_bboxes(self, positions, multi_test=False, flip_test=False, batch_size=1):
+        """
+        The predictions of the test images at positions of the test list, without storing them
+        (the task of a worker of eval.sharded_eval).
+        :return: list of (img_ind, bboxes_prd)
+        """
+        img_inds = self.__test_image_inds()
+        return list(self.__iter_predictions(img_inds, positions, multi_test, flip_test, batch_size))
+
+    def __predict_images(self, img_inds, multi_test, flip_test, batch_size):
+        img_paths = [os.path.join(self.val_data_path, 'JPEGImages', img_ind + '.jpg') for img_ind in img_inds]
+        # single-scale inputs are letterboxed by the prefetch workers as well
+        test_shape = None if multi_test else self.val_shape
+        loader = PrefetchLoader(img_paths, functools.partial(read_image, test_shape=test_shape),
+                                num_workers=self.prefetch_workers, max_prefetch=self.prefetch_images)
+        if batch_size > 1 and not multi_test and not self.showatt:
+            batch_inds = [img_inds[i:i + batch_size] for i in range(0, len(img_inds), batch_size)]
+            for inds, batch in tqdm(zip(batch_inds, loader.batches(batch_size)), total=len(batch_inds),
+                                    disable=not self.progress):
+                imgs, resized = zip(*batch)
+                for img_ind, bboxes_prd in zip(inds, self.get_bbox_batch(imgs, resized=resized)):
+                    yield img_ind, bboxes_prd
+        else:
+            for img_ind, (img, resized) in tqdm(zip(img_inds, loader), total=len(img_inds), disable=not self.progress):
+                yield img_ind, self.get_bbox(img, multi_test, flip_test, resized=resized)
+        if self.progress:
+            print(loader.stats_str())
+
+    def __predict_cached(self, img_inds, positions, batch_size):
+        """
+        Single-scale prediction of the letterboxed test set memory-mapped by utils.letterbox_cache,
+        built by the first evaluation, no image is decoded afterwards.
+        """
+        cache = self.__letterbox_cache(img_inds)
+        for start in tqdm(range(0, len(positions), batch_size), disable=not self.progress):
+            batch_positions = positions[start:start + batch_size]
+            resized, org_shapes = cache.get_batch(batch_positions)
+            bboxes_list = self.get_bbox_batch(None, resized=resized, org_shapes=org_shapes)
+            for i, bboxes_prd in zip(batch_positions, bboxes_list):
+                yield img_inds[i], bboxes_prd
+
+    def __letterbox_cache(self, img_inds):
+        img_paths = [os.path.join(self.val_data_path, 'JPEGImages', img_ind + '.jpg') for img_ind in img_inds]
+        return LetterboxCache(img_paths, self.val_shape, os.path.join(cfg.PROJECT_PATH, 'cache', 'test'),
+                              num_workers=self.prefetch_workers, max_prefetch=self.prefetch_images)
+
+    def __test_image_inds(self):
         img_inds_file = os.path.join(self.val_data_path,  'ImageSets', 'Main', 'test.txt')
         with open(img_inds_file, 'r') as f:
             lines = f.readlines()
             img_inds = [line.strip() for line in lines]
+        return img_inds
 
-        if os.path.exists(self.pred_result_path):
-            shutil.rmtree(self.pred_result_path)
+    def predict_candidates(self, multi_test=False, flip_test=False, score_floor=0.001, topk=1000):
+        """
+        The pre-NMS candidates of every test image, for eval.pred_cache.PredictionCache.
+        :param score_floor: lowest score kept, below the confidence thresholds to sweep
+        :param topk: max candidates per image
+        :return: (img_inds, candidates) candidates[i] is [n, 6] (xmin, ymin, xmax, ymax, score, class)
+        """
+        img_inds = self.__test_image_inds()
+        img_paths = [os.path.join(self.val_data_path, 'JPEGImages', img_ind + '.jpg') for img_ind in img_inds]
+        test_shape = None if multi_test else self.val_shape
+        loader = PrefetchLoader(img_paths, functools.partial(read_image, test_shape=test_shape),
+                                num_workers=self.prefetch_workers, max_prefetch=self.prefetch_images)
+        candidates = []
+        for img_ind, (img, resized) in tqdm(zip(img_inds, loader), total=len(img_inds)):
+            bboxes = self.get_candidates(img, multi_test, flip_test, resized=resized, score_threshold=score_floor)
+            candidates.append(top_candidates(bboxes, score_floor, topk))
+        print(loader.stats_str())
+        return img_inds, candidates
 
-        txtpath = "./output/detection-results/"
-        if not os.path.exists(txtpath):
-            os.mkdir(txtpath)
-        os.mkdir(self.pred_result_path)
-        print('val img size is {}'.format(self.val_shape))
-        for img_ind in tqdm(img_inds):
-            img_path = os.path.join(self.val_data_path, 'JPEGImages', img_ind+'.jpg')
-            img = cv2.imread(img_path)
-            bboxes_prd = self.get_bbox(img, multi_test, flip_test)
-
-            f = open("./output/detection-results/" + img_ind + ".txt", "w")
-            for bbox in bboxes_prd:
-                coor = np.array(bbox[:4], dtype=np.int32)
-                score = bbox[4]
-                class_ind = int(bbox[5])
-
-                class_name = self.classes[class_ind]
-                score = '%.4f' % score
-                xmin, ymin, xmax, ymax = map(str, coor)
-                s = ' '.join([img_ind, score, xmin, ymin, xmax, ymax]) + '\n'
-
-                with open(os.path.join(self.pred_result_path, 'comp4_det_test_' + class_name + '.txt'), 'a') as r:
-                    r.write(s)
-                f.write("%s %s %s %s %s %s\n" % (class_name, score, str(xmin), str(ymin), str(xmax), str(ymax)))
-            f.close()
-        self.inference_time = 1.0 * self.inference_time / len(img_inds)
-        return self.calc_APs(), self.inference_time
+    def APs_replay(self, img_inds, candidates, conf_thresh=None, nms_thresh=None, nms_method=None):
+        """
+        APs of one confidence/NMS setting applied to cached candidates, without running the model.
+        :param conf_thresh, nms_thresh, nms_method: cfg.VAL values when None
+        :return:dict{cls:ap}
+        """
+        conf_thresh = self.conf_thresh if conf_thresh is None else conf_thresh
+        nms_thresh = self.nms_thresh if nms_thresh is None else nms_thresh
+        nms_method = nms_method or self.nms_method
+        self.clear_predict_file()
+        for img_ind, bboxes_prd in zip(img_inds, replay(candidates, conf_thresh, nms_thresh, nms_method)):
+            self.store_bbox(img_ind, bboxes_prd)
+        return self.current_APs()
 
     def store_bbox(self, img_ind, bboxes_prd):
-        f = open("./output/detection-results/" + img_ind + ".txt", "w")
-        for bbox in bboxes_prd:
-            coor = np.array(bbox[:4], dtype=np.int32)
-            score = bbox[4]
-            class_ind = int(bbox[5])
-
-            class_name = self.classes[class_ind]
-            score = '%.4f' % score
-            xmin, ymin, xmax, ymax = map(str, coor)
-            s = ' '.join([img_ind, score, xmin, ymin, xmax, ymax]) + '\n'
-
-            with open(os.path.join(self.pred_result_path, 'comp4_det_test_' + class_name + '.txt'), 'a') as r:
-                r.write(s)
-            f.write("%s %s %s %s %s %s\n" % (class_name, score, str(xmin), str(ymin), str(xmax), str(ymax)))
-        f.close()
-
-    def get_bbox(self, img, multi_test=False, flip_test=False):
+        self.detections.add(img_ind, bboxes_prd)
+        if self.streaming:
+            self.get_streaming_map().update([img_ind], [bboxes_prd])
+
+    def write_detections(self, txtpath="./output/detection-results/"):
+        """
+        Write the detections as the comp4_det_test_<class>.txt files of pred_result_path and one
+        <image>.txt file per image in txtpath.
+        """
+        if not os.path.exists(self.pred_result_path):
+            os.makedirs(self.pred_result_path)
+        if not os.path.exists(txtpath):
+            os.makedirs(txtpath)
+        self.detections.export(self.pred_result_path, txtpath)
+
+    def get_bbox(self, img, multi_test=False, flip_test=False, resized=None):
+        """
+        :param resized: optional letterboxed [C,H,W] image of size val_shape (see
+                        utils.prefetch_loader.read_image), only used by single-scale prediction
+        """
+        bboxes = self.get_candidates(img, multi_test, flip_test, resized)
+        bboxes = nms(bboxes, self.conf_thresh, self.nms_thresh, method=self.nms_method)
+
+        return bboxes
+
+    def get_candidates(self, img, multi_test=False, flip_test=False, resized=None, score_threshold=None):
+        """
+        The predictions of get_bbox before NMS.
+        :param score_threshold: candidates with a score <= score_threshold are dropped, conf_thresh when None
+        :return: [N, 6] (xmin, ymin, xmax, ymax, score, class) in the coordinates of img
+        """
+        score_threshold = self.conf_thresh if score_threshold is None else score_threshold
         if multi_test:
             test_input_sizes = range(320, 640, 96)
             bboxes_list = []
             for test_input_size in test_input_sizes:
                 valid_scale =(0, np.inf)
-                bboxes_list.append(self.__predict(img, test_input_size, valid_scale))
+                bboxes_list.append(self.__predict(img, test_input_size, valid_scale, score_threshold=score_threshold))
                 if flip_test:
-                    bboxes_flip = self.__predict(img[:, ::-1], test_input_size, valid_scale)
+                    bboxes_flip = self.__predict(img[:, ::-1], test_input_size, valid_scale,
+                                                 score_threshold=score_threshold)
                     bboxes_flip[:, [0, 2]] = img.shape[1] - bboxes_flip[:, [2, 0]]
                     bboxes_list.append(bboxes_flip)
             bboxes = np.row_stack(bboxes_list)
         else:
-            bboxes = self.__predict(img, self.val_shape, (0, np.inf))
-
-        bboxes = nms(bboxes, self.conf_thresh, self.nms_thresh)
+            bboxes = self.__predict(img, self.val_shape, (0, np.inf), resized, score_threshold)
 
         return bboxes
 
-    def __predict(self, img, test_shape, valid_scale):
+    def __predict(self, img, test_shape, valid_scale, resized=None, score_threshold=None):
         org_img = np.copy(img)
         org_h, org_w, _ = org_img.shape
 
-        if 1:
+        if resized is not None:
+            img = torch.from_numpy(resized[np.newaxis, ...]).float().to(self.device)
+        elif 1:
             img = self.__get_img_tensor(img, test_shape).to(self.device)
         else:#should use interpolate
             img = F.interpolate(img.unsqueeze(0), size=test_shape, mode='bilinear')
@@ -116,12 +294,49 @@ class Evaluator(object):
             if self.showatt: _, p_d, beta = self.model(img)
             else: _, p_d = self.model(img)
             self.inference_time += (current_milli_time() - start_time)
-        pred_bbox = p_d.squeeze().cpu().numpy()
-        bboxes = self.__convert_pred(pred_bbox, test_shape, (org_h, org_w), valid_scale)
+        pred_bbox = p_d.view(1, -1, p_d.shape[-1])
+        bboxes = self.__convert_pred(pred_bbox, test_shape, [(org_h, org_w)], valid_scale, score_threshold)[0]
         if self.showatt and len(img):
             self.__show_heatmap(beta[2], org_img)
         return bboxes
 
+    def get_bbox_batch(self, imgs, test_shape=None, resized=None, org_shapes=None):
+        """
+        Single-scale prediction of several images with one forward pass.
+        :param imgs: list of BGR images, they may have different sizes
+        :param resized: optional list of the letterboxed [C,H,W] images, float in [0, 1] or uint8
+        :param org_shapes: optional (h, w) of the images, imgs may be None when both resized and
+                           org_shapes are given (see utils.letterbox_cache)
+        :return: list of bboxes, the same as get_bbox(img) for every image
+        """
+        test_shape = test_shape or self.val_shape
+        if org_shapes is None:
+            org_shapes = [img.shape[:2] for img in imgs]
+        if resized is None:
+            resized = [Resize((test_shape, test_shape), correct_box=False)(img, None).transpose(2, 0, 1)
+                       for img in imgs]
+        batch = torch.from_numpy(np.stack(resized)).to(self.device)
+        batch = batch.float().div_(255.) if batch.dtype == torch.uint8 else batch.float()
+
+        self.model.eval()
+        with torch.no_grad():
+            start_time = current_milli_time()
+            _, p_d = self.model(batch)
+            self.inference_time += (current_milli_time() - start_time)
+        pred_bbox = self.__split_batch(p_d, len(org_shapes), test_shape)
+        bboxes_list = self.__convert_pred(pred_bbox, test_shape, org_shapes, (0, np.inf))
+        return batched_multiclass_nms(bboxes_list, self.conf_thresh, self.nms_thresh, method=self.nms_method)
+
+    def __split_batch(self, p_d, batch_size, test_shape):
+        """
+        In eval mode every head returns its predictions flattened over the batch and the heads
+        are concatenated, [bs*G_s*G_s*3 | bs*G_m*G_m*3 | bs*G_l*G_l*3, 5+nC].
+        Regroup them per image as [bs, N, 5+nC] in the same row order as batch size 1.
+        """
+        sizes = [batch_size * (test_shape // stride) ** 2 * cfg.MODEL["ANCHORS_PER_SCLAE"]
+                 for stride in cfg.MODEL["STRIDES"]]
+        return torch.cat([p.view(batch_size, -1, p.shape[-1]) for p in torch.split(p_d, sizes, 0)], 1)
+
     def __show_heatmap(self, beta, img):
         imshowAtt(beta, img)
 
@@ -130,73 +345,139 @@ class Evaluator(object):
         return torch.from_numpy(img[np.newaxis, ...]).float()
 
 
-    def __convert_pred(self, pred_bbox, test_input_size, org_img_shape, valid_scale):
+    def __convert_pred(self, pred_bbox, test_input_size, org_img_shapes, valid_scale, score_threshold=None):
         """
-        Filter out the prediction box to remove the unreasonable scale of the box
+        Filter out the prediction box to remove the unreasonable scale of the box. Runs on the
+        device of the model: the scores are thresholded first, the boxes of the rows above the
+        threshold are rescaled and only the kept rows are copied to the host.
+        :param pred_bbox: [bs, N, 5+nC] tensor
+        :param org_img_shapes: list of (org_h, org_w)
+        :param score_threshold: conf_thresh when None
+        :return: list of [k, 6] (xmin, ymin, xmax, ymax, score, class) float64 arrays, at most
+                 postprocess_topk rows per image (the highest scores, in their original order)
+                 when postprocess_topk > 0
         """
-        pred_coor = xywh2xyxy(pred_bbox[:, :4])
-        pred_conf = pred_bbox[:, 4]
-        pred_prob = pred_bbox[:, 5:]
+        score_threshold = self.conf_thresh if score_threshold is None else score_threshold
+        batch_size = len(org_img_shapes)
 
-        # (1)
+        # (1)Remove bboxes whose score is below the score_threshold
+        pred_prob, classes = pred_bbox[..., 5:].max(dim=-1)
+        scores = pred_bbox[..., 4] * pred_prob
+        img_ind, row = (scores > score_threshold).nonzero(as_tuple=True)
+        pred_xywh = pred_bbox[img_ind, row, :4]
+        scores = scores[img_ind, row]
+        classes = classes[img_ind, row]
+        pred_coor = torch.cat([pred_xywh[:, :2] - pred_xywh[:, 2:4] / 2,
+                               pred_xywh[:, :2] + pred_xywh[:, 2:4] / 2], dim=-1)
+
+        # (2)
         # (xmin_org, xmax_org) = ((xmin, xmax) - dw) / resize_ratio
         # (ymin_org, ymax_org) = ((ymin, ymax) - dh) / resize_ratio
-        org_h, org_w = org_img_shape
-        resize_ratio = min(1.0 * test_input_size / org_w, 1.0 * test_input_size / org_h)
+        # per image letterbox parameters, computed in float64 and rounded to the dtype of the predictions
+        org_h = np.array([shape[0] for shape in org_img_shapes])
+        org_w = np.array([shape[1] for shape in org_img_shapes])
+        resize_ratio = np.minimum(1.0 * test_input_size / org_w, 1.0 * test_input_size / org_h)
         dw = (test_input_size - resize_ratio * org_w) / 2
         dh = (test_input_size - resize_ratio * org_h) / 2
+        per_row = lambda v: torch.as_tensor(v, dtype=pred_bbox.dtype, device=pred_bbox.device)[img_ind]
+        resize_ratio, dw, dh = per_row(resize_ratio)[:, None], per_row(dw)[:, None], per_row(dh)[:, None]
         pred_coor[:, 0::2] = 1.0 * (pred_coor[:, 0::2] - dw) / resize_ratio
         pred_coor[:, 1::2] = 1.0 * (pred_coor[:, 1::2] - dh) / resize_ratio
 
-        # (2)Crop off the portion of the predicted Bbox that is beyond the original image
-        pred_coor = np.concatenate([np.maximum(pred_coor[:, :2], [0, 0]),
-                                    np.minimum(pred_coor[:, 2:], [org_w - 1, org_h - 1])], axis=-1)
-        # (3)Sets the coor of an invalid bbox to 0
-        invalid_mask = np.logical_or((pred_coor[:, 0] > pred_coor[:, 2]), (pred_coor[:, 1] > pred_coor[:, 3]))
+        # (3)Crop off the portion of the predicted Bbox that is beyond the original image
+        max_coor = per_row(np.stack([org_w - 1, org_h - 1], axis=-1))
+        pred_coor = torch.cat([pred_coor[:, :2].clamp(min=0), torch.min(pred_coor[:, 2:], max_coor)], dim=-1)
+        # (4)Sets the coor of an invalid bbox to 0
+        invalid_mask = (pred_coor[:, 0] > pred_coor[:, 2]) | (pred_coor[:, 1] > pred_coor[:, 3])
         pred_coor[invalid_mask] = 0
 
-        # (4)Remove bboxes that are not in the valid range
-        bboxes_scale = np.sqrt(np.multiply.reduce(pred_coor[:, 2:4] - pred_coor[:, 0:2], axis=-1))
-        scale_mask = np.logical_and((valid_scale[0] < bboxes_scale), (bboxes_scale < valid_scale[1]))
-
-        # (5)Remove bboxes whose score is below the score_threshold
-        classes = np.argmax(pred_prob, axis=-1)
-        scores = pred_conf * pred_prob[np.arange(len(pred_coor)), classes]
-        score_mask = scores > self.conf_thresh
+        # (5)Remove bboxes that are not in the valid range
+        bboxes_scale = torch.sqrt(torch.prod(pred_coor[:, 2:4] - pred_coor[:, 0:2], dim=-1))
+        mask = (valid_scale[0] < bboxes_scale) & (bboxes_scale < valid_scale[1])
 
-        mask = np.logical_and(scale_mask, score_mask)
+        # (6)Keep the postprocess_topk highest scores of every image
+        if self.postprocess_topk > 0:
+            mask &= self.__top_rows(img_ind, scores.masked_fill(~mask, -1.), batch_size)
 
-        coors = pred_coor[mask]
-        scores = scores[mask]
-        classes = classes[mask]
+        bboxes = torch.cat([pred_coor[mask], scores[mask, None], classes[mask, None].to(pred_coor.dtype)], dim=-1)
+        counts = torch.bincount(img_ind[mask], minlength=batch_size).cpu().numpy()
+        return np.split(bboxes.cpu().numpy().astype(np.float64), np.cumsum(counts)[:-1])
 
-        bboxes = np.concatenate([coors, scores[:, np.newaxis], classes[:, np.newaxis]], axis=-1)
+    def __top_rows(self, img_ind, scores, batch_size):
+        """
+        :param img_ind: image of every row, sorted
+        :return: mask of the postprocess_topk highest scores of every image
+        """
+        order = torch.argsort(scores, descending=True, stable=True)
+        order = order[torch.argsort(img_ind[order], stable=True)]
+        counts = torch.bincount(img_ind, minlength=batch_size)
+        rank = torch.empty_like(order)
+        rank[order] = torch.arange(len(order), device=order.device) - (torch.cumsum(counts, 0) - counts)[img_ind[order]]
+        return rank < self.postprocess_topk
 
-        return bboxes
     def clear_predict_file(self):
+        self.detections.clear()
+        if self.__streaming_map is not None:
+            self.__streaming_map.reset()
         if os.path.exists(self.pred_result_path):
             shutil.rmtree(self.pred_result_path)
-        os.mkdir(self.pred_result_path)
-    def calc_APs(self, iou_thresh=0.5, use_07_metric=False):
+        os.makedirs(self.pred_result_path)
+
+    def get_gt_store(self):
+        """
+        Ground truth of the test set, parsed from the XML files on the first call of any run and
+        memory-mapped from PROJECT_PATH/cache/gt afterwards.
+        """
+        if self.__gt_store is None:
+            annopath = os.path.join(self.val_data_path, 'Annotations', '{:s}.xml')
+            imagesetfile = os.path.join(self.val_data_path, 'ImageSets', 'Main', 'test.txt')
+            self.__gt_store = VOCGTStore(annopath, imagesetfile, self.classes,
+                                         os.path.join(cfg.PROJECT_PATH, 'cache', 'gt'))
+        return self.__gt_store
+
+    def get_streaming_map(self, iou_thresh=0.5, use_07_metric=False):
+        """
+        The incremental mAP of the stored detections, see eval.streaming_map.
+        """
+        if self.__streaming_map is None:
+            self.__streaming_map = StreamingMAP(self.get_gt_store(), ovthresh=iou_thresh, use_07_metric=use_07_metric)
+        return self.__streaming_map
+
+    def current_APs(self):
+        """
+        APs of the detections stored since clear_predict_file: read from the streaming mAP when
+        cfg.VAL["STREAMING_MAP"], without evaluating the detections again, else calc_APs.
+        :return:dict{cls:ap}
+        """
+        if self.streaming:
+            return self.get_streaming_map().APs()
+        return self.calc_APs()
+
+    def calc_APs(self, iou_thresh=0.5, use_07_metric=False, workers=None):
         """
         Calculate ap values for each category
         :param iou_thresh:
         :param use_07_metric:
+        :param workers: processes evaluating the classes in parallel, cfg.VAL["AP_WORKERS"] when None,
+                        0 or 1 for the serial loop. The workers map the GT store and receive the
+                        detections of their class, the results are the same as the serial loop.
         :return:dict{cls:ap}
         """
-        filename = os.path.join(self.pred_result_path, 'comp4_det_test_{:s}.txt')
-        cachedir = os.path.join(self.pred_result_path, 'cache')
-        annopath = os.path.join(self.val_data_path, 'Annotations', '{:s}.xml')
-        imagesetfile = os.path.join(self.val_data_path,  'ImageSets', 'Main', 'test.txt')
+        gt_store = self.get_gt_store()
+        workers = cfg.VAL["AP_WORKERS"] if workers is None else workers
+        task = functools.partial(eval_class_arrays, gt_store, ovthresh=iou_thresh, use_07_metric=use_07_metric)
+        args = zip(*[(cls,) + self.detections.class_detections(cls) for cls in self.classes])
+        if workers > 1:
+            with ProcessPoolExecutor(max_workers=min(workers, len(self.classes))) as executor:
+                results = list(executor.map(task, *args))
+        else:
+            results = list(map(task, *args))
         APs = {}
         Recalls = {}
         Precisions = {}
-        for i, cls in enumerate(self.classes):
-            R, P, AP = voc_eval.voc_eval(filename, annopath, imagesetfile, cls, cachedir, iou_thresh, use_07_metric)
+        for cls, (R, P, AP) in zip(self.classes, results):
             Recalls[cls] = R
             Precisions[cls] = P
             APs[cls] = AP
-        if os.path.exists(cachedir):
-            shutil.rmtree(cachedir)
 
         return APs
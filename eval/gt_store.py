@@ -0,0 +1,151 @@
+# coding=utf-8
+"""
+Persistent, indexed ground truth of a VOC image set.
+
+The XML annotations are parsed once into columnar arrays sorted by (class, image):
+
+Layout of <cache_root>/<set>_<key>/:
+    image_names.npy       [N] image names of the image set file, in order
+    gt_img.npy            [M] int32 index into image_names
+    gt_cls.npy            [M] int32 index into classes
+    gt_box.npy            [M, 4] float64 (xmin, ymin, xmax, ymax)
+    gt_difficult.npy      [M] bool
+    cls_offsets.npy       [C+1] int64, objects of class c are [cls_offsets[c]:cls_offsets[c+1]]
+    meta.json             classes and counts
+
+<set> hashes the path of the image set file. The key hashes the image set file, the size and mtime
+of every annotation file and the class list, so an edited annotation builds a new store and
+removes the stale stores of the same image set file. Later runs memory-map the arrays,
+evaluating all classes reads no XML.
+"""
+import os
+import json
+import glob
+import shutil
+import hashlib
+import collections
+import numpy as np
+from eval.voc_eval import parse_rec, eval_detection_arrays
+
+
+class VOCGTStore(object):
+    def __init__(self, annopath, imagesetfile, classes, cache_root):
+        """
+        :param annopath: annopath.format(imagename) is the xml annotation file
+        :param imagesetfile: text file with one image name per line
+        :param classes: class names, the class index of the arrays
+        """
+        self.classes = list(classes)
+        with open(imagesetfile, 'r') as f:
+            imagenames = [x.strip() for x in f.readlines()]
+        self.key = self.__cache_key(annopath, imagenames)
+        self.prefix = hashlib.sha1(os.path.abspath(imagesetfile).encode()).hexdigest()[:8]
+        self.cache_dir = os.path.join(cache_root, '{}_{}'.format(self.prefix, self.key))
+        if not os.path.isfile(os.path.join(self.cache_dir, 'meta.json')):
+            self.__remove_stale(cache_root)
+            self.__build(annopath, imagenames)
+
+        self.__open()
+
+    def __open(self):
+        load = lambda name: np.load(os.path.join(self.cache_dir, name + '.npy'), mmap_mode='r')
+        self.image_names = np.load(os.path.join(self.cache_dir, 'image_names.npy'))
+        self.gt_img = load('gt_img')
+        self.gt_cls = load('gt_cls')
+        self.gt_box = load('gt_box')
+        self.gt_difficult = load('gt_difficult')
+        self.cls_offsets = np.load(os.path.join(self.cache_dir, 'cls_offsets.npy'))
+        self.image_index = {str(name): i for i, name in enumerate(self.image_names)}
+
+    def __getstate__(self):
+        # worker processes map the same files instead of receiving pickled arrays
+        return {'classes': self.classes, 'key': self.key, 'cache_dir': self.cache_dir}
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.__open()
+
+    def __cache_key(self, annopath, imagenames):
+        sha1 = hashlib.sha1()
+        sha1.update(json.dumps(self.classes).encode())
+        for imagename in imagenames:
+            stat = os.stat(annopath.format(imagename))
+            sha1.update('{} {} {}\n'.format(imagename, stat.st_size, int(stat.st_mtime)).encode())
+        return sha1.hexdigest()[:16]
+
+    def __remove_stale(self, cache_root):
+        # only the older stores of this image set file, not the ones being built (.tmp<pid>)
+        for path in glob.glob(os.path.join(cache_root, '{}_*'.format(self.prefix))):
+            if os.path.isdir(path) and path != self.cache_dir and '.tmp' not in os.path.basename(path):
+                shutil.rmtree(path, ignore_errors=True)
+
+    def __build(self, annopath, imagenames):
+        class_to_id = {name: i for i, name in enumerate(self.classes)}
+        gt_img, gt_cls, gt_box, gt_difficult = [], [], [], []
+        for i, imagename in enumerate(imagenames):
+            for obj in parse_rec(annopath.format(imagename)):
+                if obj['name'] not in class_to_id:
+                    continue
+                gt_img.append(i)
+                gt_cls.append(class_to_id[obj['name']])
+                gt_box.append(obj['bbox'])
+                gt_difficult.append(obj['difficult'])
+            if i % 1000 == 0:
+                print('Reading annotation for {:d}/{:d}'.format(i + 1, len(imagenames)))
+
+        gt_img = np.array(gt_img, dtype=np.int32)
+        gt_cls = np.array(gt_cls, dtype=np.int32)
+        order = np.lexsort((gt_img, gt_cls))
+        arrays = {'image_names': np.array(imagenames),
+                  'gt_img': gt_img[order],
+                  'gt_cls': gt_cls[order],
+                  'gt_box': np.array(gt_box, dtype=np.float64).reshape(-1, 4)[order],
+                  'gt_difficult': np.array(gt_difficult, dtype=bool)[order],
+                  'cls_offsets': np.searchsorted(gt_cls[order], np.arange(len(self.classes) + 1)).astype(np.int64)}
+
+        tmp_dir = self.cache_dir + '.tmp{}'.format(os.getpid())
+        os.makedirs(tmp_dir)
+        for name, array in arrays.items():
+            np.save(os.path.join(tmp_dir, name + '.npy'), array)
+        with open(os.path.join(tmp_dir, 'meta.json'), 'w') as f:
+            json.dump({'classes': self.classes, 'images': len(imagenames), 'objects': len(gt_img)}, f)
+        print('Saving ground truth store to {:s}'.format(self.cache_dir))
+        try:
+            os.rename(tmp_dir, self.cache_dir)
+        except OSError:
+            shutil.rmtree(tmp_dir)
+
+    def class_slice(self, classname):
+        """
+        :return: (img, box, difficult) of the objects of classname, sorted by image
+        """
+        c = self.classes.index(classname)
+        start, end = self.cls_offsets[c], self.cls_offsets[c + 1]
+        return self.gt_img[start:end], self.gt_box[start:end], self.gt_difficult[start:end]
+
+    def class_recs(self, classname):
+        """
+        The class_recs and npos of voc_eval.voc_eval without reading any annotation.
+        :return: class_recs {imagename: {'bbox', 'difficult', 'det'}}, npos
+        """
+        img, box, difficult = self.class_slice(classname)
+        bounds = np.flatnonzero(np.diff(img)) + 1
+        class_recs = collections.defaultdict(lambda: {'bbox': np.zeros((0, 4)),
+                                                      'difficult': np.zeros(0, dtype=bool),
+                                                      'det': []})
+        for start, end in zip(np.concatenate([[0], bounds]), np.concatenate([bounds, [len(img)]])):
+            if end > start:
+                class_recs[str(self.image_names[img[start]])] = {'bbox': np.array(box[start:end]),
+                                                                 'difficult': np.array(difficult[start:end]),
+                                                                 'det': [False] * int(end - start)}
+        npos = int(np.sum(~np.asarray(difficult)))
+        return class_recs, npos
+
+
+def eval_class_arrays(gt_store, classname, image_ids, confidence, BB, ovthresh=0.5, use_07_metric=False):
+    """
+    rec, prec, ap of classname, the task of Evaluator.calc_APs for one class, on the detections of
+    eval.det_store.DetectionStore.class_detections.
+    """
+    class_recs, npos = gt_store.class_recs(classname)
+    return eval_detection_arrays(image_ids, confidence, BB, class_recs, npos, ovthresh, use_07_metric)
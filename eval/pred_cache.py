@@ -0,0 +1,121 @@
+# coding=utf-8
+"""
+Cache of the decoded pre-NMS candidates of a test set, to sweep the confidence threshold and the
+NMS settings without running the model again.
+
+The candidates of an image are (xmin, ymin, xmax, ymax, score, class) rows in the coordinates of
+the original image, i.e. the input of utils.tools.nms, down to a low score floor and limited to
+the top-k scores. They are stored in their original order (NMS breaks score ties by the input
+order) in one compressed file, <cache_root>/<tag>_<key>.npz:
+    image_ids       [N] image ids
+    offsets         [N+1] int64, candidates of image i are [offsets[i]:offsets[i+1]]
+    boxes           [M, 4] float32
+    scores          [M] float32
+    classes         [M] int16
+
+The key hashes the model weights, the input size, the tag (dataset and test-time augmentation),
+the floor and top-k, so another checkpoint builds another file and removes the stale one.
+Replaying a confidence threshold above the floor with hard NMS gives the detections of a full
+evaluation, as long as no image has more than top-k candidates above that threshold.
+"""
+import os
+import glob
+import json
+import hashlib
+import numpy as np
+from utils.nms import batched_multiclass_nms
+
+
+def model_hash(model):
+    """
+    sha1 of the parameters and buffers of the model.
+    """
+    sha1 = hashlib.sha1()
+    for name, tensor in sorted(model.state_dict().items()):
+        sha1.update(name.encode())
+        sha1.update(tensor.detach().cpu().contiguous().numpy().tobytes())
+    return sha1.hexdigest()
+
+
+def top_candidates(bboxes, score_floor, topk):
+    """
+    :param bboxes: [n, 6] candidates of an image
+    :return: the rows with score > score_floor, the topk highest if there are more, in their
+             original order
+    """
+    bboxes = bboxes[bboxes[:, 4] > score_floor]
+    if len(bboxes) > topk:
+        keep = np.argpartition(-bboxes[:, 4], topk - 1)[:topk]
+        bboxes = bboxes[np.sort(keep)]
+    return bboxes
+
+
+class PredictionCache(object):
+    def __init__(self, cache_root, model, img_size, tag, score_floor=0.001, topk=1000):
+        """
+        :param model: the model whose predictions are cached, its weights are part of the key
+        :param img_size: network input size of the predictions
+        :param tag: name of the dataset and prediction settings, e.g. 'voc_multi_flip'
+        :param score_floor: candidates with a score <= score_floor are dropped
+        :param topk: max candidates per image
+        """
+        self.score_floor = score_floor
+        self.topk = topk
+        sha1 = hashlib.sha1()
+        sha1.update(model_hash(model).encode())
+        sha1.update(json.dumps({'img_size': img_size, 'tag': tag, 'score_floor': score_floor,
+                                'topk': topk}).encode())
+        self.path = os.path.join(cache_root, '{}_{}.npz'.format(tag, sha1.hexdigest()[:16]))
+        self.__cache_root = cache_root
+        self.__tag = tag
+
+    def exists(self):
+        return os.path.isfile(self.path)
+
+    def save(self, image_ids, candidates):
+        """
+        :param image_ids: [N] image ids
+        :param candidates: N arrays [n_i, 6] of candidates, score floor and top-k are applied here
+        """
+        for path in glob.glob(os.path.join(self.__cache_root, '{}_*.npz'.format(self.__tag))):
+            os.remove(path)
+        if not os.path.exists(self.__cache_root):
+            os.makedirs(self.__cache_root)
+        candidates = [top_candidates(np.asarray(c, dtype=np.float64).reshape(-1, 6), self.score_floor, self.topk)
+                      for c in candidates]
+        bboxes = np.concatenate(candidates + [np.zeros((0, 6))], 0)
+        tmp_path = self.path + '.tmp{}.npz'.format(os.getpid())
+        np.savez_compressed(tmp_path,
+                            image_ids=np.asarray(image_ids),
+                            offsets=np.concatenate([[0], np.cumsum([len(c) for c in candidates])]).astype(np.int64),
+                            boxes=bboxes[:, :4].astype(np.float32),
+                            scores=bboxes[:, 4].astype(np.float32),
+                            classes=bboxes[:, 5].astype(np.int16))
+        os.rename(tmp_path, self.path)
+        print('Saving {} candidates of {} images to {:s} ({:.1f} MB)'.format(
+            len(bboxes), len(candidates), self.path, os.path.getsize(self.path) / 2 ** 20))
+
+    def load(self):
+        """
+        :return: (image_ids, candidates) as given to save, after the floor and top-k
+        """
+        with np.load(self.path) as data:
+            bboxes = np.concatenate([data['boxes'], data['scores'][:, np.newaxis],
+                                     data['classes'][:, np.newaxis]], axis=-1).astype(np.float64)
+            offsets = data['offsets']
+            image_ids = data['image_ids']
+        return image_ids.tolist(), np.split(bboxes, offsets[1:-1])
+
+
+def replay(candidates, conf_thresh, nms_thresh, nms_method='nms', sigma=0.3, batch_size=64):
+    """
+    The detections of every image for one setting, the candidates of batch_size images share one
+    NMS call.
+    :param candidates: list of [n_i, 6] candidates, see PredictionCache.load
+    :return: list of [k_i, 6] detections, the same as utils.tools.nms on each image
+    """
+    detections = []
+    for i in range(0, len(candidates), batch_size):
+        batch = [c[c[:, 4] > conf_thresh] for c in candidates[i:i + batch_size]]
+        detections.extend(batched_multiclass_nms(batch, conf_thresh, nms_thresh, sigma=sigma, method=nms_method))
+    return detections
@@ -0,0 +1,109 @@
+# coding=utf-8
+"""
+Sequential validation: estimate the mAP on a stratified subset of the test set with a bootstrap
+confidence interval, and only evaluate the rest of the test set when the interval does not rule
+out a new best mAP.
+
+The bootstrap resamples the subset images with replacement. The TP/FP of a detection only
+depends on its image (see eval.streaming_map), so the detections are matched once; a resample
+weights every detection and every GT object by the multiplicity of its image. The resamples of
+a class share one sort by confidence and are evaluated together as a [B, nd] matrix.
+"""
+import numpy as np
+from eval.voc_eval import match_detections
+
+
+def stratified_subset(gt_store, fraction, rng=np.random):
+    """
+    Every image is put in the stratum of its rarest class (the class with the fewest images in
+    the test set, images without objects form their own stratum) and fraction of every stratum
+    is drawn, at least one image, so that the rare classes are represented.
+    :return: sorted positions of the subset in gt_store.image_names
+    """
+    num_images = len(gt_store.image_names)
+    num_classes = len(gt_store.classes)
+    has_class = np.zeros((num_images, num_classes), dtype=bool)
+    has_class[gt_store.gt_img, gt_store.gt_cls] = True
+    class_images = has_class.sum(0)
+    rarity = np.where(has_class, class_images[np.newaxis, :], np.iinfo(np.int64).max)
+    stratum = np.where(has_class.any(1), np.argmin(rarity, axis=1), num_classes)
+
+    subset = []
+    for s in np.unique(stratum):
+        members = np.flatnonzero(stratum == s)
+        size = max(1, int(round(fraction * len(members))))
+        subset.append(rng.choice(members, size, replace=False))
+    return np.sort(np.concatenate(subset))
+
+
+def match_subset(gt_store, detections, subset, ovthresh=0.5):
+    """
+    :param detections: eval.det_store.DetectionStore, the detections of other images are ignored
+    :param subset: positions of the images in gt_store.image_names
+    :return: (matches, npos) matches[c] = (img, tp, fp) of class c sorted by decreasing confidence,
+             img indexes subset; npos [len(subset), C] non difficult GT objects per image and class
+    """
+    position = np.full(len(gt_store.image_names), -1, dtype=np.int64)
+    position[subset] = np.arange(len(subset))
+    npos = np.zeros((len(subset), len(gt_store.classes)))
+    keep = (position[gt_store.gt_img] >= 0) & ~np.asarray(gt_store.gt_difficult)
+    np.add.at(npos, (position[gt_store.gt_img[keep]], gt_store.gt_cls[keep]), 1)
+
+    matches = []
+    for classname in gt_store.classes:
+        class_recs, _ = gt_store.class_recs(classname)
+        image_ids, confidence, BB = detections.class_detections(classname)
+        sorted_ind = np.argsort(-confidence)
+        image_ids = image_ids[sorted_ind]
+        tp, fp = match_detections(image_ids, BB[sorted_ind, :], class_recs, ovthresh)
+        img = position[[gt_store.image_index[str(image)] for image in image_ids]].astype(np.int64)
+        in_subset = img >= 0
+        matches.append((img[in_subset], tp[in_subset], fp[in_subset]))
+    return matches, npos
+
+
+def weighted_aps(matches, npos, weights, use_07_metric=False):
+    """
+    VOC AP of every class for every weighting of the images, voc_eval.voc_ap vectorized.
+    :param weights: [B, n] multiplicity of every subset image in each resample
+    :return: [B, C] APs, nan where a class has no GT object
+    """
+    APs = np.full((len(weights), len(matches)), np.nan)
+    for c, (img, tp, fp) in enumerate(matches):
+        npos_c = weights.dot(npos[:, c])
+        valid = npos_c > 0
+        if len(img) == 0:
+            APs[valid, c] = 0.
+            continue
+        w = weights[:, img]
+        tp_cum = np.cumsum(w * tp, axis=1)
+        fp_cum = np.cumsum(w * fp, axis=1)
+        rec = tp_cum / np.maximum(npos_c, 1)[:, np.newaxis]
+        prec = tp_cum / np.maximum(tp_cum + fp_cum, np.finfo(np.float64).eps)
+        if use_07_metric:
+            ap = np.zeros(len(weights))
+            for t in np.arange(0., 1.1, 0.1):
+                ap += np.max(np.where(rec >= t, prec, 0.), axis=1) / 11.
+        else:
+            zeros, ones = np.zeros((len(weights), 1)), np.ones((len(weights), 1))
+            mrec = np.concatenate([zeros, rec, ones], axis=1)
+            mpre = np.concatenate([zeros, prec, zeros], axis=1)
+            mpre = np.maximum.accumulate(mpre[:, ::-1], axis=1)[:, ::-1]
+            ap = np.sum((mrec[:, 1:] - mrec[:, :-1]) * mpre[:, 1:], axis=1)
+        APs[valid, c] = ap[valid]
+    return APs
+
+
+def bootstrap_map(matches, npos, resamples=200, confidence=0.95, use_07_metric=False, rng=np.random, chunk=50):
+    """
+    :return: (mAP, (low, high)) mAP of the subset and its percentile bootstrap interval
+    """
+    n = len(npos)
+    point = np.nanmean(weighted_aps(matches, npos, np.ones((1, n)), use_07_metric))
+    samples = []
+    for start in range(0, resamples, chunk):
+        weights = rng.multinomial(n, np.full(n, 1.0 / n), size=min(chunk, resamples - start)).astype(np.float64)
+        samples.append(np.nanmean(weighted_aps(matches, npos, weights, use_07_metric), axis=1))
+    samples = np.concatenate(samples)
+    alpha = (1 - confidence) / 2
+    return point, (np.percentile(samples, 100 * alpha), np.percentile(samples, 100 * (1 - alpha)))
@@ -0,0 +1,83 @@
+# coding=utf-8
+"""
+Evaluation of the VOC test set sharded across CPU worker processes.
+
+The parameters and buffers of the model are moved to shared memory (Module.share_memory) and the
+model is sent to workers started with spawn, so the workers map the same weights instead of each
+holding a copy. Every worker runs an Evaluator with its own torch thread count on shards of the
+test list and returns the (img_ind, bboxes) of its shards. The shards are contiguous slices of the
+test list, several per worker so that a slow shard does not leave the other workers idle, and are
+merged in test list order, so the stored detections and the APs are the same as the serial ones.
+"""
+import os
+import itertools
+import numpy as np
+import torch
+import torch.multiprocessing as mp
+from concurrent.futures import ProcessPoolExecutor
+
+_evaluator = None
+
+
+def _init_worker(model, settings, num_threads):
+    global _evaluator
+    from eval.evaluator import Evaluator
+    torch.set_num_threads(num_threads)
+    _evaluator = Evaluator(model, showatt=False)
+    for name, value in settings.items():
+        setattr(_evaluator, name, value)
+
+
+def _predict_shard(positions, multi_test, flip_test, batch_size):
+    _evaluator.inference_time = 0.
+    bboxes = _evaluator.predict_bboxes(positions, multi_test, flip_test, batch_size)
+    return bboxes, _evaluator.inference_time
+
+
+def default_threads(workers):
+    """
+    torch threads per worker: the cores split evenly between the workers.
+    """
+    return max(1, (os.cpu_count() or 1) // workers)
+
+
+class ShardedPredictor(object):
+    def __init__(self, model, workers, num_threads=0, settings=None, shards_per_worker=4):
+        """
+        :param model: CPU model, its tensors are moved to shared memory
+        :param workers: number of worker processes
+        :param num_threads: torch threads per worker, 0 for default_threads(workers)
+        :param settings: Evaluator attributes set in the workers, e.g. val_data_path, conf_thresh
+        :param shards_per_worker: shards of the test list per worker
+        """
+        assert next(model.parameters()).device.type == 'cpu', 'sharded evaluation runs on the CPU'
+        self.workers = workers
+        self.num_threads = num_threads or default_threads(workers)
+        self.shards_per_worker = shards_per_worker
+        model.share_memory()
+        self.__pool = ProcessPoolExecutor(workers, mp_context=mp.get_context('spawn'), initializer=_init_worker,
+                                          initargs=(model, settings or {}, self.num_threads))
+
+    def predict(self, positions, multi_test=False, flip_test=False, batch_size=1):
+        """
+        :param positions: positions of the images in the test list
+        :return: (predictions, inference_time) predictions is the list of (img_ind, bboxes_prd) in
+                 the order of positions, inference_time the sum of the forward passes in ms
+        """
+        positions = np.asarray(positions)
+        shards = [s for s in np.array_split(positions, self.workers * self.shards_per_worker) if len(s)]
+        predictions, inference_time = [], 0.
+        for bboxes, shard_time in self.__pool.map(_predict_shard, shards, itertools.repeat(multi_test),
+                                                  itertools.repeat(flip_test), itertools.repeat(batch_size)):
+            predictions.extend(bboxes)
+            inference_time += shard_time
+        return predictions, inference_time
+
+    def close(self):
+        self.__pool.shutdown()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
@@ -0,0 +1,111 @@
+# coding=utf-8
+"""
+Incremental VOC mAP, updated while the test images are predicted.
+
+The greedy matching of voc_eval only couples the detections of the same image and class: a
+detection is a TP when it is the most confident one claiming its best GT box, and the box a
+detection claims (voc_eval.claim_detections) does not depend on the other detections. So the
+overlaps are computed once per image when it is added, and the AP only needs the claims in
+score order. They are kept per class, in insertion order like eval.det_store.DetectionStore:
+
+    score                 [n] scores rounded to 4 decimals, like the text files
+    claim                 [n] (image, GT) id of the claimed box, -1 (FP) or -2 (difficult)
+
+The AP sorts the scores of a class exactly like voc_eval.eval_detection_arrays and takes the
+first claim of every GT box as TP, so detections with the same rounded score are ordered as in
+Evaluator.calc_APs and the APs are the same. Every image must be added once with all its
+detections.
+"""
+import collections
+import numpy as np
+from eval.voc_eval import claim_detections, claims_tp_fp, voc_ap
+
+
+class StreamingMAP(object):
+    def __init__(self, gt_store, ovthresh=0.5, use_07_metric=False):
+        """
+        :param gt_store: eval.gt_store.VOCGTStore of the test set
+        """
+        self.classes = gt_store.classes
+        self.ovthresh = ovthresh
+        self.use_07_metric = use_07_metric
+        self.__image_index = gt_store.image_index
+        num_images = len(gt_store.image_names)
+
+        # the class_recs of all classes in one dict, keyed by class * num_images + image
+        self.__num_images = num_images
+        self.__recs = collections.defaultdict(lambda: {'bbox': np.zeros((0, 4)),
+                                                       'difficult': np.zeros(0, dtype=bool)})
+        self.npos = np.zeros(len(self.classes), dtype=np.int64)
+        for c, classname in enumerate(self.classes):
+            class_recs, self.npos[c] = gt_store.class_recs(classname)
+            for imagename, R in class_recs.items():
+                self.__recs[c * num_images + self.__image_index[imagename]] = R
+        self.reset()
+
+    def reset(self):
+        # per class, chunks of the score and claim columns in insertion order
+        self.__scores = [[] for _ in self.classes]
+        self.__claims = [[] for _ in self.classes]
+        # the claim ids of every update start after those of the previous ones
+        self.__claim_offset = 0
+        self.num_images = 0
+
+    def update(self, img_inds, bboxes_list):
+        """
+        :param img_inds: names of images that were not added before
+        :param bboxes_list: [n, 6] (xmin, ymin, xmax, ymax, score, class) predictions of every image
+        """
+        keys, scores, boxes = [], [], []
+        for img_ind, bboxes in zip(img_inds, bboxes_list):
+            bboxes = np.asarray(bboxes, dtype=np.float64).reshape(-1, 6)
+            keys.append(bboxes[:, 5].astype(np.int64) * self.__num_images + self.__image_index[img_ind])
+            scores.append(bboxes[:, 4])
+            # integer boxes, like the text files
+            boxes.append(bboxes[:, :4].astype(np.int32).astype(np.float64))
+        self.num_images += len(keys)
+        keys, scores, boxes = np.concatenate(keys), np.concatenate(scores), np.concatenate(boxes)
+        if len(keys) == 0:
+            return
+        # scores rounded like the text files
+        scores = np.char.mod('%.4f', scores).astype(np.float64)
+
+        claims = claim_detections(keys, boxes, self.__recs, self.ovthresh)
+        claimed = claims >= 0
+        claims[claimed] += self.__claim_offset
+        if claimed.any():
+            self.__claim_offset = int(claims[claimed].max()) + 1
+
+        classes = keys // self.__num_images
+        for c in np.unique(classes):
+            mask = classes == c
+            self.__scores[c].append(scores[mask])
+            self.__claims[c].append(claims[mask])
+
+    def class_pr(self, c):
+        """
+        :return: (rec, prec, ap) of class c over the images added so far, one point per detection
+        """
+        if not self.__scores[c]:
+            return 0, 0, 0
+        if len(self.__scores[c]) > 1:
+            self.__scores[c] = [np.concatenate(self.__scores[c])]
+            self.__claims[c] = [np.concatenate(self.__claims[c])]
+        # the sort of voc_eval.eval_detection_arrays
+        sorted_ind = np.argsort(-self.__scores[c][0])
+        tp, fp = claims_tp_fp(self.__claims[c][0][sorted_ind])
+        tp = np.cumsum(tp)
+        fp = np.cumsum(fp)
+        rec = tp / float(self.npos[c])
+        prec = tp / np.maximum(tp + fp, np.finfo(np.float64).eps)
+        return rec, prec, voc_ap(rec, prec, self.use_07_metric)
+
+    def APs(self):
+        """
+        :return: dict{cls:ap} of the images added so far
+        """
+        return {cls: self.class_pr(c)[2] for c, cls in enumerate(self.classes)}
+
+    def mAP(self):
+        APs = self.APs()
+        return sum(APs.values()) / len(APs)
@@ -61,6 +61,90 @@ def voc_ap(rec, prec, use_07_metric=False):
         ap = np.sum((mrec[i + 1] - mrec[i]) * mpre[i + 1])
     return ap
 
+def claim_detections(image_ids, BB, class_recs, ovthresh=0.5):
+    """claims = claim_detections(image_ids, BB, class_recs, [ovthresh])
+
+    The order independent part of match_detections: the GT box every detection claims.
+
+    image_ids: [nd] image name of each detection, in any order
+    BB: [nd, 4] detection boxes in the same order
+    class_recs: {imagename: {'bbox', 'difficult', ...}} ground truth of the class
+    return: [nd] int64 claims, one id per (image, GT) pair of the non difficult GT boxes,
+        -1 for the detections below ovthresh (FP) and -2 for the detections whose best GT
+        is difficult (neither TP nor FP)
+    """
+    nd = len(image_ids)
+    claims = np.full(nd, -1, dtype=np.int64)
+    if nd == 0:
+        return claims
+
+    images, det_img = np.unique(np.asarray(image_ids), return_inverse=True)
+    det_img = det_img.reshape(-1)
+    recs = [class_recs[image] for image in images]
+    num_gt = np.array([len(R['bbox']) for R in recs], dtype=np.int64)
+    max_gt = max(int(num_gt.max()), 1)
+    BBGT = np.zeros((len(images), max_gt, 4))
+    difficult = np.zeros((len(images), max_gt), dtype=bool)
+    for i, R in enumerate(recs):
+        if num_gt[i]:
+            BBGT[i, :num_gt[i]] = np.asarray(R['bbox']).astype(float)
+            difficult[i, :num_gt[i]] = R['difficult']
+
+    # the same arithmetic as the per detection loop, one row per detection
+    bb = BB.astype(float)
+    BBGT_d = BBGT[det_img]
+    ixmin = np.maximum(BBGT_d[:, :, 0], bb[:, 0:1])
+    iymin = np.maximum(BBGT_d[:, :, 1], bb[:, 1:2])
+    ixmax = np.minimum(BBGT_d[:, :, 2], bb[:, 2:3])
+    iymax = np.minimum(BBGT_d[:, :, 3], bb[:, 3:4])
+    iw = np.maximum(ixmax - ixmin + 1., 0.)
+    ih = np.maximum(iymax - iymin + 1., 0.)
+    inters = iw * ih
+    uni = ((bb[:, 2:3] - bb[:, 0:1] + 1.) * (bb[:, 3:4] - bb[:, 1:2] + 1.) +
+           (BBGT_d[:, :, 2] - BBGT_d[:, :, 0] + 1.) *
+           (BBGT_d[:, :, 3] - BBGT_d[:, :, 1] + 1.) - inters)
+    overlaps = inters / uni
+    overlaps[np.arange(max_gt)[np.newaxis, :] >= num_gt[det_img][:, np.newaxis]] = -np.inf
+    jmax = np.argmax(overlaps, axis=1)
+    ovmax = overlaps[np.arange(nd), jmax]
+
+    matched = ovmax > ovthresh
+    claims[matched] = np.where(difficult[det_img, jmax], -2, det_img * max_gt + jmax)[matched]
+    return claims
+
+def claims_tp_fp(claims):
+    """tp, fp = claims_tp_fp(claims)
+
+    TP/FP of the claims of claim_detections sorted by decreasing confidence: the first claim of
+    every (image, GT) pair is the TP.
+    """
+    tp = np.zeros(len(claims))
+    fp = (claims == -1).astype(float)
+    candidates = np.flatnonzero(claims >= 0)
+    # first detection claiming each (image, gt), np.unique returns first occurrences
+    _, first = np.unique(claims[candidates], return_index=True)
+    tp[candidates[first]] = 1.
+    fp[candidates] = 1. - tp[candidates]
+    return tp, fp
+
+def match_detections(image_ids, BB, class_recs, ovthresh=0.5):
+    """tp, fp = match_detections(image_ids, BB, class_recs, [ovthresh])
+
+    Greedy matching of detections sorted by decreasing confidence, vectorized.
+
+    The GT box a detection is compared with (the argmax of its overlaps) does not depend on the
+    earlier matches, only the outcome does: a detection is a TP when it is the first one, in
+    confidence order, whose best GT is that non difficult box. So the overlaps of all detections
+    are computed at once against the GT of their image (padded to the largest count), and the
+    first claim of every (image, GT) pair is found with np.unique. The result is the same as
+    walking the detections one at a time and marking R['det'], which is left untouched.
+
+    image_ids: [nd] image name of each detection, sorted by decreasing confidence
+    BB: [nd, 4] detection boxes in the same order
+    class_recs: {imagename: {'bbox', 'difficult', ...}} ground truth of the class
+    """
+    return claims_tp_fp(claim_detections(image_ids, BB, class_recs, ovthresh))
+
 def voc_eval(detpath,
              annopath,
              imagesetfile,
@@ -132,6 +216,22 @@ def voc_eval(detpath,
                                  'difficult': difficult,
                                  'det': det}
 
+    return eval_detections(detpath, classname, class_recs, npos, ovthresh, use_07_metric)
+
+def eval_detections(detpath,
+                    classname,
+                    class_recs,
+                    npos,
+                    ovthresh=0.5,
+                    use_07_metric=False):
+    """rec, prec, ap = eval_detections(detpath, classname, class_recs, npos, ...)
+
+    Match the detections of classname against its ground truth, see voc_eval.
+
+    class_recs: {imagename: {'bbox', 'difficult', 'det'}} ground truth of classname,
+        e.g. built by voc_eval or eval.gt_store.VOCGTStore.class_recs
+    npos: number of non difficult ground truth objects
+    """
     # read dets
     detfile = detpath.format(classname)
     if os.path.isfile(detfile):
@@ -142,62 +242,42 @@ def voc_eval(detpath,
         confidence = np.array([float(x[1]) for x in splitlines])
         BB = np.array([[float(z) for z in x[2:]] for x in splitlines])
 
-        # sort by confidence
-        sorted_ind = np.argsort(-confidence)
-        sorted_scores = np.sort(-confidence)
-        BB = BB[sorted_ind, :]
-        image_ids = [image_ids[x] for x in sorted_ind]
-
-        # go down dets and mark TPs and FPs
-        nd = len(image_ids)
-        tp = np.zeros(nd)
-        fp = np.zeros(nd)
-        for d in range(nd):
-            R = class_recs[image_ids[d]]
-            bb = BB[d, :].astype(float)
-            ovmax = -np.inf
-            BBGT = R['bbox'].astype(float)
-
-            if BBGT.size > 0:
-                # compute overlaps
-                # intersection
-                ixmin = np.maximum(BBGT[:, 0], bb[0])
-                iymin = np.maximum(BBGT[:, 1], bb[1])
-                ixmax = np.minimum(BBGT[:, 2], bb[2])
-                iymax = np.minimum(BBGT[:, 3], bb[3])
-                iw = np.maximum(ixmax - ixmin + 1., 0.)
-                ih = np.maximum(iymax - iymin + 1., 0.)
-                inters = iw * ih
-
-                # union
-                uni = ((bb[2] - bb[0] + 1.) * (bb[3] - bb[1] + 1.) +
-                       (BBGT[:, 2] - BBGT[:, 0] + 1.) *
-                       (BBGT[:, 3] - BBGT[:, 1] + 1.) - inters)
-
-                overlaps = inters / uni
-                ovmax = np.max(overlaps)
-                jmax = np.argmax(overlaps)
-
-            if ovmax > ovthresh:
-                if not R['difficult'][jmax]:
-                    if not R['det'][jmax]:
-                        tp[d] = 1.
-                        R['det'][jmax] = 1
-                    else:
-                        fp[d] = 1.
-            else:
-                fp[d] = 1.
-
-        # compute precision recall
-        fp = np.cumsum(fp)
-        tp = np.cumsum(tp)
-        rec = tp / float(npos)
-        # avoid divide by zero in case the first detection matches a difficult
-        # ground truth
-        prec = tp / np.maximum(tp + fp, np.finfo(np.float64).eps)
-        ap = voc_ap(rec, prec, use_07_metric)
-        return rec, prec, ap
+        return eval_detection_arrays(image_ids, confidence, BB, class_recs, npos, ovthresh, use_07_metric)
     else:
         return 0, 0, 0
 
+def eval_detection_arrays(image_ids,
+                          confidence,
+                          BB,
+                          class_recs,
+                          npos,
+                          ovthresh=0.5,
+                          use_07_metric=False):
+    """rec, prec, ap = eval_detection_arrays(image_ids, confidence, BB, class_recs, npos, ...)
+
+    eval_detections on detections already in memory, e.g. eval.det_store.DetectionStore.
+
+    image_ids: [nd] image name of each detection
+    confidence: [nd] scores
+    BB: [nd, 4] detection boxes
+    """
+    if len(image_ids) == 0:
+        return 0, 0, 0
+
+    # sort by confidence
+    sorted_ind = np.argsort(-confidence)
+    BB = BB[sorted_ind, :]
+    image_ids = [image_ids[x] for x in sorted_ind]
+
+    # mark TPs and FPs
+    tp, fp = match_detections(image_ids, BB, class_recs, ovthresh)
 
+    # compute precision recall
+    fp = np.cumsum(fp)
+    tp = np.cumsum(tp)
+    rec = tp / float(npos)
+    # avoid divide by zero in case the first detection matches a difficult
+    # ground truth
+    prec = tp / np.maximum(tp + fp, np.finfo(np.float64).eps)
+    ap = voc_ap(rec, prec, use_07_metric)
+    return rec, prec, ap
@@ -10,6 +10,9 @@ from utils.torch_utils import *
 from utils.log import Logger
 import cv2
 from eval.cocoapi_evaluator import COCOAPIEvaluator
+from eval.pred_cache import PredictionCache
+from utils.prefetch_loader import PrefetchLoader, read_image
+import functools
 
 
 class Evaluation(object):
@@ -68,19 +71,35 @@ class Evaluation(object):
                     if os.path.isfile(path_file2):
                         os.remove(path_file2)
 
-    def study(self):
-        # Parameter study
+    def study(self, conf_list=(0.08, 0.07, 0.06), nms_list=None, nms_methods=None):
+        # Parameter study, replayed on the pre-NMS candidates of a single pass over val2017
+        global logger
+        nms_list = nms_list or [cfg.VAL["NMS_THRESH"]]
+        nms_methods = nms_methods or ['nms']
+        score_floor = cfg.VAL["SWEEP_SCORE_FLOOR"]
+        assert min(conf_list) > score_floor, 'confidence thresholds must be above SWEEP_SCORE_FLOOR'
+        evaluator = COCOAPIEvaluator(model_type='YOLOv4',
+                                     data_dir=cfg.DATA_PATH,
+                                     img_size=cfg.VAL["TEST_IMG_SIZE"],
+                                     confthre=cfg.VAL["CONF_THRESH"],
+                                     nmsthre=cfg.VAL["NMS_THRESH"])
+        cache = PredictionCache(os.path.join(cfg.PROJECT_PATH, 'cache', 'pred'), self.__model,
+                                cfg.VAL["TEST_IMG_SIZE"], 'coco_val2017', score_floor, cfg.VAL["SWEEP_TOPK"])
+        if not cache.exists():
+            t = time.time()
+            cache.save(*evaluator.predict_candidates(self.__model, score_floor, cfg.VAL["SWEEP_TOPK"]))
+            logger.info("  ===candidates cost time:{:.4f}s".format(time.time() - t))
+        ids, candidates = cache.load()
+
         y = []
-        for i in [0.08, 0.07, 0.06]:
-                t = time.time()
-                evaluator = COCOAPIEvaluator(model_type='YOLOv3',
-                                             data_dir=cfg.DATA_PATH,
-                                             img_size=cfg.VAL["TEST_IMG_SIZE"],
-                                             confthre=i,
-                                             nmsthre=cfg.VAL["NMS_THRESH"])
-                _, r = evaluator.evaluate(self.__model)
-                y.append(str(i) +str('  ') + str(r) +str('  ')+ str(time.time() - t,))
-                np.savetxt('study.txt', y, fmt='%s')  # y = np.loadtxt('study.txt')
+        for method in nms_methods:
+            for nms_thresh in nms_list:
+                for i in conf_list:
+                    t = time.time()
+                    r = evaluator.evaluate_candidates(ids, candidates, i, nms_thresh, method)
+                    y.append('  '.join([str(i), str(nms_thresh), method, str(r), str(time.time() - t)]))
+                    logger.info(y[-1])
+                    np.savetxt('study.txt', y, fmt='%s')  # y = np.loadtxt('study.txt')
 
     def val(self):
             global logger
@@ -108,13 +127,13 @@ class Evaluation(object):
             path = os.path.join(cfg.DETECTION_PATH, "detection_result")
             logger.info("saved images at: {}".format(path))
             inference_times = []
-            for v in imgs:
-                start_time = time.time()
-                path = os.path.join(self.__visiual, v)
-                img = cv2.imread(path)
-                assert img is not None
-
-                bboxes_prd = self.__evalter.get_bbox(img, v)
+            test_shape = None if self.__multi_scale_val else cfg.VAL["TEST_IMG_SIZE"]
+            loader = PrefetchLoader([os.path.join(self.__visiual, v) for v in imgs],
+                                    functools.partial(read_image, test_shape=test_shape),
+                                    num_workers=cfg.VAL["NUMBER_WORKERS"], max_prefetch=cfg.VAL["PREFETCH_IMAGES"])
+            start_time = time.time()
+            for v, (img, resized) in zip(imgs, loader):
+                bboxes_prd = self.__evalter.get_bbox(img, self.__multi_scale_val, self.__flip_val, resized=resized)
                 if bboxes_prd.shape[0] != 0:
                     boxes = bboxes_prd[..., :4]
                     class_inds = bboxes_prd[..., 5].astype(np.int32)
@@ -125,6 +144,8 @@ class Evaluation(object):
                     cv2.imwrite(path, img)
                 end_time = time.time()
                 inference_times.append(end_time - start_time)
+                start_time = end_time
+            logger.info(loader.stats_str())
             inference_time = sum(inference_times) / len(inference_times)
             fps = 1.0 / inference_time
             logging.info("Inference_Time: {:.5f} s/image, FPS: {}".format(inference_time,fps))
@@ -142,6 +163,12 @@ if __name__ == "__main__":
                         help='val or det or study')
     parser.add_argument('--heatmap', type=str, default=False,
                         help='whither show attention map')
+    parser.add_argument('--conf_list', type=float, nargs='+', default=[0.08, 0.07, 0.06],
+                        help='confidence thresholds of the study')
+    parser.add_argument('--nms_list', type=float, nargs='+', default=None,
+                        help='NMS IoU thresholds of the study, NMS_THRESH by default')
+    parser.add_argument('--nms_methods', type=str, nargs='+', default=None,
+                        help='NMS methods of the study (nms, soft-nms, linear, diou, matrix, matrix-linear)')
     opt = parser.parse_args()
     logger = Logger(log_file_name=opt.log_val_path + '/log_coco_val.txt', log_level=logging.DEBUG, logger_name='YOLOv4').get_log()
 
@@ -159,5 +186,5 @@ if __name__ == "__main__":
         Evaluation(gpu_id=opt.gpu_id,
                     weight_path=opt.weight_path,
                    visiual=opt.visiual,
-                   heatmap=opt.heatmap).study()
+                   heatmap=opt.heatmap).study(opt.conf_list, opt.nms_list, opt.nms_methods)
 
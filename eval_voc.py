@@ -2,6 +2,7 @@ import utils.gpu as gpu
 from model.build_model import Build_Model
 from utils.tools import *
 from eval.evaluator import Evaluator
+from eval.pred_cache import PredictionCache
 import argparse
 import time
 import logging
@@ -9,6 +10,8 @@ import config.yolov4_config as cfg
 from utils.visualize import *
 from utils.torch_utils import *
 from utils.log import Logger
+from utils.prefetch_loader import PrefetchLoader, read_image
+import functools
 
 
 class Evaluation(object):
@@ -17,6 +20,8 @@ class Evaluation(object):
                  weight_path=None,
                  visiual=None,
                  eval=False,
+                 batch_size=1,
+                 workers=None,
                  ):
         self.__num_class = cfg.VOC_DATA["NUM"]
         self.__conf_threshold = cfg.VAL["CONF_THRESH"]
@@ -27,6 +32,8 @@ class Evaluation(object):
 
         self.__visiual = visiual
         self.__eval = eval
+        self.__batch_size = batch_size
+        self.__workers = cfg.VAL["EVAL_WORKERS"] if workers is None else workers
         self.__classes = cfg.VOC_DATA["CLASSES"]
 
         self.__model = Build_Model().to(self.__device)
@@ -52,7 +59,9 @@ class Evaluation(object):
             start = time.time()
             mAP = 0
             with torch.no_grad():
-                    APs, inference_time = Evaluator(self.__model, showatt=False).APs_voc(self.__multi_scale_val, self.__flip_val)
+                    evaluator = Evaluator(self.__model, showatt=False)
+                    evaluator.eval_workers = self.__workers
+                    APs, inference_time = evaluator.APs_voc(self.__multi_scale_val, self.__flip_val, self.__batch_size)
                     for i in APs:
                         logger.info("{} --> mAP : {}".format(i, APs[i]))
                         mAP += APs[i]
@@ -62,19 +71,52 @@ class Evaluation(object):
             end = time.time()
             logger.info("  ===val cost time:{:.4f}s".format(end - start))
 
+    def sweep(self, conf_list=None, nms_list=None, nms_methods=None):
+        """
+        mAP of every confidence threshold/NMS setting, replayed on the pre-NMS candidates of a
+        single pass over the test set (cached per checkpoint in PROJECT_PATH/cache/pred).
+        """
+        global logger
+        conf_list = conf_list or [self.__conf_threshold]
+        nms_list = nms_list or [self.__nms_threshold]
+        nms_methods = nms_methods or [cfg.VAL["NMS_METHOD"]]
+        score_floor = cfg.VAL["SWEEP_SCORE_FLOOR"]
+        assert min(conf_list) > score_floor, 'confidence thresholds must be above SWEEP_SCORE_FLOOR'
+        tag = 'voc{}{}'.format('_multi' if self.__multi_scale_val else '', '_flip' if self.__flip_val else '')
+        cache = PredictionCache(os.path.join(cfg.PROJECT_PATH, 'cache', 'pred'), self.__model,
+                                cfg.VAL["TEST_IMG_SIZE"], tag, score_floor, cfg.VAL["SWEEP_TOPK"])
+        if not cache.exists():
+            logger.info("***********Caching the candidates****************")
+            start = time.time()
+            cache.save(*self.__evalter.predict_candidates(self.__multi_scale_val, self.__flip_val,
+                                                         score_floor, cfg.VAL["SWEEP_TOPK"]))
+            logger.info("  ===candidates cost time:{:.4f}s".format(time.time() - start))
+        img_inds, candidates = cache.load()
+
+        logger.info("***********Start Sweep****************")
+        for method in nms_methods:
+            for nms_thresh in nms_list:
+                for conf_thresh in conf_list:
+                    start = time.time()
+                    APs = self.__evalter.APs_replay(img_inds, candidates, conf_thresh, nms_thresh, method)
+                    mAP = sum(APs.values()) / self.__num_class
+                    logger.info('conf:{} nms:{} {} --> mAP:{:.5f} ({:.2f}s)'.format(
+                        conf_thresh, nms_thresh, method, mAP, time.time() - start))
+
     def detection(self):
         global logger
         if self.__visiual:
             imgs = os.listdir(self.__visiual)
             logger.info("***********Start Detection****************")
-            for v in imgs:
+            test_shape = None if self.__multi_scale_val else cfg.VAL["TEST_IMG_SIZE"]
+            loader = PrefetchLoader([os.path.join(self.__visiual, v) for v in imgs],
+                                    functools.partial(read_image, test_shape=test_shape),
+                                    num_workers=cfg.VAL["NUMBER_WORKERS"], max_prefetch=cfg.VAL["PREFETCH_IMAGES"])
+            for v, (img, resized) in zip(imgs, loader):
                 path = os.path.join(self.__visiual, v)
                 logger.info("val images : {}".format(path))
 
-                img = cv2.imread(path)
-                assert img is not None
-
-                bboxes_prd = self.__evalter.get_bbox(img,v)
+                bboxes_prd = self.__evalter.get_bbox(img, self.__multi_scale_val, self.__flip_val, resized=resized)
                 if bboxes_prd.shape[0] != 0:
                     boxes = bboxes_prd[..., :4]
                     class_inds = bboxes_prd[..., 5].astype(np.int32)
@@ -85,6 +127,7 @@ class Evaluation(object):
 
                     cv2.imwrite(path, img)
                     logger.info("saved images : {}".format(path))
+            logger.info(loader.stats_str())
 
 
 if __name__ == "__main__":
@@ -97,7 +140,16 @@ if __name__ == "__main__":
     parser.add_argument('--visiual', type=str, default='VOCtest-2007/VOC2007/JPEGImages', help='val data path or None')
     parser.add_argument('--eval', action='store_true', default=True, help='eval the mAP or not')
     parser.add_argument('--mode', type=str, default='val',
-                        help='val or det')
+                        help='val, det or sweep')
+    parser.add_argument('--conf_list', type=float, nargs='+', default=None,
+                        help='confidence thresholds of the sweep, CONF_THRESH by default')
+    parser.add_argument('--nms_list', type=float, nargs='+', default=None,
+                        help='NMS IoU thresholds of the sweep, NMS_THRESH by default')
+    parser.add_argument('--nms_methods', type=str, nargs='+', default=None,
+                        help='NMS methods of the sweep, NMS_METHOD by default')
+    parser.add_argument('--batch_size', type=int, default=1, help='test images per forward pass (single scale only)')
+    parser.add_argument('--workers', type=int, default=None,
+                        help='CPU processes sharing the test set (--gpu_id -1), EVAL_WORKERS by default')
     opt = parser.parse_args()
     logger = Logger(log_file_name=opt.log_val_path + '/log_voc_val.txt', log_level=logging.DEBUG, logger_name='YOLOv4').get_log()
 
@@ -105,7 +157,14 @@ if __name__ == "__main__":
         Evaluation(gpu_id=opt.gpu_id,
                     weight_path=opt.weight_path,
                    eval=opt.eval,
-                   visiual=opt.visiual).val()
+                   visiual=opt.visiual,
+                   batch_size=opt.batch_size,
+                   workers=opt.workers).val()
+    elif opt.mode == 'sweep':
+        Evaluation(gpu_id=opt.gpu_id,
+                    weight_path=opt.weight_path,
+                   eval=opt.eval,
+                   visiual=opt.visiual).sweep(opt.conf_list, opt.nms_list, opt.nms_methods)
     else:
         Evaluation(gpu_id=opt.gpu_id,
                     weight_path=opt.weight_path,
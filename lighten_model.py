@@ -11,7 +11,7 @@ from pytorch_lightning import loggers as pl_loggers
 from tqdm import tqdm
 
 from model.build_model import Build_Model
-from model.loss.yolo_loss import YoloV4Loss
+from model.loss.yolo_loss import YoloV4Loss, YoloV4SparseLoss
 import config.yolov4_config as cfg
 
 from eval_coco import *
@@ -26,8 +26,13 @@ class lightenYOLOv4(pl.LightningModule):
 
         super().__init__()
         self.model = Build_Model(weight_path=weight_path, resume=resume)
-        self.criterion = YoloV4Loss(anchors=cfg.MODEL["ANCHORS"], strides=cfg.MODEL["STRIDES"],
-                                    iou_threshold_loss=cfg.TRAIN["IOU_THRESHOLD_LOSS"])
+        self.sparse_label = cfg.TRAIN["SPARSE_LABEL"]
+        if self.sparse_label:
+            self.criterion = YoloV4SparseLoss(anchors=cfg.MODEL["ANCHORS"], strides=cfg.MODEL["STRIDES"],
+                                              iou_threshold_loss=cfg.TRAIN["IOU_THRESHOLD_LOSS"])
+        else:
+            self.criterion = YoloV4Loss(anchors=cfg.MODEL["ANCHORS"], strides=cfg.MODEL["STRIDES"],
+                                        iou_threshold_loss=cfg.TRAIN["IOU_THRESHOLD_LOSS"])
 
         self.evaluator = Evaluator(self.model, showatt=False, exp_name=exp_name)
         self.evaluator.clear_predict_file()
@@ -51,11 +56,16 @@ class lightenYOLOv4(pl.LightningModule):
 
     # the train loop INDEPENDENT of forward.
     def training_step(self, batch, batch_idx):
-        img, label_sbbox, label_mbbox, label_lbbox, sbboxes, mbboxes, lbboxes, _ = batch
+        if self.sparse_label:
+            img, targets, gt_bboxes, _ = batch
+            p, p_d = self(img)
+            loss, loss_ciou, loss_conf, loss_cls = self.criterion(p, p_d, targets, gt_bboxes)
+        else:
+            img, label_sbbox, label_mbbox, label_lbbox, sbboxes, mbboxes, lbboxes, _ = batch
 
-        p, p_d = self(img)
-        loss, loss_ciou, loss_conf, loss_cls = self.criterion(p, p_d, label_sbbox, label_mbbox,
-                                                  label_lbbox, sbboxes, mbboxes, lbboxes)
+            p, p_d = self(img)
+            loss, loss_ciou, loss_conf, loss_cls = self.criterion(p, p_d, label_sbbox, label_mbbox,
+                                                      label_lbbox, sbboxes, mbboxes, lbboxes)
 
 
         result = pl.TrainResult(minimize=loss)
@@ -84,7 +94,7 @@ class lightenYOLOv4(pl.LightningModule):
 
 
     def validation_epoch_end(self, outputs):
-        APs = self.evaluator.calc_APs()
+        APs = self.evaluator.current_APs()
         self.evaluator.clear_predict_file()
         mAP = 0
         for i in APs:
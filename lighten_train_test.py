@@ -34,7 +34,8 @@ if __name__ == '__main__':
     train_dataloader = DataLoader(train_dataset,
                                         batch_size=1, #cfg.TRAIN["BATCH_SIZE"],
                                         num_workers=cfg.TRAIN["NUMBER_WORKERS"],
-                                        shuffle=True, pin_memory=True
+                                        shuffle=True, pin_memory=True,
+                                        collate_fn=data.sparse_collate if train_dataset.sparse_label else None
                                         )
     test_dataloader = DataLoader(test_dataset,
                                         batch_size=1, #cfg.VAL["BATCH_SIZE"],
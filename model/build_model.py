@@ -39,16 +39,25 @@ class Build_Model(nn.Module):
 
         x_s, x_m, x_l = self.__yolov4(x)
 
-        out.append(self.__head_s(x_s))
-        out.append(self.__head_m(x_m))
-        out.append(self.__head_l(x_l))
-
-        if self.training:
-            p, p_d = list(zip(*out))
-            return p, p_d  # smalll, medium, large
-        else:
+        if self.training or torch.is_grad_enabled():
+            out.append(self.__head_s(x_s))
+            out.append(self.__head_m(x_m))
+            out.append(self.__head_l(x_l))
             p, p_d = list(zip(*out))
+            if self.training:
+                return p, p_d  # smalll, medium, large
             return p, torch.cat(p_d, 0)
+        else:
+            # the heads decode into their rows of one output, instead of torch.cat of their outputs
+            nA = cfg.MODEL["ANCHORS_PER_SCLAE"]
+            rows = [x_i.shape[0] * x_i.shape[2] * x_i.shape[3] * nA for x_i in (x_s, x_m, x_l)]
+            p_d = x_s.new_empty((sum(rows), 5 + self.__nC))
+            start = 0
+            for head, x_i, n in zip((self.__head_s, self.__head_m, self.__head_l), (x_s, x_m, x_l), rows):
+                bs, nG = x_i.shape[0], x_i.shape[-1]
+                out.append(head(x_i, p_d[start:start + n].view(bs, nG, nG, nA, 5 + self.__nC))[0])
+                start += n
+            return tuple(out), p_d
     
     def getNC(self):
         return self.__nC
@@ -10,34 +10,48 @@ class Yolo_head(nn.Module):
         self.__nA = len(anchors)
         self.__nC = nC
         self.__stride = stride
+        # (grid size, device, dtype) -> ([1, nG, nG, 1, 2] grid, [nA, 2] anchors), broadcast over the batch
+        self.__grids = {}
 
 
-    def forward(self, p):
+    def forward(self, p, out=None):
+        """
+        :param out: optional [bs, nG, nG, nA, 5 + nC] view the decoded boxes are written to (eval
+                    under torch.no_grad only, see Build_Model), instead of a new tensor
+        """
         bs, nG = p.shape[0], p.shape[-1]
-        p = p.view(bs, self.__nA, 5 + self.__nC, nG, nG).permute(0, 3, 4, 1, 2)
+        p_raw = p.view(bs, self.__nA, 5 + self.__nC, nG, nG)
+        p = p_raw.permute(0, 3, 4, 1, 2)
 
-        p_de = self.__decode(p.clone())
+        if out is not None:
+            return (p, self.__decode_into(p_raw, out))
+        p_de = self.__decode(p)
 
         return (p, p_de)
 
 
+    def __grid(self, output_size, device, dtype):
+        key = (output_size, device, dtype)
+        if key not in self.__grids:
+            y = torch.arange(0, output_size).unsqueeze(1).repeat(1, output_size)
+            x = torch.arange(0, output_size).unsqueeze(0).repeat(output_size, 1)
+            grid_xy = torch.stack([x, y], dim=-1).unsqueeze(0).unsqueeze(3).to(device=device, dtype=dtype)
+            anchors = (1.0 * self.__anchors).to(device=device, dtype=dtype)
+            self.__grids[key] = (grid_xy, anchors)
+        return self.__grids[key]
+
+
     def __decode(self, p):
-        batch_size, output_size = p.shape[:2]
+        output_size = p.shape[1]
 
-        device = p.device
         stride = self.__stride
-        anchors = (1.0 * self.__anchors).to(device)
+        grid_xy, anchors = self.__grid(output_size, p.device, p.dtype)
 
         conv_raw_dxdy = p[:, :, :, :, 0:2]
         conv_raw_dwdh = p[:, :, :, :, 2:4]
         conv_raw_conf = p[:, :, :, :, 4:5]
         conv_raw_prob = p[:, :, :, :, 5:]
 
-        y = torch.arange(0, output_size).unsqueeze(1).repeat(1, output_size)
-        x = torch.arange(0, output_size).unsqueeze(0).repeat(output_size, 1)
-        grid_xy = torch.stack([x, y], dim=-1)
-        grid_xy = grid_xy.unsqueeze(0).unsqueeze(3).repeat(batch_size, 1, 1, 3, 1).float().to(device)
-
         pred_xy = (torch.sigmoid(conv_raw_dxdy) + grid_xy) * stride
         pred_wh = (torch.exp(conv_raw_dwdh) * anchors) * stride
         pred_xywh = torch.cat([pred_xy, pred_wh], dim=-1)
@@ -46,3 +60,21 @@ class Yolo_head(nn.Module):
         pred_bbox = torch.cat([pred_xywh, pred_conf, pred_prob], dim=-1)
 
         return pred_bbox.view(-1, 5 + self.__nC) if not self.training else pred_bbox
+
+
+    def __decode_into(self, p, out):
+        """
+        __decode written to out from fewer temporaries: the activations are computed on the
+        contiguous [bs, nA, 5 + nC, nG, nG] layout of the convolution output and copied to out in
+        one transposed copy. The values may differ from __decode by an ulp of the sigmoid.
+        :param p: [bs, nA, 5 + nC, nG, nG]
+        """
+        stride = self.__stride
+        grid_xy, anchors = self.__grid(p.shape[-1], p.device, p.dtype)
+
+        pred_bbox = torch.sigmoid(p)
+        pred_bbox[:, :, 0:2].add_(grid_xy.permute(0, 3, 4, 1, 2)).mul_(stride)
+        torch.exp(p[:, :, 2:4], out=pred_bbox[:, :, 2:4]).mul_(anchors.view(1, self.__nA, 2, 1, 1)).mul_(stride)
+        out.copy_(pred_bbox.permute(0, 3, 4, 1, 2))
+
+        return out
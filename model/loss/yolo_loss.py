@@ -3,6 +3,7 @@ sys.path.append("../utils")
 import torch
 import torch.nn as nn
 from utils import tools
+from utils.box_iou import box_iou_xywh
 import config.yolov4_config as cfg
 
 
@@ -20,11 +21,40 @@ class FocalLoss(nn.Module):
         return loss
 
 
+def iou_max(p_d_xywh, bboxes, chunk=16):
+    """
+    Max IoU of every prediction with the GT boxes of its image, for the ignore mask.
+    The mask only thresholds it, so it is computed without autograd, over chunks of GT slots with
+    a running max instead of one [bs, grid, grid, anchors, slots] product, and the slots after the
+    last non-empty one of the batch are skipped.
+    :param p_d_xywh: [bs, grid, grid, anchors, 4]
+    :param bboxes: [bs, slots, 4] (x, y, w, h), empty slots are zero
+    :return: [bs, grid, grid, anchors, 1]
+    """
+    with torch.no_grad():
+        used = (bboxes[..., 2] * bboxes[..., 3] > 0).any(0).nonzero()
+        num_slots = int(used.max()) + 1 if len(used) else 0
+        p_d_xywh = p_d_xywh.detach().unsqueeze(4)
+        # empty slots have an IoU of 0
+        iou_max = torch.zeros_like(p_d_xywh[..., 0, :1])
+        for start in range(0, num_slots, chunk):
+            gt = bboxes[:, start:start + chunk].unsqueeze(1).unsqueeze(1).unsqueeze(1)
+            iou_max = torch.max(iou_max, tools.iou_xywh_torch(p_d_xywh, gt).max(-1, keepdim=True)[0])
+    return iou_max
+
+
 class YoloV4Loss(nn.Module):
-    def __init__(self, anchors, strides, iou_threshold_loss=0.5):
+    def __init__(self, anchors, strides, iou_threshold_loss=0.5, fused=False):
+        """
+        :param fused: compute the three detection layers in one pass over their concatenated
+                      predictions and labels instead of one pass per layer
+        """
         super(YoloV4Loss, self).__init__()
         self.__iou_threshold_loss = iou_threshold_loss
         self.__strides = strides
+        self.__fused = fused
+        self.__bce = nn.BCEWithLogitsLoss(reduction="none")
+        self.__focal = FocalLoss(gamma=2, alpha=1.0, reduction="none")
 
     def forward(self, p, p_d, label_sbbox, label_mbbox, label_lbbox, sbboxes, mbboxes, lbboxes):
         """
@@ -42,6 +72,8 @@ class YoloV4Loss(nn.Module):
         :param lbboxes: Same as sbboxes
         """
         strides = self.__strides
+        if self.__fused:
+            return self.__cal_loss_fused(p, p_d, [label_sbbox, label_mbbox, label_lbbox], [sbboxes, mbboxes, lbboxes])
 
         loss_s, loss_s_ciou, loss_s_conf, loss_s_cls = self.__cal_loss_per_layer(p[0], p_d[0], label_sbbox,
                                                                sbboxes, strides[0])
@@ -79,8 +111,8 @@ class YoloV4Loss(nn.Module):
 
         :return: The average loss(loss_giou, loss_conf, loss_cls) of all batches of this detection layer.
         """
-        BCE = nn.BCEWithLogitsLoss(reduction="none")
-        FOCAL = FocalLoss(gamma=2, alpha=1.0, reduction="none")
+        BCE = self.__bce
+        FOCAL = self.__focal
 
         batch_size, grid = p.shape[:2]
         img_size = stride * grid
@@ -96,18 +128,17 @@ class YoloV4Loss(nn.Module):
         label_mix = label[..., 5:6]
 
 
-        # loss ciou
-        ciou = tools.CIOU_xywh_torch(p_d_xywh, label_xywh).unsqueeze(-1)
+        # loss ciou, positive cells only
+        obj = label_obj_mask[..., 0] > 0
+        ciou = box_iou_xywh(p_d_xywh[obj], label_xywh[obj], 'ciou').unsqueeze(-1)
 
         # The scaled weight of bbox is used to balance the impact of small objects and large objects on loss.
-        bbox_loss_scale = 2.0 - 1.0 * label_xywh[..., 2:3] * label_xywh[..., 3:4] / (img_size ** 2)
-        loss_ciou = label_obj_mask * bbox_loss_scale * (1.0 - ciou) * label_mix
+        bbox_loss_scale = 2.0 - 1.0 * label_xywh[obj][:, 2:3] * label_xywh[obj][:, 3:4] / (img_size ** 2)
+        loss_ciou = label_obj_mask[obj] * bbox_loss_scale * (1.0 - ciou) * label_mix[obj]
 
 
         # loss confidence
-        iou = tools.iou_xywh_torch(p_d_xywh.unsqueeze(4), bboxes.unsqueeze(1).unsqueeze(1).unsqueeze(1))
-        iou_max = iou.max(-1, keepdim=True)[0]
-        label_noobj_mask = (1.0 - label_obj_mask) * (iou_max < self.__iou_threshold_loss).float()
+        label_noobj_mask = (1.0 - label_obj_mask) * (iou_max(p_d_xywh, bboxes) < self.__iou_threshold_loss).float()
 
         loss_conf = (label_obj_mask * FOCAL(input=p_conf, target=label_obj_mask) +
                     label_noobj_mask * FOCAL(input=p_conf, target=label_obj_mask)) * label_mix
@@ -124,6 +155,144 @@ class YoloV4Loss(nn.Module):
 
         return loss, loss_ciou, loss_conf, loss_cls
 
+    def __cal_loss_fused(self, p, p_d, labels, bboxes):
+        """
+        __cal_loss_per_layer on the rows [bs, sum(grid*grid*anchors), C] of the three layers, the
+        image size of the layer of every row is a column of the rows. The focal loss of the
+        confidence is computed once for the obj and noobj terms, the ignore mask per layer
+        without autograd.
+        """
+        batch_size = p[0].shape[0]
+        img_sizes = [stride * p_i.shape[1] for p_i, stride in zip(p, self.__strides)]
+        noobj = [(iou_max(p_d_i[..., :4], bboxes_i) < self.__iou_threshold_loss).float().view(batch_size, -1, 1)
+                 for p_d_i, bboxes_i in zip(p_d, bboxes)]
+
+        img_size = torch.cat([torch.full((p_i[0, ..., :1].numel(), 1), float(size), device=p_i.device)
+                              for p_i, size in zip(p, img_sizes)], 0)
+        p = self.__rows([p_i[..., 4:] for p_i in p])
+        p_d_xywh = self.__rows([p_d_i[..., :4] for p_d_i in p_d])
+        label = self.__rows(labels)
+
+        p_conf = p[..., 0:1]
+        p_cls = p[..., 1:]
+        label_xywh = label[..., :4]
+        label_obj_mask = label[..., 4:5]
+        label_mix = label[..., 5:6]
+        label_cls = label[..., 6:]
+
+        # loss ciou, positive cells only
+        obj = label_obj_mask[..., 0] > 0
+        ciou = box_iou_xywh(p_d_xywh[obj], label_xywh[obj], 'ciou').unsqueeze(-1)
+        bbox_loss_scale = 2.0 - 1.0 * label_xywh[obj][:, 2:3] * label_xywh[obj][:, 3:4] / \
+                          (img_size.expand(batch_size, -1, -1)[obj] ** 2)
+        loss_ciou = label_obj_mask[obj] * bbox_loss_scale * (1.0 - ciou) * label_mix[obj]
+
+        # loss confidence, obj and noobj terms share the focal loss
+        label_noobj_mask = (1.0 - label_obj_mask) * torch.cat(noobj, 1)
+        loss_conf = (label_obj_mask + label_noobj_mask) * self.__focal(input=p_conf, target=label_obj_mask) * label_mix
+
+        # loss classes
+        loss_cls = label_obj_mask * self.__bce(input=p_cls, target=label_cls) * label_mix
+
+        loss_ciou = (torch.sum(loss_ciou)) / batch_size
+        loss_conf = (torch.sum(loss_conf)) / batch_size
+        loss_cls = (torch.sum(loss_cls)) / batch_size
+        loss = loss_ciou + loss_conf + loss_cls
+
+        return loss, loss_ciou, loss_conf, loss_cls
+
+    @staticmethod
+    def __rows(tensors):
+        """
+        [bs, grid, grid, anchors, C] tensors concatenated to [bs, sum(grid*grid*anchors), C]
+        """
+        return torch.cat([t.reshape(t.shape[0], -1, t.shape[-1]) for t in tensors], 1)
+
+
+class YoloV4SparseLoss(nn.Module):
+    """
+    YoloV4Loss on the sparse targets of utils.datasets.sparse_collate. The CIoU and class
+    losses gather the predictions at the assigned anchors instead of multiplying the whole
+    grid by dense masks; only the confidence loss, which covers every cell, stays dense.
+    """
+    def __init__(self, anchors, strides, iou_threshold_loss=0.5, label_smooth_delta=0.01):
+        super(YoloV4SparseLoss, self).__init__()
+        self.__iou_threshold_loss = iou_threshold_loss
+        self.__strides = strides
+        self.__delta = label_smooth_delta
+        self.__bce = nn.BCEWithLogitsLoss(reduction="none")
+        self.__focal = FocalLoss(gamma=2, alpha=1.0, reduction="none")
+
+    def forward(self, p, p_d, targets, gt_bboxes):
+        """
+        :param p: Predicted offset values for three detection layers, see YoloV4Loss.
+        :param p_d: Decodeed predicted value, see YoloV4Loss.
+        :param targets: [R, (img, layer, yind, xind, anchor, x, y, w, h, class_ind, mix)]
+        :param gt_bboxes: [Q, (img, layer, x, y, w, h)] boxes of every layer for the ignore mask
+        """
+        loss_s, loss_s_ciou, loss_s_conf, loss_s_cls = self.__cal_loss_per_layer(0, p[0], p_d[0], targets, gt_bboxes)
+        loss_m, loss_m_ciou, loss_m_conf, loss_m_cls = self.__cal_loss_per_layer(1, p[1], p_d[1], targets, gt_bboxes)
+        loss_l, loss_l_ciou, loss_l_conf, loss_l_cls = self.__cal_loss_per_layer(2, p[2], p_d[2], targets, gt_bboxes)
+
+        loss = loss_l + loss_m + loss_s
+        loss_ciou = loss_s_ciou + loss_m_ciou + loss_l_ciou
+        loss_conf = loss_s_conf + loss_m_conf + loss_l_conf
+        loss_cls = loss_s_cls + loss_m_cls + loss_l_cls
+
+        return loss, loss_ciou, loss_conf, loss_cls
+
+    def __cal_loss_per_layer(self, layer, p, p_d, targets, gt_bboxes):
+        batch_size, grid = p.shape[:2]
+        num_classes = p.shape[-1] - 5
+        img_size = self.__strides[layer] * grid
+
+        t = targets[targets[:, 1] == layer]
+        img_ind, yind, xind, anchor = t[:, 0].long(), t[:, 2].long(), t[:, 3].long(), t[:, 4].long()
+        label_xywh = t[:, 5:9]
+        label_mix = t[:, 10:11]
+
+        # loss ciou, assigned anchors only
+        ciou = box_iou_xywh(p_d[img_ind, yind, xind, anchor, :4], label_xywh, 'ciou').unsqueeze(-1)
+        bbox_loss_scale = 2.0 - 1.0 * label_xywh[:, 2:3] * label_xywh[:, 3:4] / (img_size ** 2)
+        loss_ciou = bbox_loss_scale * (1.0 - ciou) * label_mix
+
+        # loss classes, assigned anchors only, smoothed one-hot like dataAug.LabelSmooth
+        one_hot = torch.zeros((len(t), num_classes), device=p.device).scatter_(1, t[:, 9:10].long(), 1.0)
+        label_cls = one_hot * (1 - self.__delta) + self.__delta * 1.0 / num_classes
+        loss_cls = self.__bce(input=p[img_ind, yind, xind, anchor, 5:], target=label_cls) * label_mix
+
+        # loss confidence
+        p_conf = p[..., 4:5]
+        label_obj_mask = torch.zeros_like(p_conf)
+        label_obj_mask[img_ind, yind, xind, anchor] = 1.0
+        label_mix_grid = torch.ones_like(p_conf)
+        label_mix_grid[img_ind, yind, xind, anchor] = label_mix
+        bboxes = self.__pad_bboxes(gt_bboxes[gt_bboxes[:, 1] == layer], batch_size)
+        label_noobj_mask = (1.0 - label_obj_mask) * (iou_max(p_d[..., :4], bboxes) < self.__iou_threshold_loss).float()
+
+        loss_conf = (label_obj_mask * self.__focal(input=p_conf, target=label_obj_mask) +
+                    label_noobj_mask * self.__focal(input=p_conf, target=label_obj_mask)) * label_mix_grid
+
+        loss_ciou = (torch.sum(loss_ciou)) / batch_size
+        loss_conf = (torch.sum(loss_conf)) / batch_size
+        loss_cls = (torch.sum(loss_cls)) / batch_size
+        loss = loss_ciou + loss_conf + loss_cls
+
+        return loss, loss_ciou, loss_conf, loss_cls
+
+    def __pad_bboxes(self, gt_bboxes, batch_size):
+        """
+        The GT boxes of every image padded to the largest count of the batch instead of 150 slots.
+        :return: [bs, max_count, 4] for iou_max
+        """
+        img_ind = gt_bboxes[:, 0].long()
+        counts = torch.bincount(img_ind, minlength=batch_size)
+        max_count = int(counts.max()) if len(gt_bboxes) else 0
+        slot = torch.arange(len(gt_bboxes), device=gt_bboxes.device) - (torch.cumsum(counts, 0) - counts)[img_ind]
+        bboxes = torch.zeros((batch_size, max_count, 4), device=gt_bboxes.device)
+        bboxes[img_ind, slot] = gt_bboxes[:, 2:6]
+        return bboxes
+
 
 if __name__ == "__main__":
     from model.build_model import Yolov4
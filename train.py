@@ -1,12 +1,14 @@
 import logging
 import utils.gpu as gpu
 from model.build_model import Build_Model
-from model.loss.yolo_loss import YoloV4Loss
+from model.loss.yolo_loss import YoloV4Loss, YoloV4SparseLoss
 import torch
 import torch.optim as optim
 from torch.utils.data import DataLoader
 import utils.datasets as data
+from utils.batch_augment import BatchAugment
 import time
+import shutil
 import random
 import argparse
 from eval.evaluator import *
@@ -19,6 +21,7 @@ from utils.log import Logger
 
 from eval_coco import *
 from eval.cocoapi_evaluator import COCOAPIEvaluator
+from eval.async_eval import AsyncEvaluator
 
 
 def detection_collate(batch):
@@ -43,20 +46,35 @@ class Trainer(object):
         if self.multi_scale_train:print('Using multi scales training')
         else:print('train img size is {}'.format(cfg.TRAIN["TRAIN_IMG_SIZE"]))
         self.train_dataset = data.Build_Dataset(anno_file_type="train", img_size=cfg.TRAIN["TRAIN_IMG_SIZE"])
+        self.sparse_label = self.train_dataset.sparse_label
+        if self.train_dataset.batch_augment:
+            collate_fn = data.raw_collate
+        else:
+            collate_fn = data.sparse_collate if self.sparse_label else None
         self.epochs = cfg.TRAIN["YOLO_EPOCHS"] if cfg.MODEL_TYPE["TYPE"] == 'YOLOv4' else cfg.TRAIN["Mobilenet_YOLO_EPOCHS"]
         self.train_dataloader = DataLoader(self.train_dataset,
                                            batch_size=cfg.TRAIN["BATCH_SIZE"],
                                            num_workers=cfg.TRAIN["NUMBER_WORKERS"],
-                                           shuffle=True, pin_memory=True
+                                           shuffle=True, pin_memory=True,
+                                           collate_fn=collate_fn
                                            )
 
         self.yolov4 = Build_Model(weight_path=weight_path, resume=resume).to(self.device)
+        self.batch_augment = None
+        if self.train_dataset.batch_augment:
+            self.batch_augment = BatchAugment(cfg.MODEL["ANCHORS"], cfg.MODEL["STRIDES"], self.train_dataset.num_classes,
+                                              cfg.MODEL["ANCHORS_PER_SCLAE"], device=self.device)
 
         self.optimizer = optim.SGD(self.yolov4.parameters(), lr=cfg.TRAIN["LR_INIT"],
                                    momentum=cfg.TRAIN["MOMENTUM"], weight_decay=cfg.TRAIN["WEIGHT_DECAY"])
 
-        self.criterion = YoloV4Loss(anchors=cfg.MODEL["ANCHORS"], strides=cfg.MODEL["STRIDES"],
-                                    iou_threshold_loss=cfg.TRAIN["IOU_THRESHOLD_LOSS"])
+        if self.sparse_label:
+            self.criterion = YoloV4SparseLoss(anchors=cfg.MODEL["ANCHORS"], strides=cfg.MODEL["STRIDES"],
+                                              iou_threshold_loss=cfg.TRAIN["IOU_THRESHOLD_LOSS"])
+        else:
+            self.criterion = YoloV4Loss(anchors=cfg.MODEL["ANCHORS"], strides=cfg.MODEL["STRIDES"],
+                                        iou_threshold_loss=cfg.TRAIN["IOU_THRESHOLD_LOSS"],
+                                        fused=cfg.TRAIN["FUSED_LOSS"])
 
         self.scheduler = cosine_lr_scheduler.CosineDecayLR(self.optimizer,
                                                           T_max=self.epochs*len(self.train_dataloader),
@@ -64,6 +82,7 @@ class Trainer(object):
                                                           lr_min=cfg.TRAIN["LR_END"],
                                                           warmup=cfg.TRAIN["WARMUP_EPOCHS"]*len(self.train_dataloader))
         if resume: self.__load_resume_weights(weight_path)
+        self.async_eval = None
 
     def __load_resume_weights(self, weight_path):
 
@@ -78,7 +97,11 @@ class Trainer(object):
         del chkpt
 
     def __save_model_weights(self, epoch, mAP):
-        if mAP > self.best_mAP:
+        """
+        :param mAP: mAP of the full test set, None when it was not evaluated (only last.pt and
+                    the backups are saved)
+        """
+        if mAP is not None and mAP > self.best_mAP:
             self.best_mAP = mAP
         best_weight = os.path.join(os.path.split(self.weight_path)[0], "best.pt")
         last_weight = os.path.join(os.path.split(self.weight_path)[0], "last.pt")
@@ -95,6 +118,31 @@ class Trainer(object):
             torch.save(chkpt, os.path.join(os.path.split(self.weight_path)[0], 'backup_epoch%g.pt'%epoch))
         del chkpt
 
+    def __handle_eval_result(self, result):
+        """
+        Log a result of the background evaluation and copy its snapshot to best.pt when it is the
+        best so far.
+        """
+        epoch = result['epoch']
+        if 'error' in result:
+            logger.error("  ===evaluation of epoch {} failed:\n{}".format(epoch, result['error']))
+        else:
+            if 'APs' in result:
+                for i in result['APs']:
+                    logger.info("{} --> mAP : {}".format(i, result['APs'][i]))
+                logger.info("  ===epoch {} test mAP:{:.3f}, inference time: {:.2f} ms".format(
+                    epoch, result['mAP'], result['inference_time']))
+                writer.add_scalar('mAP', result['mAP'], epoch)
+            else:
+                logger.info('  ===epoch {} ap50_95:{}|ap50:{}'.format(epoch, result['ap50_95'], result['ap50']))
+                writer.add_scalar('val/COCOAP50', result['ap50'], epoch)
+                writer.add_scalar('val/COCOAP50_95', result['ap50_95'], epoch)
+            if result['mAP'] > self.best_mAP:
+                self.best_mAP = result['mAP']
+                shutil.copyfile(result['path'], os.path.join(os.path.split(self.weight_path)[0], "best.pt"))
+                logger.info('  ===best weights from epoch {}'.format(epoch))
+        os.remove(result['path'])
+
 
 
     def train(self):
@@ -105,27 +153,33 @@ class Trainer(object):
 
         if self.fp_16: self.yolov4, self.optimizer = amp.initialize(self.yolov4, self.optimizer, opt_level='O1', verbosity=0)
         logger.info("        =======  start  training   ======     ")
+        if cfg.VAL["ASYNC_EVAL"]:
+            self.async_eval = AsyncEvaluator(os.path.join(os.path.split(self.weight_path)[0], 'eval_snapshots'),
+                                             data_type=cfg.TRAIN["DATA_TYPE"], device=cfg.VAL["ASYNC_EVAL_DEVICE"],
+                                             num_threads=cfg.VAL["ASYNC_EVAL_THREADS"],
+                                             max_pending=cfg.VAL["ASYNC_EVAL_PENDING"])
         for epoch in range(self.start_epoch, self.epochs):
             start = time.time()
             self.yolov4.train()
 
             mloss = torch.zeros(4)
             logger.info("===Epoch:[{}/{}]===".format(epoch, self.epochs))
-            for i, (imgs, label_sbbox, label_mbbox, label_lbbox, sbboxes, mbboxes, lbboxes)  in enumerate(self.train_dataloader):
+            for i, batch in enumerate(self.train_dataloader):
                 self.scheduler.step(len(self.train_dataloader)/(cfg.TRAIN["BATCH_SIZE"])*epoch + i)
 
-                imgs = imgs.to(self.device)
-                label_sbbox = label_sbbox.to(self.device)
-                label_mbbox = label_mbbox.to(self.device)
-                label_lbbox = label_lbbox.to(self.device)
-                sbboxes = sbboxes.to(self.device)
-                mbboxes = mbboxes.to(self.device)
-                lbboxes = lbboxes.to(self.device)
-
+                if self.batch_augment is not None:
+                    batch = self.batch_augment.build_batch(batch, self.train_dataset.img_size, sparse=self.sparse_label)
+                imgs = batch[0].to(self.device)
                 p, p_d = self.yolov4(imgs)
 
-                loss, loss_ciou, loss_conf, loss_cls = self.criterion(p, p_d, label_sbbox, label_mbbox,
-                                                  label_lbbox, sbboxes, mbboxes, lbboxes)
+                if self.sparse_label:
+                    targets, gt_bboxes = batch[1].to(self.device), batch[2].to(self.device)
+                    loss, loss_ciou, loss_conf, loss_cls = self.criterion(p, p_d, targets, gt_bboxes)
+                else:
+                    label_sbbox, label_mbbox, label_lbbox, sbboxes, mbboxes, lbboxes = \
+                        [t.to(self.device) for t in batch[1:7]]
+                    loss, loss_ciou, loss_conf, loss_cls = self.criterion(p, p_d, label_sbbox, label_mbbox,
+                                                      label_lbbox, sbboxes, mbboxes, lbboxes)
 
                 if self.fp_16:
                     with amp.scale_loss(loss, self.optimizer) as scaled_loss:
@@ -160,20 +214,37 @@ class Trainer(object):
                     self.train_dataset.img_size = random.choice(range(10, 20)) * 32
 
 
-            if cfg.TRAIN["DATA_TYPE"] == 'VOC' or cfg.TRAIN["DATA_TYPE"] == 'Customer':
+            if self.async_eval is not None:
+                # evaluated by the worker while the next epoch trains
+                for result in self.async_eval.submit(epoch, self.yolov4):
+                    self.__handle_eval_result(result)
+                self.__save_model_weights(epoch, None)
+            elif cfg.TRAIN["DATA_TYPE"] == 'VOC' or cfg.TRAIN["DATA_TYPE"] == 'Customer':
                 mAP = 0.
                 if epoch >= 0:
                     logger.info("===== Validate =====".format(epoch, self.epochs))
                     with torch.no_grad():
-                        APs, inference_time = Evaluator(self.yolov4, showatt=False).APs_voc()
-                        for i in APs:
-                            logger.info("{} --> mAP : {}".format(i, APs[i]))
-                            mAP += APs[i]
-                        mAP = mAP / self.train_dataset.num_classes
-                        logger.info("mAP : {}".format(mAP))
+                        evaluator = Evaluator(self.yolov4, showatt=False)
+                        if cfg.VAL["SEQUENTIAL_VAL"]:
+                            APs, mAP, inference_time, info = evaluator.APs_voc_sequential(self.best_mAP)
+                            logger.info("subset mAP : {:.4f}, {:.0%} interval [{:.4f}, {:.4f}] on {} images, "
+                                        "best mAP : {:.4f} --> {}".format(
+                                info['subset_mAP'], cfg.VAL["SEQUENTIAL_CONFIDENCE"], info['interval'][0],
+                                info['interval'][1], info['subset_images'], self.best_mAP,
+                                'full test set' if info['full'] else 'stop on the subset'))
+                            writer.add_scalar('mAP_subset', info['subset_mAP'], epoch)
+                        else:
+                            APs, inference_time = evaluator.APs_voc()
+                        if APs is not None:
+                            mAP = 0.
+                            for i in APs:
+                                logger.info("{} --> mAP : {}".format(i, APs[i]))
+                                mAP += APs[i]
+                            mAP = mAP / self.train_dataset.num_classes
+                            logger.info("mAP : {}".format(mAP))
+                            writer.add_scalar('mAP', mAP, epoch)
                         logger.info("inference time: {:.2f} ms".format(inference_time))
-                        writer.add_scalar('mAP', mAP, epoch)
-                        self.__save_model_weights(epoch, mAP)
+                        self.__save_model_weights(epoch, mAP if APs is not None else None)
                         logger.info('save weights done')
                     logger.info("  ===test mAP:{:.3f}".format(mAP))
             elif epoch >= 0 and cfg.TRAIN["DATA_TYPE"] == 'COCO':
@@ -188,8 +259,16 @@ class Trainer(object):
                 writer.add_scalar('val/COCOAP50_95', ap50_95, epoch)
                 self.__save_model_weights(epoch, ap50)
                 print('save weights done')
+            image_cache_stats = self.train_dataset.image_cache_stats()
+            if image_cache_stats is not None:
+                logger.info("  ===image cache: hit rate {:.1%}, {} evictions, {}/{} images cached".format(
+                    image_cache_stats['hit_rate'], image_cache_stats['evictions'], image_cache_stats['cached'],
+                    image_cache_stats['slots']))
             end = time.time()
             logger.info("  ===cost time:{:.4f}s".format(end - start))
+        if self.async_eval is not None:
+            for result in self.async_eval.close():
+                self.__handle_eval_result(result)
         logger.info("=====Training Finished.   best_test_mAP:{:.3f}%====".format(self.best_mAP))
 
 
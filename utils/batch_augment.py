@@ -0,0 +1,131 @@
+# coding=utf-8
+"""
+Batched augmentation on the training device.
+
+The train transforms of Build_Dataset (RandomHorizontalFilp, RandomCrop, RandomAffine, Resize and
+Mixup of utils.data_augment) are all affine maps of the pixel grid. BatchAugment draws their random
+parameters per sample with dataAug.ComposedAffine.sample, exactly like the cv2 transforms do, so the
+boxes are identical to the per-sample pipeline. The images are not warped step by step; the four
+maps are composed into one sampling grid and the whole uint8 batch is resampled by a single
+grid_sample call, on the GPU when the batch lives there.
+
+The image is interpolated once instead of twice (warpAffine + resize), so pixel values differ
+slightly from the cv2 pipeline at object edges.
+"""
+import random
+import numpy as np
+import torch
+import torch.nn.functional as F
+import utils.data_augment as dataAug
+from utils.label_assign import assign_labels, densify_labels, sparse_targets
+
+
+class BatchAugment(object):
+    def __init__(self, anchors, strides, num_classes, anchors_per_scale=3, device='cpu', p=0.5):
+        self.anchors = anchors
+        self.strides = strides
+        self.num_classes = num_classes
+        self.anchors_per_scale = anchors_per_scale
+        self.device = device
+        self.p = p
+
+    def __call__(self, imgs, bboxes, imgs_mix, bboxes_mix, img_size):
+        """
+        :param imgs: list of BGR uint8 images [H, W, 3] of any size
+        :param bboxes: list of [n, (xmin, ymin, xmax, ymax, class_ind)] boxes of imgs
+        :param imgs_mix: images mixed into imgs, see dataAug.Mixup
+        :param bboxes_mix: boxes of imgs_mix
+        :param img_size: input size of the network
+        :return: imgs [B, 3, img_size, img_size] RGB float in [0, 1] on self.device,
+                 list of [n, (xmin, ymin, xmax, ymax, class_ind, mix)] boxes
+        """
+        batch_size = len(imgs)
+        affine = dataAug.ComposedAffine((img_size, img_size), self.p)
+        params, out_bboxes = [], []
+        for img, bbox, img_mix, bbox_mix in zip(imgs, bboxes, imgs_mix, bboxes_mix):
+            bbox, bbox_mix = np.copy(bbox), np.copy(bbox_mix)
+            param_org = affine.sample(img.shape, bbox)
+            param_mix = affine.sample(img_mix.shape, bbox_mix)
+            lam, bbox = self.__mixup(bbox, bbox_mix)
+            params.append(param_org + (lam,))
+            params.append(param_mix + (1 - lam,))
+            out_bboxes.append(bbox)
+
+        out = self.__warp(list(sum(zip(imgs, imgs_mix), ())), params, img_size)
+        lam = torch.tensor([p[-1] for p in params], dtype=out.dtype, device=out.device).view(-1, 1, 1, 1)
+        out = (out * lam).view(batch_size, 2, 3, img_size, img_size).sum(1)
+        return out, out_bboxes
+
+    def __mixup(self, bboxes_org, bboxes_mix):
+        """
+        dataAug.Mixup on the boxes.
+        :return: lam, mixed boxes with the mix column
+        """
+        if random.random() > self.p:
+            lam = np.random.beta(1.5, 1.5)
+            bboxes_org = np.concatenate([bboxes_org, np.full((len(bboxes_org), 1), lam)], axis=1)
+            bboxes_mix = np.concatenate([bboxes_mix, np.full((len(bboxes_mix), 1), 1 - lam)], axis=1)
+            return lam, np.concatenate([bboxes_org, bboxes_mix])
+        return 1.0, np.concatenate([bboxes_org, np.full((len(bboxes_org), 1), 1.0)], axis=1)
+
+    def __warp(self, imgs, params, img_size):
+        """
+        Resample every image once with its composed map. For an output pixel u of the letterbox:
+            x_frame = (u - dw + 0.5) * w_crop / resize_w - 0.5   (cv2.resize)
+            x_crop  = x_frame - tx                                 (warpAffine, 0 outside the frame)
+            x_img   = x_crop + crop_xmin, mirrored when flipped
+        and 128 outside of the resized area.
+        """
+        h_max = max(img.shape[0] for img in imgs)
+        w_max = max(img.shape[1] for img in imgs)
+        batch = torch.zeros((len(imgs), h_max, w_max, 3), dtype=torch.uint8)
+        for i, img in enumerate(imgs):
+            batch[i, :img.shape[0], :img.shape[1]] = torch.from_numpy(np.ascontiguousarray(img))
+        batch = batch.to(self.device, non_blocking=True).permute(0, 3, 1, 2)[:, [2, 1, 0]].float()  # BGR->RGB
+
+        params = torch.tensor([p[:-1] for p in params], dtype=torch.float64)
+        w_img, h_img, flip, crop_xmin, crop_ymin, tx, ty, resize_w, resize_h, dw, dh = params.unbind(1)
+        u = torch.arange(img_size, dtype=torch.float64)
+        x_crop = (u - dw[:, None] + 0.5) * ((w_img - crop_xmin) / resize_w)[:, None] - 0.5 - tx[:, None]
+        y_crop = (u - dh[:, None] + 0.5) * ((h_img - crop_ymin) / resize_h)[:, None] - 0.5 - ty[:, None]
+        x_img = x_crop + crop_xmin[:, None]
+        x_img = torch.where(flip[:, None] > 0, w_img[:, None] - 1 - x_img, x_img)
+        y_img = y_crop + crop_ymin[:, None]
+
+        # masks of the letterbox area and of the frame the translation keeps
+        x_in = (u >= dw[:, None]) & (u < (dw + resize_w)[:, None])
+        y_in = (u >= dh[:, None]) & (u < (dh + resize_h)[:, None])
+        x_frame = (x_crop > -0.5) & (x_crop < (w_img - crop_xmin)[:, None] - 0.5)
+        y_frame = (y_crop > -0.5) & (y_crop < (h_img - crop_ymin)[:, None] - 0.5)
+
+        grid = torch.stack([((2 * x_img + 1) / w_max - 1)[:, None, :].expand(-1, img_size, -1),
+                            ((2 * y_img + 1) / h_max - 1)[:, :, None].expand(-1, -1, img_size)], dim=-1)
+        out = F.grid_sample(batch, grid.to(batch), mode='bilinear', padding_mode='zeros', align_corners=False)
+        frame = (y_frame[:, :, None] & x_frame[:, None, :]).to(out)
+        letterbox = (y_in[:, :, None] & x_in[:, None, :]).to(out.device)
+        out = torch.where(letterbox[:, None], out * frame[:, None], torch.full_like(out, 128.0))
+        return out / 255.0  # normalize to [0, 1]
+
+    def build_batch(self, batch, img_size, sparse=False):
+        """
+        Augment a batch of Build_Dataset.raw_collate and assign its labels.
+        :return: the batch that the DataLoader yields without batch augmentation, i.e.
+                 (imgs, label_sbbox, label_mbbox, label_lbbox, sbboxes, mbboxes, lbboxes, img_names), or
+                 (imgs, targets, gt_bboxes, img_names) of utils.datasets.sparse_collate when sparse
+        """
+        imgs_org, bboxes_org, imgs_mix, bboxes_mix, img_names = batch
+        imgs, bboxes = self(imgs_org, bboxes_org, imgs_mix, bboxes_mix, img_size)
+
+        assignments = [assign_labels(bbox, self.anchors, self.strides, self.anchors_per_scale) for bbox in bboxes]
+        if sparse:
+            targets, gt_bboxes = [], []
+            for i, ((rows, layer_boxes), bbox) in enumerate(zip(assignments, bboxes)):
+                target, gt_bbox = sparse_targets(rows, layer_boxes, bbox)
+                targets.append(torch.cat([torch.full((len(target), 1), float(i)), target], 1))
+                gt_bboxes.append(torch.cat([torch.full((len(gt_bbox), 1), float(i)), gt_bbox], 1))
+            return imgs, torch.cat(targets, 0), torch.cat(gt_bboxes, 0), img_names
+
+        labels = [densify_labels(rows, layer_boxes, bbox, img_size, self.num_classes, self.strides,
+                                 self.anchors_per_scale) for (rows, layer_boxes), bbox in zip(assignments, bboxes)]
+        labels = [torch.stack(label, 0) for label in zip(*labels)]
+        return (imgs,) + tuple(labels) + (img_names,)
@@ -0,0 +1,161 @@
+# coding=utf-8
+"""
+GIoU, DIoU and CIoU of (x, y, w, h) boxes as torch.autograd.Function with an analytic backward.
+
+tools.GIOU_xywh_torch/CIOU_xywh_torch build every term from a dozen intermediate tensors that
+autograd keeps until the backward pass. These functions only save the two input boxes; the
+backward recomputes the terms and applies the chain rule by hand, so the memory of the loss graph
+is that of the inputs. The values are the same as the tools functions (same corner sorting,
+clamps and formulas), and the gradients are those of autograd through them, ties of min/max
+included.
+"""
+import math
+import torch
+
+KINDS = ('giou', 'diou', 'ciou')
+
+
+def _max_weight(a, b):
+    """
+    d max(a, b) / da, ties split like torch.max
+    """
+    return (a > b).to(a.dtype) + 0.5 * (a == b).to(a.dtype)
+
+
+class _Axis(object):
+    """
+    Corners of the two boxes along x (axis 0) or y (axis 1) and the intervals built from them.
+    """
+    def __init__(self, boxes1, boxes2, axis):
+        self.p1 = boxes1[..., axis] - boxes1[..., axis + 2] * 0.5
+        self.q1 = boxes1[..., axis] + boxes1[..., axis + 2] * 0.5
+        self.p2 = boxes2[..., axis] - boxes2[..., axis + 2] * 0.5
+        self.q2 = boxes2[..., axis] + boxes2[..., axis + 2] * 0.5
+        self.l1, self.r1 = torch.min(self.p1, self.q1), torch.max(self.p1, self.q1)
+        self.l2, self.r2 = torch.min(self.p2, self.q2), torch.max(self.p2, self.q2)
+        self.size1 = self.r1 - self.l1
+        self.size2 = self.r2 - self.l2
+        self.inter_raw = torch.min(self.r1, self.r2) - torch.max(self.l1, self.l2)
+        self.inter = self.inter_raw.clamp(min=0)
+        self.outer_raw = torch.max(self.r1, self.r2) - torch.min(self.l1, self.l2)
+        self.outer = self.outer_raw.clamp(min=0)
+        self.center1 = (self.l1 + self.r1) * 0.5
+        self.center2 = (self.l2 + self.r2) * 0.5
+
+    def backward(self, g_size1, g_size2, g_inter, g_outer, g_center1, g_center2):
+        """
+        :return: gradients of the (center, size) input columns of both boxes
+        """
+        g_inter_raw = g_inter * _max_weight(self.inter_raw, torch.zeros_like(self.inter_raw))
+        g_outer_raw = g_outer * _max_weight(self.outer_raw, torch.zeros_like(self.outer_raw))
+        # inter_raw = min(r1, r2) - max(l1, l2), outer_raw = max(r1, r2) - min(l1, l2)
+        g_l1 = -g_size1 + 0.5 * g_center1 - g_inter_raw * _max_weight(self.l1, self.l2) \
+               - g_outer_raw * _max_weight(self.l2, self.l1)
+        g_r1 = g_size1 + 0.5 * g_center1 + g_inter_raw * _max_weight(self.r2, self.r1) \
+               + g_outer_raw * _max_weight(self.r1, self.r2)
+        g_l2 = -g_size2 + 0.5 * g_center2 - g_inter_raw * _max_weight(self.l2, self.l1) \
+               - g_outer_raw * _max_weight(self.l1, self.l2)
+        g_r2 = g_size2 + 0.5 * g_center2 + g_inter_raw * _max_weight(self.r1, self.r2) \
+               + g_outer_raw * _max_weight(self.r2, self.r1)
+        grads = []
+        for p, q, g_l, g_r in ((self.p1, self.q1, g_l1, g_r1), (self.p2, self.q2, g_l2, g_r2)):
+            # l = min(p, q), r = max(p, q), p = center - size / 2, q = center + size / 2
+            g_p = g_l * _max_weight(q, p) + g_r * _max_weight(p, q)
+            g_q = g_l * _max_weight(p, q) + g_r * _max_weight(q, p)
+            grads.append((g_p + g_q, 0.5 * (g_q - g_p)))
+        return grads
+
+
+class _Terms(object):
+    def __init__(self, boxes1, boxes2, kind):
+        self.ax, self.ay = _Axis(boxes1, boxes2, 0), _Axis(boxes1, boxes2, 1)
+        ax, ay = self.ax, self.ay
+        self.inter = ax.inter * ay.inter
+        self.union = ax.size1 * ay.size1 + ax.size2 * ay.size2 - self.inter
+        self.iou = 1.0 * self.inter / self.union
+        if kind == 'giou':
+            self.enclose = ax.outer * ay.outer
+            self.value = self.iou - (self.enclose - self.union) / self.enclose
+            return
+        self.c2 = torch.pow(ax.outer, 2) + torch.pow(ay.outer, 2)
+        self.rho2 = torch.pow(ax.center1 - ax.center2, 2) + torch.pow(ay.center1 - ay.center2, 2)
+        if kind == 'diou':
+            self.value = self.iou - self.rho2 / self.c2
+            return
+        self.w1, self.w2 = ax.size1.clamp(min=0), ax.size2.clamp(min=0)
+        self.h1, self.h2 = ay.size1.clamp(min=0), ay.size2.clamp(min=0)
+        self.ratio1 = self.w1 / torch.clamp(self.h1, min=1e-6)
+        self.ratio2 = self.w2 / torch.clamp(self.h2, min=1e-6)
+        self.atan_diff = torch.atan(self.ratio1) - torch.atan(self.ratio2)
+        self.v = (4 / (math.pi ** 2)) * torch.pow(self.atan_diff, 2)
+        self.alpha = self.v / (1 - self.iou + self.v)
+        self.value = self.iou - (self.rho2 / self.c2 + self.alpha * self.v)
+
+    def backward(self, g, kind):
+        ax, ay = self.ax, self.ay
+        zeros = torch.zeros_like(g)
+        g_iou, g_union = g, zeros
+        g_outer_x, g_outer_y = zeros, zeros
+        g_center_x, g_center_y = zeros, zeros
+        g_w1, g_h1, g_w2, g_h2 = zeros, zeros, zeros, zeros
+        if kind == 'giou':
+            # value = iou - 1 + union / enclose
+            g_union = g / self.enclose
+            g_enclose = -g * self.union / torch.pow(self.enclose, 2)
+            g_outer_x, g_outer_y = g_enclose * ay.outer, g_enclose * ax.outer
+        else:
+            g_c2 = g * self.rho2 / torch.pow(self.c2, 2)
+            g_rho2 = -g / self.c2
+            g_outer_x, g_outer_y = 2 * ax.outer * g_c2, 2 * ay.outer * g_c2
+            g_center_x = 2 * (ax.center1 - ax.center2) * g_rho2
+            g_center_y = 2 * (ay.center1 - ay.center2) * g_rho2
+        if kind == 'ciou':
+            # alpha * v = v ** 2 / (1 - iou + v)
+            g_iou = g * (1 - torch.pow(self.alpha, 2))
+            g_v = -g * (2 * self.alpha - torch.pow(self.alpha, 2))
+            g_atan1 = g_v * (8 / (math.pi ** 2)) * self.atan_diff
+            g_size = []
+            for g_atan, ratio, w, h, size_w, size_h in ((g_atan1, self.ratio1, self.w1, self.h1, ax.size1, ay.size1),
+                                                        (-g_atan1, self.ratio2, self.w2, self.h2, ax.size2, ay.size2)):
+                h_clamped = torch.clamp(h, min=1e-6)
+                g_ratio = g_atan / (1 + torch.pow(ratio, 2))
+                g_w = g_ratio / h_clamped
+                g_h = -g_ratio * ratio / h_clamped * (h >= 1e-6).to(g.dtype)
+                g_size.append((g_w * _max_weight(size_w, torch.zeros_like(size_w)),
+                               g_h * _max_weight(size_h, torch.zeros_like(size_h))))
+            (g_w1, g_h1), (g_w2, g_h2) = g_size
+        # iou = inter / union, union = area1 + area2 - inter
+        g_union = g_union - g_iou * self.inter / torch.pow(self.union, 2)
+        g_inter = g_iou / self.union - g_union
+        g_size1_x, g_size1_y = g_union * ay.size1 + g_w1, g_union * ax.size1 + g_h1
+        g_size2_x, g_size2_y = g_union * ay.size2 + g_w2, g_union * ax.size2 + g_h2
+        (g_x1, g_sw1), (g_x2, g_sw2) = ax.backward(g_size1_x, g_size2_x, g_inter * ay.inter, g_outer_x,
+                                                   g_center_x, -g_center_x)
+        (g_y1, g_sh1), (g_y2, g_sh2) = ay.backward(g_size1_y, g_size2_y, g_inter * ax.inter, g_outer_y,
+                                                   g_center_y, -g_center_y)
+        return torch.stack([g_x1, g_y1, g_sw1, g_sh1], -1), torch.stack([g_x2, g_y2, g_sw2, g_sh2], -1)
+
+
+class BoxIoUFunction(torch.autograd.Function):
+    @staticmethod
+    def forward(ctx, boxes1, boxes2, kind):
+        ctx.kind = kind
+        ctx.save_for_backward(boxes1, boxes2)
+        return _Terms(boxes1, boxes2, kind).value
+
+    @staticmethod
+    def backward(ctx, grad_output):
+        boxes1, boxes2 = ctx.saved_tensors
+        g1, g2 = _Terms(boxes1, boxes2, ctx.kind).backward(grad_output, ctx.kind)
+        return g1 if ctx.needs_input_grad[0] else None, g2 if ctx.needs_input_grad[1] else None, None
+
+
+def box_iou_xywh(boxes1, boxes2, kind='ciou'):
+    """
+    :param boxes1, boxes2: [..., (x, y, w, h)] broadcastable boxes
+    :param kind: 'giou' (tools.GIOU_xywh_torch), 'diou' or 'ciou' (tools.CIOU_xywh_torch)
+    :return: [...] IoUs of the broadcast shape
+    """
+    assert kind in KINDS, kind
+    shape = torch.broadcast_shapes(boxes1.shape, boxes2.shape)
+    return BoxIoUFunction.apply(boxes1.expand(shape), boxes2.expand(shape), kind)
@@ -100,6 +100,129 @@ class Resize(object):
         return image
 
 
+class ComposedAffine(object):
+    """
+    RandomHorizontalFilp -> RandomCrop -> RandomAffine -> Resize as one cv2.warpAffine.
+    The random parameters and the boxes are the same as the chain of the four transforms; the
+    image is interpolated once, from the original uint8 image into a reused uint8 letterbox
+    buffer, and only the final normalization allocates a float image.
+    """
+    def __init__(self, target_shape, p=0.5):
+        self.h_target, self.w_target = target_shape
+        self.p = p
+        self.__buffer = None
+
+    def sample(self, img_shape, bboxes):
+        """
+        Draw the random parameters in the order of the transform chain and move bboxes in place.
+        :return: (w_img, h_img, flip, crop_xmin, crop_ymin, tx, ty, resize_w, resize_h, dw, dh)
+        """
+        h_img, w_img = img_shape[:2]
+
+        # RandomHorizontalFilp
+        flip = random.random() < self.p
+        if flip:
+            bboxes[:, [0, 2]] = w_img - bboxes[:, [2, 0]]
+
+        # RandomCrop, crop_xmax/crop_ymax never cut the image so only the top left corner moves
+        crop_xmin, crop_ymin = 0, 0
+        if random.random() < self.p:
+            max_bbox = np.concatenate([np.min(bboxes[:, 0:2], axis=0), np.max(bboxes[:, 2:4], axis=0)], axis=-1)
+            crop_xmin = max(0, int(max_bbox[0] - random.uniform(0, max_bbox[0])))
+            crop_ymin = max(0, int(max_bbox[1] - random.uniform(0, max_bbox[1])))
+            random.uniform(0, w_img - max_bbox[2])
+            random.uniform(0, h_img - max_bbox[3])
+            bboxes[:, [0, 2]] = bboxes[:, [0, 2]] - crop_xmin
+            bboxes[:, [1, 3]] = bboxes[:, [1, 3]] - crop_ymin
+        w_crop, h_crop = w_img - crop_xmin, h_img - crop_ymin
+
+        # RandomAffine
+        tx, ty = 0., 0.
+        if random.random() < self.p:
+            max_bbox = np.concatenate([np.min(bboxes[:, 0:2], axis=0), np.max(bboxes[:, 2:4], axis=0)], axis=-1)
+            tx = random.uniform(-(max_bbox[0] - 1), (w_crop - max_bbox[2] - 1))
+            ty = random.uniform(-(max_bbox[1] - 1), (h_crop - max_bbox[3] - 1))
+            bboxes[:, [0, 2]] = bboxes[:, [0, 2]] + tx
+            bboxes[:, [1, 3]] = bboxes[:, [1, 3]] + ty
+
+        # Resize
+        resize_ratio = min(1.0 * self.w_target / w_crop, 1.0 * self.h_target / h_crop)
+        resize_w = int(resize_ratio * w_crop)
+        resize_h = int(resize_ratio * h_crop)
+        dw = int((self.w_target - resize_w) / 2)
+        dh = int((self.h_target - resize_h) / 2)
+        bboxes[:, [0, 2]] = bboxes[:, [0, 2]] * resize_ratio + dw
+        bboxes[:, [1, 3]] = bboxes[:, [1, 3]] * resize_ratio + dh
+
+        return w_img, h_img, flip, crop_xmin, crop_ymin, tx, ty, resize_w, resize_h, dw, dh
+
+    def __call__(self, img, bboxes):
+        bboxes = np.copy(bboxes)
+        w_img, h_img, flip, crop_xmin, crop_ymin, tx, ty, resize_w, resize_h, dw, dh = self.sample(img.shape, bboxes)
+        w_crop, h_crop = w_img - crop_xmin, h_img - crop_ymin
+
+        # the crop window as a view of the original image, it is mirrored by the matrix when flipped
+        src = img[crop_ymin:, :w_crop] if flip else img[crop_ymin:, crop_xmin:]
+        # pixel centres: x_frame = x_src (+ mirror) + tx, x_resized = (x_frame + 0.5) * sx - 0.5 (cv2.resize)
+        sx, sy = 1.0 * resize_w / w_crop, 1.0 * resize_h / h_crop
+        ax = -sx if flip else sx
+        bx = ((w_crop - 1 if flip else 0) + tx + 0.5) * sx - 0.5
+        by = (ty + 0.5) * sy - 0.5
+        M = np.array([[ax, 0, bx], [0, sy, by]])
+
+        if self.__buffer is None or self.__buffer.shape[:2] != (self.h_target, self.w_target):
+            self.__buffer = np.empty((self.h_target, self.w_target, 3), dtype=np.uint8)
+        self.__buffer.fill(128)
+        # warp into the letterbox area only, the translation border stays 0 like RandomAffine
+        cv2.warpAffine(src, M, (resize_w, resize_h), dst=self.__buffer[dh:dh + resize_h, dw:dw + resize_w],
+                       borderMode=cv2.BORDER_CONSTANT, borderValue=0)
+
+        image = cv2.cvtColor(self.__buffer, cv2.COLOR_BGR2RGB).astype(np.float32)
+        image *= 1.0 / 255.0  # normalize to [0, 1]
+        return image, bboxes
+
+
+class Mosaic(object):
+    """
+    Four images around a random centre of a target_shape gray canvas, each tile touches the centre
+    with one corner and is cut by the canvas. The tiles are placed at their own size, the caller
+    downscales them (see utils.tile_cache.TileCache). Boxes are clipped to the visible part of their
+    tile and dropped when less than min_side pixels remain. The image is normalized like Resize.
+    """
+    def __init__(self, target_shape, min_side=2):
+        self.h_target, self.w_target = target_shape
+        self.min_side = min_side
+
+    def __call__(self, tiles):
+        """
+        :param tiles: 4 (img, bboxes) uint8 BGR images, top left, top right, bottom left, bottom right
+        :return: RGB float image [h_target, w_target, 3] in [0, 1], bboxes
+        """
+        canvas = np.full((self.h_target, self.w_target, 3), 128, dtype=np.uint8)
+        xc = int(random.uniform(0.25 * self.w_target, 0.75 * self.w_target))
+        yc = int(random.uniform(0.25 * self.h_target, 0.75 * self.h_target))
+
+        mosaic_bboxes = []
+        for i, (img, bboxes) in enumerate(tiles):
+            h, w = img.shape[:2]
+            # position of the tile's top left pixel on the canvas
+            ox = xc - w if i in (0, 2) else xc
+            oy = yc - h if i in (0, 1) else yc
+            x1, y1 = max(ox, 0), max(oy, 0)
+            x2, y2 = min(ox + w, self.w_target), min(oy + h, self.h_target)
+            canvas[y1:y2, x1:x2] = img[y1 - oy:y2 - oy, x1 - ox:x2 - ox]
+
+            bboxes = np.array(bboxes, dtype=np.float64).reshape(-1, 5)
+            bboxes[:, [0, 2]] = np.clip(bboxes[:, [0, 2]] + ox, x1, x2)
+            bboxes[:, [1, 3]] = np.clip(bboxes[:, [1, 3]] + oy, y1, y2)
+            keep = ((bboxes[:, 2] - bboxes[:, 0]) >= self.min_side) & ((bboxes[:, 3] - bboxes[:, 1]) >= self.min_side)
+            mosaic_bboxes.append(bboxes[keep])
+
+        image = cv2.cvtColor(canvas, cv2.COLOR_BGR2RGB).astype(np.float32)
+        image *= 1.0 / 255.0  # normalize to [0, 1]
+        return image, np.concatenate(mosaic_bboxes)
+
+
 class Mixup(object):
     def __init__(self, p=0.5):
         self.p = p
@@ -14,6 +14,10 @@ import random
 
 import utils.data_augment as dataAug
 import utils.tools as tools
+from utils.label_assign import assign_labels, densify_labels, sparse_targets
+from utils.label_cache import LabelCache
+from utils.tile_cache import TileCache
+from utils.image_cache import ImageCache
 
 
 class Build_Dataset(Dataset):
@@ -29,6 +33,31 @@ class Build_Dataset(Dataset):
         self.class_to_id = dict(zip(self.classes, range(self.num_classes)))
         self.__annotations = self.__load_annotations(anno_file_type)
         self.anno_file_type = anno_file_type
+        # sparse targets for YoloV4SparseLoss, see sparse_collate (train set only)
+        self.sparse_label = cfg.TRAIN["SPARSE_LABEL"] and anno_file_type == 'train'
+        # raw images for utils.batch_augment.BatchAugment, see raw_collate (train set only)
+        self.batch_augment = cfg.TRAIN["BATCH_AUGMENT"] and anno_file_type == 'train'
+        self.__composed_aug = None
+        self.__tile_cache = None  # per worker, created on the first mosaic
+        self.__num_mosaic = 0
+        self.__image_cache = None
+        if cfg.TRAIN["IMAGE_CACHE"] and anno_file_type == 'train':
+            # decoded images shared by all workers, in RAM when /dev/shm exists and has room for them
+            disk_root = os.path.join(cfg.PROJECT_PATH, 'cache', 'images')
+            cache_root, fallback_root = disk_root, None
+            if os.path.isdir('/dev/shm'):
+                cache_root, fallback_root = '/dev/shm/yolov4_images', disk_root
+            self.__image_cache = ImageCache(os.path.join(cfg.PROJECT_PATH, anno_file_type+"_annotation.txt"),
+                                            anno_file_type, cache_root, len(self.__annotations),
+                                            cfg.TRAIN["IMAGE_CACHE_SIDE"], cfg.TRAIN["IMAGE_CACHE_MB"],
+                                            fallback_root=fallback_root)
+        self.__label_cache = None
+        if cfg.TRAIN["LABEL_CACHE"]:
+            # test samples are not augmented, so their whole label assignment is cached as well
+            self.__label_cache = LabelCache(os.path.join(cfg.PROJECT_PATH, anno_file_type+"_annotation.txt"),
+                                            anno_file_type, os.path.join(cfg.PROJECT_PATH, 'cache', 'labels'),
+                                            cfg.MODEL["ANCHORS"], cfg.MODEL["STRIDES"], self.num_classes,
+                                            cfg.MODEL["ANCHORS_PER_SCLAE"], with_assignment=(anno_file_type == 'test'))
 
     def __len__(self):
         return  len(self.__annotations)
@@ -37,13 +66,21 @@ class Build_Dataset(Dataset):
         assert item <= len(self), 'index range error'
 
 
+        if self.batch_augment:
+            img_org, bboxes_org, img_name = self.__load_item(item)
+            img_mix, bboxes_mix, _ = self.__load_item(random.randint(0, len(self.__annotations)-1))
+            return img_org, bboxes_org, img_mix, bboxes_mix, img_name
+
         if self.anno_file_type == 'train':
-            img_org, bboxes_org, img_name = self.__parse_annotation(self.__annotations[item])
-            img_org, bboxes_org = self.__data_aug(img_org, bboxes_org)
+            if cfg.TRAIN["MOSAIC"] > 0 and random.random() < cfg.TRAIN["MOSAIC"]:
+                img_org, bboxes_org, img_name = self.__mosaic(item)
+            else:
+                img_org, bboxes_org, img_name = self.__load_item(item)
+                img_org, bboxes_org = self.__data_aug(img_org, bboxes_org)
             img_org = img_org.transpose(2, 0, 1)  # HWC->CHW
 
             item_mix = random.randint(0, len(self.__annotations)-1)
-            img_mix, bboxes_mix, _ = self.__parse_annotation(self.__annotations[item_mix])
+            img_mix, bboxes_mix, _ = self.__load_item(item_mix)
             img_mix, bboxes_mix = self.__data_aug(img_mix, bboxes_mix)
             img_mix = img_mix.transpose(2, 0, 1)
 
@@ -51,7 +88,7 @@ class Build_Dataset(Dataset):
             del img_mix, bboxes_mix
             img_size = img.shape[1] # img must be square
         else:
-            img_org, bboxes_org, img_name = self.__parse_annotation(self.__annotations[item])
+            img_org, bboxes_org, img_name = self.__load_item(item)
             img_org = img_org.transpose(2, 0, 1)
             img = img_org
             bboxes = bboxes_org
@@ -60,15 +97,19 @@ class Build_Dataset(Dataset):
         del img_org, bboxes_org
 
 
-        label_sbbox, label_mbbox, label_lbbox, sbboxes, mbboxes, lbboxes = self.__creat_label(bboxes, img_size)
-
         img = torch.from_numpy(img).float()
-        label_sbbox = torch.from_numpy(label_sbbox).float()
-        label_mbbox = torch.from_numpy(label_mbbox).float()
-        label_lbbox = torch.from_numpy(label_lbbox).float()
-        sbboxes = torch.from_numpy(sbboxes).float()
-        mbboxes = torch.from_numpy(mbboxes).float()
-        lbboxes = torch.from_numpy(lbboxes).float()
+        if self.sparse_label:
+            rows, layer_boxes = assign_labels(bboxes, cfg.MODEL["ANCHORS"], cfg.MODEL["STRIDES"],
+                                              cfg.MODEL["ANCHORS_PER_SCLAE"])
+            targets, gt_bboxes = sparse_targets(rows, layer_boxes, bboxes)
+            return img, targets, gt_bboxes, img_name
+
+        # test samples are not augmented, their assignment can come from the cache
+        assignment = None
+        if self.__label_cache is not None and self.anno_file_type == 'test':
+            assignment = self.__label_cache.get_assignment(item)
+        label_sbbox, label_mbbox, label_lbbox, sbboxes, mbboxes, lbboxes = self.__creat_label(bboxes, img_size,
+                                                                                            assignment)
 
         return img, label_sbbox, label_mbbox, label_lbbox, sbboxes, mbboxes, lbboxes, img_name
 
@@ -83,23 +124,44 @@ class Build_Dataset(Dataset):
 
         return annotations
 
+    def __load_item(self, item):
+        if self.__label_cache is None:
+            img_path, bboxes = self.__parse_annotation(self.__annotations[item])
+        else:
+            img_path, bboxes = self.__label_cache.get_annotation(item)
+
+        if self.__image_cache is None:
+            img = cv2.imread(img_path)  # H*W*C and C=BGR
+            assert img is not None, 'File Not Found ' + img_path
+        else:
+            # read-only view of the shared cache, downscaled to IMAGE_CACHE_SIDE, the boxes follow
+            img, scale = self.__image_cache.get(item, img_path)
+            if scale != 1 and len(bboxes):
+                bboxes = np.array(bboxes, dtype=np.float64)
+                bboxes[:, :4] = bboxes[:, :4] * scale
+        return img, bboxes, img_path.split('/')[-1].strip('.jpg')
+
     def __parse_annotation(self, annotation):
         """
         Data augument.
         :param annotation: Image' path and bboxes' coordinates, categories.
         ex. [image_path xmin,ymin,xmax,ymax,class_ind xmin,ymin,xmax,ymax,class_ind ...]
-        :return: Return the enhanced image and bboxes. bbox'shape is [xmin, ymin, xmax, ymax, class_ind]
+        :return: Return the image path and bboxes. bbox'shape is [xmin, ymin, xmax, ymax, class_ind]
         """
         anno = annotation.strip().split(' ')
 
         img_path = anno[0]
-        img = cv2.imread(img_path)  # H*W*C and C=BGR
-        assert img is not None, 'File Not Found ' + img_path
         bboxes = np.array([list(map(float, box.split(','))) for box in anno[1:]])
 
-        return img, bboxes, img_path.split('/')[-1].strip('.jpg')
+        return img_path, bboxes
 
     def __data_aug(self, img, bboxes):
+        if cfg.TRAIN["COMPOSED_AUGMENT"]:
+            # one warpAffine from the uint8 image, the buffer is reused for the same img_size
+            if self.__composed_aug is None or self.__composed_aug.h_target != self.img_size:
+                self.__composed_aug = dataAug.ComposedAffine((self.img_size, self.img_size))
+            return self.__composed_aug(img, bboxes)
+
         img, bboxes = dataAug.RandomHorizontalFilp()(np.copy(img), np.copy(bboxes))
         img, bboxes = dataAug.RandomCrop()(np.copy(img), np.copy(bboxes))
         img, bboxes = dataAug.RandomAffine()(np.copy(img), np.copy(bboxes))
@@ -107,101 +169,88 @@ class Build_Dataset(Dataset):
 
         return img, bboxes
 
-    def __creat_label(self, bboxes, img_size):
+    def __mosaic(self, item):
+        """
+        Mosaic of item and 3 random images. The tiles come from a per worker LRU cache of decoded
+        images downscaled to half the input size, a cached tile costs no decode. Once the cache is
+        full the 3 partners are drawn from the cached tiles (TileCache.sample).
+        """
+        if self.__tile_cache is None:
+            self.__tile_cache = TileCache(self.__load_item, cfg.TRAIN["MOSAIC_CACHE"])
+        max_side = self.img_size // 2
+        tiles = [self.__tile_cache.get(item, max_side)]
+        partners = self.__tile_cache.sample(max_side, 3, len(self.__annotations))
+        if partners is None:
+            tiles += [self.__tile_cache.get(random.randint(0, len(self.__annotations)-1), max_side) for _ in range(3)]
+        else:
+            tiles += [self.__tile_cache.get(i, max_side, touch=False) for i in partners]
+        tiles = [dataAug.RandomHorizontalFilp()(*tile) for tile in tiles]
+        img, bboxes = dataAug.Mosaic((self.img_size, self.img_size))(tiles)
+
+        self.__num_mosaic += 1
+        if self.__num_mosaic % 1000 == 0:
+            worker_info = torch.utils.data.get_worker_info()
+            print('worker {} {}'.format(worker_info.id if worker_info else 0, self.__tile_cache.stats_str()))
+        img_path = self.__annotations[item].strip().split(' ')[0]
+        return img, bboxes, img_path.split('/')[-1].strip('.jpg')
+
+    def image_cache_stats(self):
+        """
+        Counters of the shared image cache over all workers, see utils.image_cache.ImageCache.
+        """
+        return None if self.__image_cache is None else self.__image_cache.get_stats()
+
+    def tile_cache_stats(self):
+        """
+        Counters of the mosaic tile cache of this process, see utils.tile_cache.TileCache.
+        """
+        return None if self.__tile_cache is None else self.__tile_cache.get_stats()
+
+    def __creat_label(self, bboxes, img_size, assignment=None):
         """
         Label assignment. For a single picture all GT box bboxes are assigned anchor.
-        1、Select a bbox in order, convert its coordinates("xyxy") to "xywh"; and scale bbox'
-           xywh by the strides.
-        2、Calculate the iou between the each detection layer'anchors and the bbox in turn, and select the largest
-            anchor to predict the bbox.If the ious of all detection layers are smaller than 0.3, select the largest
-            of all detection layers' anchors to predict the bbox.
+        1、Convert the coordinates("xyxy") of all bboxes to "xywh"; and scale bboxes' xywh by the strides.
+        2、Calculate the iou between the each detection layer'anchors and the bboxes at once, and select the
+            anchors whose iou is larger than 0.3 to predict the bbox.If the ious of all detection layers are
+            smaller than 0.3, select the largest of all detection layers' anchors to predict the bbox.
 
         Note :
         1、The same GT may be assigned to multiple anchors. And the anchors may be on the same or different layer.
         2、The total number of bboxes may be more than it is, because the same GT may be assigned to multiple layers
         of detection.
+        3、When several bboxes hit the same anchor, the anchor predicts the bbox with the highest iou.
 
+        :param assignment: (rows, layer_boxes) of utils.label_assign, computed when None
+        :return: label_sbbox, label_mbbox, label_lbbox, sbboxes, mbboxes, lbboxes as float tensors
         """
-
-        anchors = np.array(cfg.MODEL["ANCHORS"])
-        strides = np.array(cfg.MODEL["STRIDES"])
-        train_output_size = img_size / strides
-        anchors_per_scale = cfg.MODEL["ANCHORS_PER_SCLAE"]
-
-        label = [np.zeros((int(train_output_size[i]), int(train_output_size[i]), anchors_per_scale, 6+self.num_classes))
-                                                                      for i in range(3)]
-        for i in range(3):
-            label[i][..., 5] = 1.0
-
-        bboxes_xywh = [np.zeros((150, 4)) for _ in range(3)]   # Darknet the max_num is 30
-        bbox_count = np.zeros((3,))
-
-        for bbox in bboxes:
-            bbox_coor = bbox[:4]
-            bbox_class_ind = int(bbox[4])
-            if len(bbox) >= 6:
-                bbox_mix = bbox[5]
-            else:
-                bbox_mix = None
-
-            # onehot
-            one_hot = np.zeros(self.num_classes, dtype=np.float32)
-            one_hot[bbox_class_ind] = 1.0
-            one_hot_smooth = dataAug.LabelSmooth()(one_hot, self.num_classes)
-
-            # convert "xyxy" to "xywh"
-            bbox_xywh = np.concatenate([(bbox_coor[2:] + bbox_coor[:2]) * 0.5,
-                                        bbox_coor[2:] - bbox_coor[:2]], axis=-1)
-            # print("bbox_xywh: ", bbox_xywh)
-
-            bbox_xywh_scaled = 1.0 * bbox_xywh[np.newaxis, :] / strides[:, np.newaxis]
-
-            iou = []
-            exist_positive = False
-            for i in range(3):
-                anchors_xywh = np.zeros((anchors_per_scale, 4))
-                anchors_xywh[:, 0:2] = np.floor(bbox_xywh_scaled[i, 0:2]).astype(np.int32) + 0.5  # 0.5 for compensation
-                anchors_xywh[:, 2:4] = anchors[i]
-
-                iou_scale = tools.iou_xywh_numpy(bbox_xywh_scaled[i][np.newaxis, :], anchors_xywh)
-                iou.append(iou_scale)
-                iou_mask = iou_scale > 0.3
-
-                if np.any(iou_mask):
-                    xind, yind = np.floor(bbox_xywh_scaled[i, 0:2]).astype(np.int32)
-
-                    # Bug : 当多个bbox对应同一个anchor时，默认将该anchor分配给最后一个bbox
-                    label[i][yind, xind, iou_mask, 0:4] = bbox_xywh
-                    label[i][yind, xind, iou_mask, 4:5] = 1.0
-                    label[i][yind, xind, iou_mask, 5:6] = bbox_mix
-                    label[i][yind, xind, iou_mask, 6:] = one_hot_smooth
-
-                    bbox_ind = int(bbox_count[i] % 150)  # BUG : 150为一个先验值,内存消耗大
-                    bboxes_xywh[i][bbox_ind, :4] = bbox_xywh
-                    bbox_count[i] += 1
-
-                    exist_positive = True
-
-            if not exist_positive:
-                best_anchor_ind = np.argmax(np.array(iou).reshape(-1), axis=-1)
-                best_detect = int(best_anchor_ind / anchors_per_scale)
-                best_anchor = int(best_anchor_ind % anchors_per_scale)
-
-                xind, yind = np.floor(bbox_xywh_scaled[best_detect, 0:2]).astype(np.int32)
-
-                label[best_detect][yind, xind, best_anchor, 0:4] = bbox_xywh
-                label[best_detect][yind, xind, best_anchor, 4:5] = 1.0
-                label[best_detect][yind, xind, best_anchor, 5:6] = bbox_mix
-                label[best_detect][yind, xind, best_anchor, 6:] = one_hot_smooth
-
-                bbox_ind = int(bbox_count[best_detect] % 150)
-                bboxes_xywh[best_detect][bbox_ind, :4] = bbox_xywh
-                bbox_count[best_detect] += 1
-
-        label_sbbox, label_mbbox, label_lbbox = label
-        sbboxes, mbboxes, lbboxes = bboxes_xywh
-
-        return label_sbbox, label_mbbox, label_lbbox, sbboxes, mbboxes, lbboxes
+        if assignment is None:
+            assignment = assign_labels(bboxes, cfg.MODEL["ANCHORS"], cfg.MODEL["STRIDES"],
+                                       cfg.MODEL["ANCHORS_PER_SCLAE"])
+        rows, layer_boxes = assignment
+        return densify_labels(rows, layer_boxes, bboxes, img_size, self.num_classes, cfg.MODEL["STRIDES"],
+                              cfg.MODEL["ANCHORS_PER_SCLAE"])
+
+
+def sparse_collate(batch):
+    """
+    collate_fn of a sparse_label Build_Dataset.
+    :return: imgs [bs, 3, H, W],
+             targets [R, (img, layer, yind, xind, anchor, x, y, w, h, class_ind, mix)],
+             gt_bboxes [Q, (img, layer, x, y, w, h)],
+             img_names
+    """
+    imgs, targets, gt_bboxes, img_names = zip(*batch)
+    targets = torch.cat([torch.cat([torch.full((len(t), 1), float(i)), t], 1) for i, t in enumerate(targets)], 0)
+    gt_bboxes = torch.cat([torch.cat([torch.full((len(g), 1), float(i)), g], 1) for i, g in enumerate(gt_bboxes)], 0)
+    return torch.stack(imgs, 0), targets, gt_bboxes, list(img_names)
+
+
+def raw_collate(batch):
+    """
+    collate_fn of a batch_augment Build_Dataset, the images keep their own size.
+    :return: (imgs_org, bboxes_org, imgs_mix, bboxes_mix, img_names) lists
+    """
+    return tuple(list(x) for x in zip(*batch))
 
 
 if __name__ == "__main__":
@@ -0,0 +1,263 @@
+# coding=utf-8
+"""
+Decoded-image cache shared by all DataLoader workers.
+
+Images are downscaled so that their longer side is at most max_side and stored in fixed size
+slots of a memory-mapped file, /dev/shm by default. Every worker maps the same files, a hit returns
+a read-only view of the slot without copy or decode. The number of slots follows from the byte
+budget; when the dataset does not fit, slots are recycled with the CLOCK policy (an approximation
+of LRU: a hit sets the reference bit of the slot, the clock hand clears set bits and evicts the
+first slot whose bit is clear).
+
+Layout of <cache_root>/<anno_type>_<file>_<key>/:
+    slots.dat             [S, max_side, max_side, 3] uint8 pixels
+    index_to_slot.npy     [N] int64, -1 when the image is not cached
+    slot_to_index.npy     [S] int64, -1 when the slot is free
+    slot_shape.npy        [S, 2] int64 (h, w) of the cached image
+    slot_scale.npy        [S] float64, cached size / file size
+    slot_ref.npy          [S] uint8 reference bits
+    slot_time.npy         [S] float64 time of the last read
+    state.npy             [hand, hits, misses, evictions, bypasses] int64
+    lock                  flock of the insertions
+
+Insertions are serialized by the lock; hits are lock free. A slot read less than hold_time seconds
+ago is never evicted, so the view a worker holds stays valid while it augments the image. When every
+slot is that recent (the cache is much too small for the access rate) the image is returned without
+being cached, counted as a bypass.
+<file> hashes the path of the annotation file. The key hashes the annotation file content, max_side
+and the number of slots, a later run with the same settings starts with the cache of the previous
+one, any change builds a new cache and removes the stale ones of the same annotation file.
+The pixel file is sparse, its pages are allocated when images are written: a tmpfs smaller than the
+file (e.g. the 64 MB /dev/shm of a docker container) would kill the workers with SIGBUS. Before a
+cache is built the free space of cache_root is checked, when it cannot hold the budget the cache goes
+to fallback_root (on disk) if that one can, else the number of slots is reduced to the free space.
+"""
+import os
+import glob
+import time
+import fcntl
+import shutil
+import hashlib
+import warnings
+import cv2
+import numpy as np
+
+
+HAND, HITS, MISSES, EVICTIONS, BYPASSES = range(5)
+
+
+class ImageCache(object):
+    def __init__(self, anno_path, anno_type, cache_root, num_images, max_side=608, budget_mb=4096, hold_time=2.0,
+                 fallback_root=None):
+        """
+        :param num_images: number of images of the annotation file
+        :param max_side: images are downscaled to this longer side
+        :param budget_mb: size of the pixel file in MB
+        :param hold_time: seconds a slot is protected from eviction after a read
+        :param fallback_root: used instead of cache_root when only it has room for the budget
+        """
+        self.max_side = max_side
+        self.hold_time = hold_time
+        self.prefix = '{}_{}'.format(anno_type, hashlib.sha1(os.path.abspath(anno_path).encode()).hexdigest()[:8])
+        self.__content_key = self.__hash_file(anno_path)
+        num_slots = max(1, min(num_images, int(budget_mb * 2 ** 20) // self.__slot_bytes()))
+        self.__select(cache_root, num_slots)
+        if not self.__exists():
+            roots = [cache_root] if fallback_root is None else [cache_root, fallback_root]
+            fits = [min(num_slots, self.__free_slots(root)) for root in roots]
+            root = roots[fits.index(max(fits))]
+            if fits[0] < num_slots:
+                warnings.warn('{} has room for {} of the {} slots ({} MB) of the image cache, using {} slots in {}'
+                              .format(cache_root, fits[0], num_slots, num_slots * self.__slot_bytes() >> 20,
+                                      max(fits), root))
+            self.__select(root, max(1, max(fits)))
+            if not self.__exists():
+                for stale_root in roots:
+                    self.__remove_stale(stale_root)
+                self.__create(num_images)
+        self.__open()
+
+    @staticmethod
+    def __hash_file(path):
+        sha1 = hashlib.sha1()
+        with open(path, 'rb') as f:
+            for chunk in iter(lambda: f.read(1 << 20), b''):
+                sha1.update(chunk)
+        return sha1.hexdigest()
+
+    def __slot_bytes(self):
+        return self.max_side * self.max_side * 3
+
+    def __select(self, cache_root, num_slots):
+        self.num_slots = num_slots
+        key = hashlib.sha1('{}_{}_{}'.format(self.__content_key, self.max_side, num_slots).encode()).hexdigest()[:16]
+        self.cache_dir = os.path.join(cache_root, '{}_{}'.format(self.prefix, key))
+
+    def __exists(self):
+        return os.path.isfile(os.path.join(self.cache_dir, 'state.npy'))
+
+    def __stale(self, cache_root):
+        # only the older caches of this annotation file, not the ones being built (.tmp<pid>)
+        return [path for path in glob.glob(os.path.join(cache_root, '{}_*'.format(self.prefix)))
+                if os.path.isdir(path) and path != self.cache_dir and '.tmp' not in os.path.basename(path)]
+
+    def __remove_stale(self, cache_root):
+        for path in self.__stale(cache_root):
+            shutil.rmtree(path, ignore_errors=True)
+
+    def __free_slots(self, cache_root):
+        """
+        :return: number of slots the free space of cache_root holds, counting the space of the stale
+                 caches that are removed before the new one is built
+        """
+        os.makedirs(cache_root, exist_ok=True)
+        stat = os.statvfs(cache_root)
+        free = stat.f_bavail * stat.f_frsize
+        for path in self.__stale(cache_root):
+            for name in os.listdir(path):
+                free += os.stat(os.path.join(path, name)).st_blocks * 512
+        # the index files and a margin for the other users of the file system
+        free -= free // 20 + self.num_slots * 64
+        return max(0, int(free) // self.__slot_bytes())
+
+    def __create(self, num_images):
+        tmp_dir = self.cache_dir + '.tmp{}'.format(os.getpid())
+        os.makedirs(tmp_dir)
+        # sparse file, tmpfs only allocates the pages that are written
+        with open(os.path.join(tmp_dir, 'slots.dat'), 'wb') as f:
+            f.truncate(self.num_slots * self.max_side * self.max_side * 3)
+        np.save(os.path.join(tmp_dir, 'index_to_slot.npy'), np.full(num_images, -1, dtype=np.int64))
+        np.save(os.path.join(tmp_dir, 'slot_to_index.npy'), np.full(self.num_slots, -1, dtype=np.int64))
+        np.save(os.path.join(tmp_dir, 'slot_shape.npy'), np.zeros((self.num_slots, 2), dtype=np.int64))
+        np.save(os.path.join(tmp_dir, 'slot_scale.npy'), np.ones(self.num_slots, dtype=np.float64))
+        np.save(os.path.join(tmp_dir, 'slot_ref.npy'), np.zeros(self.num_slots, dtype=np.uint8))
+        np.save(os.path.join(tmp_dir, 'slot_time.npy'), np.zeros(self.num_slots, dtype=np.float64))
+        open(os.path.join(tmp_dir, 'lock'), 'w').close()
+        np.save(os.path.join(tmp_dir, 'state.npy'), np.zeros(5, dtype=np.int64))
+        try:
+            os.rename(tmp_dir, self.cache_dir)
+        except OSError:
+            # created by a concurrent process
+            for name in os.listdir(tmp_dir):
+                os.remove(os.path.join(tmp_dir, name))
+            os.rmdir(tmp_dir)
+
+    def __open(self):
+        path = lambda name: os.path.join(self.cache_dir, name)
+        self.__slots = np.memmap(path('slots.dat'), dtype=np.uint8, mode='r+',
+                                 shape=(self.num_slots, self.max_side, self.max_side, 3))
+        self.__index_to_slot = np.load(path('index_to_slot.npy'), mmap_mode='r+')
+        self.__slot_to_index = np.load(path('slot_to_index.npy'), mmap_mode='r+')
+        self.__slot_shape = np.load(path('slot_shape.npy'), mmap_mode='r+')
+        self.__slot_scale = np.load(path('slot_scale.npy'), mmap_mode='r+')
+        self.__slot_ref = np.load(path('slot_ref.npy'), mmap_mode='r+')
+        self.__slot_time = np.load(path('slot_time.npy'), mmap_mode='r+')
+        self.__state = np.load(path('state.npy'), mmap_mode='r+')
+        self.__lock_path = path('lock')
+
+    def __getstate__(self):
+        # workers started with spawn map the files again instead of receiving copies
+        return {'max_side': self.max_side, 'hold_time': self.hold_time, 'num_slots': self.num_slots,
+                'cache_dir': self.cache_dir}
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.__open()
+
+    def get(self, index, img_path):
+        """
+        :return: (img, scale) img is a read-only BGR view of the cached image, scale is the ratio of
+                 its size to the size of the file (multiply the boxes by it)
+        """
+        slot = self.__index_to_slot[index]
+        if slot >= 0:
+            # protect the slot first, then check that it was not recycled meanwhile
+            self.__slot_time[slot] = time.time()
+            self.__slot_ref[slot] = 1
+            if self.__slot_to_index[slot] == index:
+                self.__state[HITS] += 1  # approximate, not locked
+                return self.__view(slot), float(self.__slot_scale[slot])
+
+        img = cv2.imread(img_path)  # H*W*C and C=BGR
+        assert img is not None, 'File Not Found ' + img_path
+        h, w = img.shape[:2]
+        scale = min(1.0, 1.0 * self.max_side / max(h, w))
+        if scale < 1:
+            size = (min(self.max_side, int(round(w * scale))), min(self.max_side, int(round(h * scale))))
+            img = cv2.resize(img, size, interpolation=cv2.INTER_AREA)
+            scale = 1.0 * img.shape[1] / w
+
+        with open(self.__lock_path, 'r') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            self.__state[MISSES] += 1
+            slot = self.__victim() if self.__index_to_slot[index] < 0 else -1
+            if slot >= 0:
+                h, w = img.shape[:2]
+                self.__slots[slot, :h, :w] = img
+                self.__slot_shape[slot] = (h, w)
+                self.__slot_scale[slot] = scale
+                self.__slot_to_index[slot] = index
+                self.__slot_ref[slot] = 1
+                self.__slot_time[slot] = time.time()
+                self.__index_to_slot[index] = slot
+            fcntl.flock(lock, fcntl.LOCK_UN)
+        return img, scale
+
+    def __victim(self):
+        """
+        CLOCK eviction that skips the slots read within hold_time, called with the lock held.
+        :return: a free slot, -1 when two turns of the hand found none
+        """
+        hand = int(self.__state[HAND])
+        for _ in range(2 * self.num_slots):
+            slot, hand = hand, (hand + 1) % self.num_slots
+            if self.__slot_ref[slot]:
+                self.__slot_ref[slot] = 0
+                continue
+            evicted = self.__slot_to_index[slot]
+            if evicted < 0:
+                break
+            if time.time() - self.__slot_time[slot] < self.hold_time:
+                continue
+            self.__index_to_slot[evicted] = -1
+            self.__slot_to_index[slot] = -1
+            if time.time() - self.__slot_time[slot] < self.hold_time:
+                # read between the check and the unmapping, keep it
+                self.__slot_to_index[slot] = evicted
+                self.__index_to_slot[evicted] = slot
+                continue
+            self.__state[EVICTIONS] += 1
+            break
+        else:
+            self.__state[HAND] = hand
+            self.__state[BYPASSES] += 1
+            return -1
+        self.__state[HAND] = hand
+        return slot
+
+    def __view(self, slot):
+        h, w = self.__slot_shape[slot]
+        img = np.asarray(self.__slots[slot, :h, :w])
+        img.flags.writeable = False
+        return img
+
+    def get_stats(self):
+        """
+        Counters of all the processes using the cache.
+        """
+        hits, misses = int(self.__state[HITS]), int(self.__state[MISSES])
+        return {'hits': hits,
+                'misses': misses,
+                'hit_rate': 1.0 * hits / max(hits + misses, 1),
+                'evictions': int(self.__state[EVICTIONS]),
+                'bypasses': int(self.__state[BYPASSES]),
+                'cached': int(np.count_nonzero(self.__slot_to_index >= 0)),
+                'slots': self.num_slots,
+                'mbytes': self.num_slots * self.max_side * self.max_side * 3 / 2 ** 20}
+
+    def stats_str(self):
+        stats = self.get_stats()
+        return ('image cache: hit rate {:.1%} ({} hits, {} misses), {} evictions, {} bypasses, '
+                '{}/{} images cached, {:.0f} MB').format(
+            stats['hit_rate'], stats['hits'], stats['misses'], stats['evictions'], stats['bypasses'], stats['cached'],
+            stats['slots'], stats['mbytes'])
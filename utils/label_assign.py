@@ -0,0 +1,129 @@
+# coding=utf-8
+"""
+Sparse label assignment.
+
+assign_labels() does the anchor assignment of Build_Dataset.__creat_label but only returns index
+lists; densify_labels() turns them into the dense [G, G, 3, 6+C] label tensors and the [150, 4]
+bbox tensors that YoloV4Loss expects.
+
+rows:        [R, (layer, yind, xind, anchor, box)] one row per assigned anchor, at most one row per
+             (layer, yind, xind, anchor); when several boxes hit the same anchor the box with the
+             highest IoU wins.
+layer_boxes: [Q, (layer, box)] boxes in the order they are written into the per-layer bbox lists.
+
+sparse_targets() packs the same information for YoloV4SparseLoss without densifying anything.
+"""
+import numpy as np
+import torch
+import utils.tools as tools
+import utils.data_augment as dataAug
+
+
+MAX_BBOX_PER_SCALE = 150  # Darknet the max_num is 30
+
+
+def bboxes_xyxy2xywh(bboxes):
+    return np.concatenate([(bboxes[:, 2:4] + bboxes[:, :2]) * 0.5, bboxes[:, 2:4] - bboxes[:, :2]], axis=-1)
+
+
+def assign_labels(bboxes, anchors, strides, anchors_per_scale=3, iou_thresh=0.3):
+    """
+    Vectorized anchor assignment: the IoU of every box with the anchors of every layer is computed
+    in one shot. An anchor hit by several boxes goes to the box with the highest IoU (the later box
+    on a tie).
+    :param bboxes: [N, (xmin, ymin, xmax, ymax, class_ind[, mix])] in input image pixels
+    :param anchors: [3, anchors_per_scale, 2] anchors in grid units
+    :param strides: [3]
+    :return: rows [R, 5] int32, layer_boxes [Q, 2] int32
+    """
+    anchors = np.asarray(anchors)
+    strides = np.asarray(strides)
+    if len(bboxes) == 0:
+        return np.zeros((0, 5), dtype=np.int32), np.zeros((0, 2), dtype=np.int32)
+    bboxes = np.asarray(bboxes, dtype=np.float64)
+
+    bboxes_xywh_scaled = bboxes_xyxy2xywh(bboxes[:, :4])[:, np.newaxis, :] / strides[np.newaxis, :, np.newaxis]
+    cells = np.floor(bboxes_xywh_scaled[..., 0:2]).astype(np.int32)  # [N, 3, 2] (xind, yind)
+    shape = cells.shape[:2] + (anchors_per_scale, 2)
+    anchors_xywh = np.concatenate([np.broadcast_to((cells + 0.5)[:, :, np.newaxis, :], shape),  # 0.5 for compensation
+                                   np.broadcast_to(anchors[np.newaxis], shape)], axis=-1)
+    iou = tools.iou_xywh_numpy(bboxes_xywh_scaled[:, :, np.newaxis, :], anchors_xywh)  # [N, 3, A]
+
+    iou_mask = iou > iou_thresh
+    # boxes without any positive anchor take the best anchor of all layers
+    no_positive = np.flatnonzero(~iou_mask.any(axis=(1, 2)))
+    best_anchor_ind = np.argmax(iou[no_positive].reshape(len(no_positive), 3 * anchors_per_scale), axis=-1)
+    iou_mask[no_positive, best_anchor_ind // anchors_per_scale, best_anchor_ind % anchors_per_scale] = True
+
+    box, layer, anchor = np.nonzero(iou_mask)
+    xind, yind = cells[box, layer, 0], cells[box, layer, 1]
+    key = np.stack([layer, yind, xind, anchor], axis=-1)
+    # per anchor keep the highest iou, then the last box
+    order = np.lexsort((box, iou[box, layer, anchor], anchor, xind, yind, layer))
+    key, box = key[order], box[order]
+    last = np.ones(len(key), dtype=bool)
+    last[:-1] = np.any(key[1:] != key[:-1], axis=-1)
+    rows = np.concatenate([key[last], box[last, np.newaxis]], axis=-1).astype(np.int32)
+
+    # np.nonzero is box-major, the boxes are written into the bbox lists in box order
+    layer_boxes = np.stack(np.nonzero(iou_mask.any(axis=2))[::-1], axis=-1).astype(np.int32)
+    return rows, layer_boxes
+
+
+def densify_labels(rows, layer_boxes, bboxes, img_size, num_classes, strides, anchors_per_scale=3):
+    """
+    Build the dense targets of Build_Dataset.__getitem__ from the sparse assignment.
+    :return: label_sbbox, label_mbbox, label_lbbox, sbboxes, mbboxes, lbboxes as float tensors
+    """
+    bboxes = np.asarray(bboxes, dtype=np.float64)
+    if bboxes.size == 0:
+        bboxes = np.zeros((0, 5))
+    bboxes_xywh = bboxes_xyxy2xywh(bboxes)
+    mix = bboxes[:, 5] if bboxes.shape[1] >= 6 else np.ones(len(bboxes))
+    one_hot = np.eye(num_classes, dtype=np.float32)[bboxes[:, 4].astype(np.int64)]
+    one_hot_smooth = dataAug.LabelSmooth()(one_hot, num_classes)
+    # the label row of every box, written to its anchors at once. The labels are filled with numpy,
+    # the per call overhead of torch indexing dominates at the few boxes of a VOC image
+    box_labels = np.concatenate([bboxes_xywh, np.ones((len(bboxes), 1)), mix[:, np.newaxis], one_hot_smooth],
+                                axis=-1).astype(np.float32)
+
+    labels, bboxes_list = [], []
+    rows = np.asarray(rows, dtype=np.int64).reshape(-1, 5)
+    layer_boxes = np.asarray(layer_boxes, dtype=np.int64).reshape(-1, 2)
+    for i in range(3):
+        output_size = int(img_size / strides[i])
+        label = np.zeros((output_size, output_size, anchors_per_scale, 6 + num_classes), dtype=np.float32)
+        label[..., 5] = 1.0
+        layer_rows = rows[rows[:, 0] == i]
+        label[layer_rows[:, 1], layer_rows[:, 2], layer_rows[:, 3]] = box_labels[layer_rows[:, 4]]
+        labels.append(torch.from_numpy(label))
+
+        # ring buffer of MAX_BBOX_PER_SCALE slots, later boxes overwrite earlier ones
+        layer_box = layer_boxes[layer_boxes[:, 0] == i, 1]
+        slots = np.arange(len(layer_box)) % MAX_BBOX_PER_SCALE
+        layer_box, slots = layer_box[-MAX_BBOX_PER_SCALE:], slots[-MAX_BBOX_PER_SCALE:]
+        layer_bboxes = np.zeros((MAX_BBOX_PER_SCALE, 4), dtype=np.float32)
+        layer_bboxes[slots] = box_labels[layer_box, :4]
+        bboxes_list.append(torch.from_numpy(layer_bboxes))
+
+    return labels[0], labels[1], labels[2], bboxes_list[0], bboxes_list[1], bboxes_list[2]
+
+
+def sparse_targets(rows, layer_boxes, bboxes):
+    """
+    Sparse training targets of one image.
+    :return: targets [R, (layer, yind, xind, anchor, x, y, w, h, class_ind, mix)] float tensor,
+             gt_bboxes [Q, (layer, x, y, w, h)] float tensor, the boxes each layer uses for the
+             ignore mask of the confidence loss.
+    """
+    bboxes = np.asarray(bboxes, dtype=np.float64)
+    if bboxes.size == 0:
+        bboxes = np.zeros((0, 5))
+    bboxes_xywh = bboxes_xyxy2xywh(bboxes)
+    mix = bboxes[:, 5] if bboxes.shape[1] >= 6 else np.ones(len(bboxes))
+    rows = np.asarray(rows, dtype=np.int64).reshape(-1, 5)
+    layer_boxes = np.asarray(layer_boxes, dtype=np.int64).reshape(-1, 2)
+    box = rows[:, 4]
+    targets = np.concatenate([rows[:, :4], bboxes_xywh[box], bboxes[box, 4:5], mix[box, np.newaxis]], axis=-1)
+    gt_bboxes = np.concatenate([layer_boxes[:, :1], bboxes_xywh[layer_boxes[:, 1]]], axis=-1)
+    return torch.from_numpy(targets).float(), torch.from_numpy(gt_bboxes).float()
@@ -0,0 +1,130 @@
+# coding=utf-8
+"""
+On-disk cache of parsed annotations and of the augmentation-independent label assignment.
+
+Layout of <cache_root>/<anno_type>_<file>_<key>/:
+    img_paths.npy         [N] image paths
+    boxes.npy             [M, 5] float64 (xmin, ymin, xmax, ymax, class_ind) of all images
+    box_offsets.npy       [N+1] int64, boxes of image i are boxes[box_offsets[i]:box_offsets[i+1]]
+    assign_*.npy          sparse label assignment (see utils.label_assign) of the un-augmented
+                          boxes, with per-image offsets. It does not depend on the input size.
+<file> hashes the path of the annotation file. The key hashes the annotation file content, the
+anchors, the strides, the number of classes and the collision rule of the assignment, so any
+change of those builds a new cache and removes the stale ones of the same annotation file.
+"""
+import os
+import json
+import glob
+import shutil
+import hashlib
+import numpy as np
+from utils.label_assign import assign_labels
+
+
+class LabelCache(object):
+    def __init__(self, anno_path, anno_type, cache_root, anchors, strides, num_classes, anchors_per_scale=3,
+                 with_assignment=False):
+        """
+        :param with_assignment: build/load the label assignment now, so that DataLoader workers
+                                share it instead of building it each
+        """
+        self.anchors = np.asarray(anchors)
+        self.strides = np.asarray(strides)
+        self.anchors_per_scale = anchors_per_scale
+        self.key = self.__cache_key(anno_path, num_classes)
+        self.prefix = '{}_{}'.format(anno_type, hashlib.sha1(os.path.abspath(anno_path).encode()).hexdigest()[:8])
+        self.cache_dir = os.path.join(cache_root, '{}_{}'.format(self.prefix, self.key))
+        if not os.path.isfile(os.path.join(self.cache_dir, 'meta.json')):
+            self.__remove_stale(cache_root)
+            self.__build(anno_path, num_classes)
+
+        self.img_paths = np.load(os.path.join(self.cache_dir, 'img_paths.npy'))
+        self.boxes = np.load(os.path.join(self.cache_dir, 'boxes.npy'), mmap_mode='r')
+        self.box_offsets = np.load(os.path.join(self.cache_dir, 'box_offsets.npy'))
+        self.__assignment = self.__load_assignment() if with_assignment else None
+
+    def __len__(self):
+        return len(self.img_paths)
+
+    def __cache_key(self, anno_path, num_classes):
+        sha1 = hashlib.sha1()
+        with open(anno_path, 'rb') as f:
+            for chunk in iter(lambda: f.read(1 << 20), b''):
+                sha1.update(chunk)
+        sha1.update(json.dumps({'anchors': self.anchors.tolist(), 'strides': self.strides.tolist(),
+                                'anchors_per_scale': self.anchors_per_scale,
+                                'num_classes': num_classes, 'collision': 'highest_iou'}).encode())
+        return sha1.hexdigest()[:16]
+
+    def __remove_stale(self, cache_root):
+        # only the older caches of this annotation file, not the ones being built (.tmp<pid>)
+        for path in glob.glob(os.path.join(cache_root, '{}_*'.format(self.prefix))):
+            if os.path.isdir(path) and path != self.cache_dir and '.tmp' not in os.path.basename(path):
+                shutil.rmtree(path, ignore_errors=True)
+
+    def __build(self, anno_path, num_classes):
+        with open(anno_path, 'r') as f:
+            annotations = list(filter(lambda x: len(x) > 0, f.readlines()))
+        img_paths, boxes, counts = [], [], []
+        for annotation in annotations:
+            anno = annotation.strip().split(' ')
+            img_paths.append(anno[0])
+            img_boxes = [list(map(float, box.split(','))) for box in anno[1:]]
+            boxes.extend(img_boxes)
+            counts.append(len(img_boxes))
+
+        tmp_dir = self.cache_dir + '.tmp{}'.format(os.getpid())
+        os.makedirs(tmp_dir)
+        np.save(os.path.join(tmp_dir, 'img_paths.npy'), np.array(img_paths))
+        np.save(os.path.join(tmp_dir, 'boxes.npy'), np.array(boxes, dtype=np.float64).reshape(-1, 5))
+        np.save(os.path.join(tmp_dir, 'box_offsets.npy'), np.concatenate([[0], np.cumsum(counts)]).astype(np.int64))
+        with open(os.path.join(tmp_dir, 'meta.json'), 'w') as f:
+            json.dump({'anno_path': anno_path, 'images': len(img_paths), 'boxes': len(boxes),
+                       'num_classes': num_classes}, f)
+        # rename is atomic, concurrent builders of the same key cannot leave a half written cache
+        try:
+            os.rename(tmp_dir, self.cache_dir)
+        except OSError:
+            shutil.rmtree(tmp_dir)
+
+    def get_annotation(self, index):
+        """
+        :return: (img_path, bboxes) bboxes is [n, (xmin, ymin, xmax, ymax, class_ind)] float64,
+                 the same as parsing the annotation line.
+        """
+        start, end = self.box_offsets[index], self.box_offsets[index + 1]
+        return str(self.img_paths[index]), np.array(self.boxes[start:end])
+
+    def get_assignment(self, index):
+        """
+        Label assignment of the un-augmented boxes of image index, built for the whole
+        annotation set on first use.
+        :return: (rows, layer_boxes), see utils.label_assign
+        """
+        if self.__assignment is None:
+            self.__assignment = self.__load_assignment()
+        rows, row_offsets, layer_boxes, layer_box_offsets = self.__assignment
+        return (rows[row_offsets[index]:row_offsets[index + 1]],
+                layer_boxes[layer_box_offsets[index]:layer_box_offsets[index + 1]])
+
+    def __load_assignment(self):
+        names = ['rows', 'row_offsets', 'layer_boxes', 'layer_box_offsets']
+        paths = [os.path.join(self.cache_dir, 'assign_{}.npy'.format(name)) for name in names]
+        if not all(os.path.isfile(path) for path in paths):
+            rows, layer_boxes = [], []
+            for index in range(len(self)):
+                img_rows, img_layer_boxes = assign_labels(self.get_annotation(index)[1], self.anchors,
+                                                          self.strides, self.anchors_per_scale)
+                rows.append(img_rows)
+                layer_boxes.append(img_layer_boxes)
+            arrays = [np.concatenate(rows), self.__offsets(rows),
+                      np.concatenate(layer_boxes), self.__offsets(layer_boxes)]
+            for path, array in zip(paths, arrays):
+                tmp_path = path + '.tmp{}.npy'.format(os.getpid())
+                np.save(tmp_path, array)
+                os.replace(tmp_path, path)
+        return [np.load(path, mmap_mode='r') for path in paths]
+
+    @staticmethod
+    def __offsets(arrays):
+        return np.concatenate([[0], np.cumsum([len(a) for a in arrays])]).astype(np.int64)
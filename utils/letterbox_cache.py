@@ -0,0 +1,91 @@
+# coding=utf-8
+"""
+Memory-mapped cache of a letterboxed test set, so that the validation of every epoch only runs
+the forward pass and the postprocess instead of decoding and resizing the same images again.
+
+Layout of <cache_root>/<key>/:
+    images.dat            [N, 3, S, S] uint8 RGB letterboxed images (dataAug.Resize, rounded to uint8)
+    org_shapes.npy        [N, 2] int64 (h, w) of the original images
+    meta.json             test size and number of images
+
+The key hashes the test size and the path, size and mtime of every image, so another test size
+or image list builds another cache and removes the stale one. The images differ from the float
+letterbox of utils.prefetch_loader.read_image by the uint8 rounding (at most 0.5 / 255).
+"""
+import os
+import json
+import glob
+import shutil
+import hashlib
+import functools
+import numpy as np
+from tqdm import tqdm
+from utils.prefetch_loader import PrefetchLoader, read_image
+
+
+class LetterboxCache(object):
+    def __init__(self, img_paths, test_shape, cache_root, num_workers=4, max_prefetch=16):
+        """
+        :param img_paths: images of the test set, in evaluation order
+        :param test_shape: network input size S
+        :param num_workers, max_prefetch: decoding threads used to build the cache
+        """
+        self.test_shape = test_shape
+        self.num_images = len(img_paths)
+        self.key = self.__cache_key(img_paths)
+        self.cache_dir = os.path.join(cache_root, self.key)
+        if not os.path.isfile(os.path.join(self.cache_dir, 'meta.json')):
+            self.__remove_stale(cache_root)
+            self.__build(img_paths, num_workers, max_prefetch)
+
+        self.images = np.memmap(os.path.join(self.cache_dir, 'images.dat'), dtype=np.uint8, mode='r',
+                                shape=(self.num_images, 3, test_shape, test_shape))
+        self.org_shapes = np.load(os.path.join(self.cache_dir, 'org_shapes.npy'))
+
+    def __len__(self):
+        return self.num_images
+
+    def __cache_key(self, img_paths):
+        sha1 = hashlib.sha1()
+        sha1.update(str(self.test_shape).encode())
+        for path in img_paths:
+            stat = os.stat(path)
+            sha1.update('{} {} {}\n'.format(path, stat.st_size, int(stat.st_mtime)).encode())
+        return sha1.hexdigest()[:16]
+
+    def __remove_stale(self, cache_root):
+        # not the caches being built (.tmp<pid>)
+        for path in glob.glob(os.path.join(cache_root, '*')):
+            if os.path.isdir(path) and path != self.cache_dir and '.tmp' not in os.path.basename(path):
+                shutil.rmtree(path, ignore_errors=True)
+
+    def __build(self, img_paths, num_workers, max_prefetch):
+        tmp_dir = self.cache_dir + '.tmp{}'.format(os.getpid())
+        os.makedirs(tmp_dir)
+        images = np.memmap(os.path.join(tmp_dir, 'images.dat'), dtype=np.uint8, mode='w+',
+                           shape=(self.num_images, 3, self.test_shape, self.test_shape))
+        org_shapes = np.zeros((self.num_images, 2), dtype=np.int64)
+        loader = PrefetchLoader(img_paths, functools.partial(read_image, test_shape=self.test_shape),
+                                num_workers=num_workers, max_prefetch=max_prefetch)
+        print('Caching {} letterboxed test images to {:s}'.format(self.num_images, self.cache_dir))
+        for i, (img, resized) in enumerate(tqdm(loader, total=self.num_images)):
+            images[i] = np.rint(resized * 255.0)
+            org_shapes[i] = img.shape[:2]
+        images.flush()
+        del images
+        np.save(os.path.join(tmp_dir, 'org_shapes.npy'), org_shapes)
+        with open(os.path.join(tmp_dir, 'meta.json'), 'w') as f:
+            json.dump({'test_shape': self.test_shape, 'images': self.num_images}, f)
+        try:
+            os.rename(tmp_dir, self.cache_dir)
+        except OSError:
+            shutil.rmtree(tmp_dir)
+
+    def get_batch(self, indices):
+        """
+        :param indices: positions of the images in img_paths
+        :return: (images, org_shapes) [len(indices), 3, S, S] uint8 copy of the letterboxed images
+                 and their original (h, w)
+        """
+        indices = np.asarray(indices)
+        return np.array(self.images[indices]), self.org_shapes[indices]
@@ -0,0 +1,421 @@
+# coding=utf-8
+"""
+Batched non-maximum suppression engine.
+
+All boxes of all classes (and of all images of a batch) are suppressed in one call: every box
+gets a group id (image * num_classes + class) and boxes of different groups never suppress
+each other. The IoU between candidates is computed once as a matrix, the suppression itself only
+walks the rows of that matrix.
+
+Supported methods:
+    'nms'        hard greedy NMS, suppress when IoU > iou_threshold
+    'soft-nms'   Gaussian soft-NMS, score *= exp(-IoU^2 / sigma)
+    'linear'     linear soft-NMS, score *= 1 - IoU when IoU > iou_threshold
+    'diou'       greedy DIoU-NMS, suppress when IoU - d^2/c^2 > iou_threshold
+    'matrix'     Matrix NMS (SOLOv2), fully parallel score decay with a Gaussian kernel
+    'matrix-linear'  Matrix NMS with a linear kernel
+
+numpy arrays are handled with the numpy backend, torch tensors with the torch backend (the IoU
+matrix is built on the tensor's device, CPU tensors reuse the numpy backend). Groups of more than
+MAX_BLOCK boxes never build their N x N matrix: the greedy methods compute the IoU of the picked box
+with the remaining ones at every step, like the former per-class loop, and Matrix NMS builds the
+matrix in column chunks of at most MAX_BLOCK ** 2 entries.
+
+Like the former per-class loop of utils.tools.nms, the greedy methods always keep the highest
+scoring box of every group, whatever its score; the other boxes are kept when their (decayed)
+score is above score_threshold. Matrix NMS thresholds the decayed scores of all boxes.
+"""
+import numpy as np
+import torch
+
+
+METHODS = ['nms', 'soft-nms', 'linear', 'diou', 'matrix', 'matrix-linear']
+MAX_BLOCK = 2048  # max number of boxes per IoU matrix, larger groups are suppressed without the matrix
+
+
+def _pairwise_iou_numpy(boxes, diou=False, others=None):
+    """
+    :param boxes: [N, (xmin, ymin, xmax, ymax)]
+    :param others: [M, 4] boxes of the columns, boxes when None
+    :return: [N, M] IoU (or DIoU) matrix
+    """
+    others = boxes if others is None else others
+    x1, y1, x2, y2 = boxes[:, 0], boxes[:, 1], boxes[:, 2], boxes[:, 3]
+    ox1, oy1, ox2, oy2 = others[:, 0], others[:, 1], others[:, 2], others[:, 3]
+    area = (x2 - x1) * (y2 - y1)
+    other_area = (ox2 - ox1) * (oy2 - oy1)
+    # per-coordinate outer products avoid the [N, M, 2] temporaries of broadcasting
+    inter_w = np.minimum.outer(x2, ox2) - np.maximum.outer(x1, ox1)
+    inter_h = np.minimum.outer(y2, oy2) - np.maximum.outer(y1, oy1)
+    np.maximum(inter_w, 0.0, out=inter_w)
+    np.maximum(inter_h, 0.0, out=inter_h)
+    inter_area = np.multiply(inter_w, inter_h, out=inter_w)
+    union_area = np.add.outer(area, other_area) - inter_area
+    iou = inter_area / np.maximum(union_area, np.finfo(np.float32).eps)
+    if diou:
+        iou = iou - _center_penalty_numpy(boxes, others)
+    return iou
+
+
+def _center_penalty_numpy(boxes, others):
+    cx = (boxes[:, 0] + boxes[:, 2]) * 0.5
+    cy = (boxes[:, 1] + boxes[:, 3]) * 0.5
+    ocx = (others[:, 0] + others[:, 2]) * 0.5
+    ocy = (others[:, 1] + others[:, 3]) * 0.5
+    center_dis = np.subtract.outer(cx, ocx) ** 2 + np.subtract.outer(cy, ocy) ** 2
+    outer_w = np.maximum.outer(boxes[:, 2], others[:, 2]) - np.minimum.outer(boxes[:, 0], others[:, 0])
+    outer_h = np.maximum.outer(boxes[:, 3], others[:, 3]) - np.minimum.outer(boxes[:, 1], others[:, 1])
+    outer_diagonal_line = outer_w ** 2 + outer_h ** 2
+    return center_dis / np.maximum(outer_diagonal_line, np.finfo(np.float32).eps)
+
+
+def _pairwise_iou_torch(boxes, diou=False):
+    area = (boxes[:, 2] - boxes[:, 0]) * (boxes[:, 3] - boxes[:, 1])
+    left_up = torch.max(boxes[:, None, :2], boxes[None, :, :2])
+    right_down = torch.min(boxes[:, None, 2:], boxes[None, :, 2:])
+    inter_section = (right_down - left_up).clamp(min=0)
+    inter_area = inter_section[..., 0] * inter_section[..., 1]
+    union_area = area[:, None] + area[None, :] - inter_area
+    iou = inter_area / union_area.clamp(min=1e-7)
+    if diou:
+        center = (boxes[:, :2] + boxes[:, 2:]) * 0.5
+        center_dis = ((center[:, None] - center[None]) ** 2).sum(-1)
+        outer = torch.max(boxes[:, None, 2:], boxes[None, :, 2:]) - \
+                torch.min(boxes[:, None, :2], boxes[None, :, :2])
+        iou = iou - center_dis / (outer ** 2).sum(-1).clamp(min=1e-7)
+    return iou
+
+
+def _greedy_keep(over):
+    """
+    Greedy suppression on a precomputed boolean matrix.
+    :param over: [N, N] bool, over[i, j] means box i suppresses box j. Rows are sorted by
+                 descending score.
+    :return: indices of the kept rows
+    """
+    n = len(over)
+    alive = np.ones(n, dtype=bool)
+    keep = []
+    i = 0
+    while True:
+        keep.append(i)
+        if i + 1 == n:
+            break
+        alive[i + 1:] &= ~over[i, i + 1:]
+        # argmax of a bool array is the first True, i.e. the next unsuppressed box
+        i += 1 + int(np.argmax(alive[i + 1:]))
+        if not alive[i]:
+            break
+    return np.array(keep, dtype=np.int64)
+
+
+def _soft_keep(iou, scores, score_threshold, iou_threshold, sigma, method):
+    """
+    Soft-NMS on a precomputed IoU matrix. The box with the highest decayed score is picked at
+    every step, so the order is the same as the reference implementation.
+    :return: indices of the kept boxes in pick order, decayed scores of all boxes
+    """
+    scores = scores.copy()
+    # the candidates are already filtered by _candidates, the top box of a group may be below
+    # score_threshold
+    alive = np.ones(len(scores), dtype=bool)
+    keep = []
+    while alive.any():
+        i = np.flatnonzero(alive)[np.argmax(scores[alive])]
+        keep.append(i)
+        alive[i] = False
+        row = iou[i, alive]
+        if method == 'soft-nms':
+            weight = np.exp(-(1.0 * row ** 2 / sigma))
+        else:
+            weight = np.where(row > iou_threshold, 1.0 - row, 1.0)
+        scores[alive] *= weight
+        alive[alive] = scores[alive] > score_threshold
+    return np.array(keep, dtype=np.int64), scores
+
+
+def _matrix_decay(iou, scores, same_group, sigma, method):
+    """
+    Matrix NMS (https://arxiv.org/abs/2003.10152). iou/same_group are sorted by descending score.
+    :return: decayed scores in the same order
+    """
+    n = len(scores)
+    if isinstance(iou, torch.Tensor):
+        upper = torch.ones((n, n), dtype=torch.bool, device=iou.device).triu(1)
+        iou = iou * (upper & same_group)
+        compensate = iou.max(0)[0][:, None]
+        if method == 'matrix':
+            decay = torch.exp(-(iou ** 2 - compensate ** 2) / sigma)
+        else:
+            decay = (1.0 - iou) / (1.0 - compensate).clamp(min=1e-7)
+        return scores * decay.min(0)[0]
+
+    upper = np.triu(np.ones((n, n), dtype=bool), 1)
+    iou = iou * (upper & same_group)
+    compensate = iou.max(0)[:, np.newaxis]
+    if method == 'matrix':
+        decay = np.exp(-(iou ** 2 - compensate ** 2) / sigma)
+    else:
+        decay = (1.0 - iou) / np.maximum(1.0 - compensate, 1e-7)
+    return scores * decay.min(0)
+
+
+def _suppress(iou, scores, score_threshold, iou_threshold, sigma, method):
+    """
+    Shared driver of both backends. Everything is already sorted by descending score.
+    :param iou: [N, N] numpy IoU matrix, zero between boxes of different groups
+    :return: kept indices (into the sorted order) and their output scores
+    """
+    if method in ['nms', 'diou']:
+        keep = _greedy_keep(iou > iou_threshold)
+        return keep, scores[keep]
+    keep, decayed = _soft_keep(iou, scores, score_threshold, iou_threshold, sigma, method)
+    return keep, decayed[keep]
+
+
+def _suppress_rowwise(boxes, scores, score_threshold, iou_threshold, sigma, method):
+    """
+    _suppress without the IoU matrix, for the groups of more than MAX_BLOCK boxes: only the IoU row
+    of the picked box with the remaining boxes is computed at every step. The results are the same.
+    :param boxes: [N, 4] numpy boxes of one group, sorted by descending score
+    """
+    scores = scores.copy()
+    alive = np.ones(len(scores), dtype=bool)
+    keep = []
+    while alive.any():
+        rest = np.flatnonzero(alive)
+        if method in ['nms', 'diou']:
+            i = rest[0]
+        else:
+            i = rest[np.argmax(scores[rest])]
+        keep.append(i)
+        alive[i] = False
+        rest = rest[rest != i]
+        if len(rest) == 0:
+            break
+        row = _pairwise_iou_numpy(boxes[i:i + 1], diou=(method == 'diou'), others=boxes[rest])[0]
+        if method in ['nms', 'diou']:
+            alive[rest[row > iou_threshold]] = False
+            continue
+        if method == 'soft-nms':
+            weight = np.exp(-(1.0 * row ** 2 / sigma))
+        else:
+            weight = np.where(row > iou_threshold, 1.0 - row, 1.0)
+        scores[rest] *= weight
+        alive[rest] = scores[rest] > score_threshold
+    keep = np.array(keep, dtype=np.int64)
+    return keep, scores[keep]
+
+
+def _matrix_decay_chunked(boxes, scores, sigma, method):
+    """
+    _matrix_decay of one group, the IoU matrix is built in column chunks of at most MAX_BLOCK ** 2
+    entries. The results are the same.
+    """
+    n = len(scores)
+    chunk = max(1, MAX_BLOCK ** 2 // n)
+    rows = np.arange(n)[:, np.newaxis]
+
+    def upper_iou(s, e):
+        return _pairwise_iou_numpy(boxes, others=boxes[s:e]) * (rows < np.arange(s, e)[np.newaxis, :])
+
+    compensate = np.zeros(n)
+    for s in range(0, n, chunk):
+        compensate[s:s + chunk] = upper_iou(s, min(s + chunk, n)).max(0)
+    compensate = compensate[:, np.newaxis]
+    decay = np.zeros(n)
+    for s in range(0, n, chunk):
+        iou = upper_iou(s, min(s + chunk, n))
+        if method == 'matrix':
+            decay[s:s + chunk] = np.exp(-(iou ** 2 - compensate ** 2) / sigma).min(0)
+        else:
+            decay[s:s + chunk] = ((1.0 - iou) / np.maximum(1.0 - compensate, 1e-7)).min(0)
+    return scores * decay
+
+
+def _suppress_group(boxes, scores, score_threshold, iou_threshold, sigma, method):
+    """
+    Suppression of the boxes of one group, sorted by descending score.
+    :return: kept indices (into the sorted order) and their output scores, by descending output
+             score for Matrix NMS
+    """
+    large = len(scores) > MAX_BLOCK
+    if method in ['matrix', 'matrix-linear']:
+        if large:
+            decayed = _matrix_decay_chunked(boxes, scores, sigma, method)
+        else:
+            iou = _pairwise_iou_numpy(boxes)
+            decayed = _matrix_decay(iou, scores, np.ones(iou.shape, dtype=bool), sigma, method)
+        keep = np.flatnonzero(decayed > score_threshold)
+        keep = keep[np.argsort(-decayed[keep], kind='stable')]
+        return keep, decayed[keep]
+    if large:
+        return _suppress_rowwise(boxes, scores, score_threshold, iou_threshold, sigma, method)
+    iou = _pairwise_iou_numpy(boxes, diou=(method == 'diou'))
+    return _suppress(iou, scores, score_threshold, iou_threshold, sigma, method)
+
+
+def _candidates(scores, groups, score_threshold, method):
+    """
+    :return: bool mask of the boxes taking part in the suppression: the boxes above
+             score_threshold and, for the greedy methods, the top box of every group. scores
+             and groups are sorted group-major, by descending score.
+    """
+    valid = scores > score_threshold
+    if method not in ['matrix', 'matrix-linear'] and len(groups):
+        valid[0] = True
+        valid[1:] |= groups[1:] != groups[:-1]
+    return valid
+
+
+def nms_numpy(boxes, scores, groups, iou_threshold, score_threshold=0., method='nms', sigma=0.3):
+    """
+    :param boxes: [N, (xmin, ymin, xmax, ymax)]
+    :param scores: [N]
+    :param groups: [N] int, boxes are only suppressed by boxes of the same group
+    :return: (keep, scores) indices into the inputs sorted by descending output score inside
+             each group, and the (possibly decayed) output scores.
+    """
+    assert method in METHODS, 'unknown nms method {}'.format(method)
+    # group-major, score-descending, stable w.r.t. the input order for ties
+    order = np.lexsort((-scores, groups))
+    order = order[_candidates(scores[order], groups[order], score_threshold, method)]
+    if len(order) == 0:
+        return np.zeros((0,), dtype=np.int64), np.zeros((0,), dtype=scores.dtype)
+    boxes, scores, groups = boxes[order], scores[order], groups[order]
+
+    # one IoU block per group, boxes of different groups never suppress each other
+    bounds = np.flatnonzero(np.diff(groups)) + 1
+    starts = np.concatenate([[0], bounds])
+    ends = np.concatenate([bounds, [len(groups)]])
+    keep_list, score_list = [], []
+    for s, e in zip(starts, ends):
+        keep, keep_scores = _suppress_group(boxes[s:e], scores[s:e], score_threshold, iou_threshold,
+                                            sigma, method)
+        keep_list.append(order[s + keep])
+        score_list.append(keep_scores)
+    return np.concatenate(keep_list), np.concatenate(score_list)
+
+
+def nms_torch(boxes, scores, groups, iou_threshold, score_threshold=0., method='nms', sigma=0.3):
+    """
+    Same as nms_numpy for tensors. One IoU matrix on the tensor's device covers many groups at
+    once, the entries between boxes of different groups are masked out; only the sequential walk
+    over the matrix runs on the host. Consecutive groups are packed into blocks of about MAX_BLOCK
+    boxes to bound the size of the matrix, a group of more than MAX_BLOCK boxes is suppressed on
+    the host like in nms_numpy.
+    :return: (keep, scores) as tensors on the input device
+    """
+    assert method in METHODS, 'unknown nms method {}'.format(method)
+    device = boxes.device
+    if device.type == 'cpu':
+        # no device to offload to: the per-group blocks of the numpy backend are cheaper
+        keep, keep_scores = nms_numpy(boxes.detach().numpy(), scores.detach().numpy(), groups.numpy(),
+                                      iou_threshold, score_threshold, method, sigma)
+        return torch.from_numpy(keep), torch.from_numpy(keep_scores)
+    # group-major, score-descending, stable w.r.t. the input order for ties
+    order = torch.argsort(-scores, stable=True)
+    order = order[torch.argsort(groups[order], stable=True)]
+    order = order[_candidates(scores[order], groups[order], score_threshold, method)]
+    if order.numel() == 0:
+        return order, scores[order]
+    boxes, scores, groups = boxes[order], scores[order], groups[order]
+
+    keep_list, score_list = [], []
+    for s, e in _blocks(torch.unique_consecutive(groups, return_counts=True)[1].tolist()):
+        if e - s > MAX_BLOCK:
+            # a single group, see _blocks
+            keep, keep_scores = _suppress_group(boxes[s:e].cpu().numpy(), scores[s:e].cpu().numpy(),
+                                                score_threshold, iou_threshold, sigma, method)
+            keep_list.append(torch.from_numpy(keep).to(device) + s)
+            score_list.append(torch.from_numpy(keep_scores).to(device=device, dtype=scores.dtype))
+            continue
+        iou = _pairwise_iou_torch(boxes[s:e], diou=(method == 'diou'))
+        same_group = groups[s:e, None] == groups[None, s:e]
+        iou = iou.masked_fill(~same_group, -1.0 if method == 'diou' else 0.0)
+
+        if method in ['matrix', 'matrix-linear']:
+            decayed = _matrix_decay(iou, scores[s:e], same_group, sigma, method)
+            keep = torch.nonzero(decayed > score_threshold).view(-1)
+            keep_list.append(keep + s)
+            score_list.append(decayed[keep])
+            continue
+
+        keep, keep_scores = _suppress(iou.cpu().numpy(), scores[s:e].cpu().numpy(), score_threshold,
+                                      iou_threshold, sigma, method)
+        keep_list.append(torch.from_numpy(keep).to(device) + s)
+        score_list.append(torch.from_numpy(keep_scores).to(device=device, dtype=scores.dtype))
+    return order[torch.cat(keep_list)], torch.cat(score_list)
+
+
+def _blocks(counts):
+    """
+    Pack consecutive groups into [start, end) blocks of at most MAX_BLOCK boxes (a single larger
+    group gets a block of its own, suppressed without the IoU matrix).
+    """
+    blocks = []
+    start = end = 0
+    for count in counts:
+        if end > start and end - start + count > MAX_BLOCK:
+            blocks.append((start, end))
+            start = end
+        end += count
+    blocks.append((start, end))
+    return blocks
+
+
+def multiclass_nms(bboxes, score_threshold, iou_threshold, sigma=0.3, method='nms'):
+    """
+    Drop-in replacement of the per-class loop in utils.tools.nms.
+    :param bboxes: (N, 6) numpy array or tensor, (xmin, ymin, xmax, ymax, score, class)
+    :return: best_bboxes, (K, 6) of the same type, score column holds the output scores
+    """
+    if len(bboxes) == 0:
+        return bboxes[:0]
+    if isinstance(bboxes, torch.Tensor):
+        keep, scores = nms_torch(bboxes[:, :4], bboxes[:, 4], bboxes[:, 5].long(), iou_threshold,
+                                 score_threshold, method, sigma)
+        best_bboxes = bboxes[keep].clone()
+    else:
+        keep, scores = nms_numpy(bboxes[:, :4], bboxes[:, 4], bboxes[:, 5].astype(np.int64),
+                                 iou_threshold, score_threshold, method, sigma)
+        best_bboxes = bboxes[keep].copy()
+    best_bboxes[:, 4] = scores
+    return best_bboxes
+
+
+def batched_multiclass_nms(bboxes_list, score_threshold, iou_threshold, sigma=0.3, method='nms'):
+    """
+    Run multiclass_nms on the detections of several images in one call.
+    :param bboxes_list: list of (N_i, 6) arrays or tensors, one per image
+    :return: list of (K_i, 6) arrays or tensors, one per image
+    """
+    if len(bboxes_list) == 0:
+        return []
+    counts = [len(b) for b in bboxes_list]
+    is_tensor = isinstance(bboxes_list[0], torch.Tensor)
+    if is_tensor:
+        bboxes = torch.cat(list(bboxes_list), 0)
+        image_ind = torch.repeat_interleave(torch.arange(len(counts), device=bboxes.device),
+                                            torch.tensor(counts, device=bboxes.device))
+        if len(bboxes) == 0:
+            return [bboxes[:0] for _ in counts]
+        classes = bboxes[:, 5].long()
+        groups = image_ind * (int(classes.max()) + 1) + classes
+        keep, scores = nms_torch(bboxes[:, :4], bboxes[:, 4], groups, iou_threshold,
+                                 score_threshold, method, sigma)
+        best_bboxes = bboxes[keep].clone()
+        kept_image_ind = image_ind[keep].cpu().numpy()
+    else:
+        bboxes = np.concatenate(bboxes_list, 0)
+        image_ind = np.repeat(np.arange(len(counts)), counts)
+        if len(bboxes) == 0:
+            return [bboxes[:0] for _ in counts]
+        classes = bboxes[:, 5].astype(np.int64)
+        groups = image_ind * (classes.max() + 1) + classes
+        keep, scores = nms_numpy(bboxes[:, :4], bboxes[:, 4], groups, iou_threshold,
+                                 score_threshold, method, sigma)
+        best_bboxes = bboxes[keep].copy()
+        kept_image_ind = image_ind[keep]
+    best_bboxes[:, 4] = scores
+    return [best_bboxes[np.flatnonzero(kept_image_ind == i)] for i in range(len(counts))]
@@ -0,0 +1,97 @@
+# coding=utf-8
+import time
+import collections
+from concurrent.futures import ThreadPoolExecutor
+import cv2
+import utils.data_augment as dataAug
+
+
+def read_image(path, test_shape=None):
+    """
+    Decode an image and optionally letterbox it for the network.
+    :param path: image path
+    :param test_shape: network input size, None to skip letterboxing
+    :return: (img, resized) img is the BGR image read by cv2, resized is the letterboxed [C,H,W]
+             float image (the same as Evaluator.__get_img_tensor) or None
+    """
+    img = cv2.imread(path)
+    assert img is not None, 'File Not Found ' + path
+    resized = None
+    if test_shape is not None:
+        resized = dataAug.Resize((test_shape, test_shape), correct_box=False)(img, None).transpose(2, 0, 1)
+    return img, resized
+
+
+class PrefetchLoader(object):
+    """
+    Run load_fn on the next max_prefetch items in a thread pool while the consumer works on the
+    current one. cv2 decode/resize release the GIL, so threads overlap with the forward pass.
+    Results are yielded in the order of items.
+
+    Counters:
+        stall_time: seconds the consumer waited for a result that was not ready
+        queue_depth: number of finished results waiting when the consumer asked (averaged in stats)
+    """
+    def __init__(self, items, load_fn, num_workers=4, max_prefetch=8):
+        self.__items = list(items)
+        self.__load_fn = load_fn
+        self.__num_workers = max(1, num_workers)
+        self.__max_prefetch = max(1, max_prefetch)
+        self.stall_time = 0.
+        self.num_loaded = 0
+        self.num_stalls = 0
+        self.__queue_depth_sum = 0
+
+    def __len__(self):
+        return len(self.__items)
+
+    def __iter__(self):
+        pending = collections.deque()
+        items = iter(self.__items)
+        with ThreadPoolExecutor(max_workers=self.__num_workers) as executor:
+            for item in items:
+                pending.append(executor.submit(self.__load_fn, item))
+                if len(pending) >= self.__max_prefetch:
+                    break
+            while pending:
+                yield self.__next_result(pending)
+                item = next(items, None)
+                if item is not None:
+                    pending.append(executor.submit(self.__load_fn, item))
+
+    def batches(self, batch_size):
+        """
+        Yield lists of at most batch_size consecutive results.
+        """
+        batch = []
+        for result in self:
+            batch.append(result)
+            if len(batch) == batch_size:
+                yield batch
+                batch = []
+        if batch:
+            yield batch
+
+    def __next_result(self, pending):
+        self.__queue_depth_sum += sum(future.done() for future in pending)
+        future = pending.popleft()
+        if not future.done():
+            start = time.time()
+            result = future.result()
+            self.stall_time += time.time() - start
+            self.num_stalls += 1
+        else:
+            result = future.result()
+        self.num_loaded += 1
+        return result
+
+    def get_stats(self):
+        return {'loaded': self.num_loaded,
+                'stalls': self.num_stalls,
+                'stall_time': self.stall_time,
+                'avg_queue_depth': self.__queue_depth_sum / max(self.num_loaded, 1)}
+
+    def stats_str(self):
+        stats = self.get_stats()
+        return 'prefetch: {} images, {} stalls, {:.2f}s stalled, avg queue depth {:.2f}/{}'.format(
+            stats['loaded'], stats['stalls'], stats['stall_time'], stats['avg_queue_depth'], self.__max_prefetch)
@@ -0,0 +1,99 @@
+# coding=utf-8
+import random
+import collections
+import cv2
+import numpy as np
+
+
+class TileCache(object):
+    """
+    LRU cache of decoded, pre-downscaled images for Mosaic. Every DataLoader worker holds its own
+    copy, a tile that is used again while it is cached costs no decode.
+
+    With random partners over a whole dataset a cache of a few hundred tiles almost never hits, so
+    once the cache is full the partners of a mosaic are drawn from the cached tiles (sample). They
+    are read without touching the LRU order: every tile is evicted after capacity new tiles, the
+    pool of partners is renewed by the images the sampler draws.
+
+    Counters:
+        lookups/hits: requests and requests served from the cache
+        decodes: images decoded, i.e. misses
+        evictions: tiles dropped to stay within capacity
+        nbytes: bytes of the cached images
+    """
+    def __init__(self, load_fn, capacity=256):
+        """
+        :param load_fn: index -> (img, bboxes, ...) the decoded BGR image and its boxes
+        :param capacity: max number of cached tiles
+        """
+        self.__load_fn = load_fn
+        self.__capacity = capacity
+        self.__tiles = collections.OrderedDict()
+        self.lookups = 0
+        self.hits = 0
+        self.decodes = 0
+        self.evictions = 0
+        self.nbytes = 0
+
+    def __len__(self):
+        return len(self.__tiles)
+
+    def get(self, index, max_side, touch=True):
+        """
+        :param max_side: the longer side of the returned image is at most max_side
+        :param touch: a hit moves the tile to the most recently used end
+        :return: (img, bboxes) the cached uint8 image, which must not be modified, and a copy
+                 of its boxes scaled to the image
+        """
+        self.lookups += 1
+        key = (index, max_side)
+        if key in self.__tiles:
+            self.hits += 1
+            if touch:
+                self.__tiles.move_to_end(key)
+            img, bboxes = self.__tiles[key]
+            return img, np.copy(bboxes)
+
+        img, bboxes = self.__load_fn(index)[:2]
+        self.decodes += 1
+        bboxes = np.array(bboxes, dtype=np.float64).reshape(-1, 5)
+        h, w = img.shape[:2]
+        ratio = 1.0 * max_side / max(h, w)
+        if ratio < 1:
+            img = cv2.resize(img, (max(1, int(w * ratio)), max(1, int(h * ratio))), interpolation=cv2.INTER_AREA)
+            bboxes[:, :4] = bboxes[:, :4] * ratio
+
+        if self.__capacity > 0:
+            self.__tiles[key] = (img, bboxes)
+            self.nbytes += img.nbytes
+            while len(self.__tiles) > self.__capacity:
+                _, (evicted, _) = self.__tiles.popitem(last=False)
+                self.nbytes -= evicted.nbytes
+                self.evictions += 1
+        return img, np.copy(bboxes)
+
+    def sample(self, max_side, k, num_images):
+        """
+        :param num_images: size of the dataset, the cache is full at min(capacity, num_images) tiles
+        :return: k random indices of cached tiles of max_side, None until the tiles of max_side fill
+                 the cache (e.g. after a change of the input size)
+        """
+        indices = [index for index, side in self.__tiles if side == max_side]
+        if len(indices) < max(min(self.__capacity, num_images), k):
+            return None
+        return random.sample(indices, k)
+
+    def get_stats(self):
+        return {'lookups': self.lookups,
+                'hits': self.hits,
+                'hit_rate': 1.0 * self.hits / max(self.lookups, 1),
+                'decodes': self.decodes,
+                'evictions': self.evictions,
+                'tiles': len(self.__tiles),
+                'mbytes': self.nbytes / 2 ** 20}
+
+    def stats_str(self):
+        stats = self.get_stats()
+        return 'tile cache: {} lookups, hit rate {:.1%}, {} decodes, {} evictions, {}/{} tiles, {:.1f} MB'.format(
+            stats['lookups'], stats['hit_rate'], stats['decodes'], stats['evictions'], stats['tiles'],
+            self.__capacity, stats['mbytes'])
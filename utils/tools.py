@@ -6,6 +6,7 @@ import numpy as np
 import cv2
 import random
 import config.yolov4_config as cfg
+from utils.nms import multiclass_nms
 import os
 import math
 
@@ -296,33 +297,12 @@ def nms(bboxes, score_threshold, iou_threshold, sigma=0.3, method='nms'):
     :param bboxes:
     假设有N个bbox的score大于score_threshold，那么bboxes的shape为(N, 6)，存储格式为(xmin, ymin, xmax, ymax, score, class)
     其中(xmin, ymin, xmax, ymax)的大小都是相对于输入原图的，score = conf * prob，class是bbox所属类别的索引号
+    :param method: one of utils.nms.METHODS ('nms', 'soft-nms', 'linear', 'diou', 'matrix', 'matrix-linear')
     :return: best_bboxes
     假设NMS后剩下N个bbox，那么best_bboxes的shape为(N, 6)，存储格式为(xmin, ymin, xmax, ymax, score, class)
     其中(xmin, ymin, xmax, ymax)的大小都是相对于输入原图的，score = conf * prob，class是bbox所属类别的索引号
     """
-    classes_in_img = list(set(bboxes[:, 5].astype(np.int32)))
-    best_bboxes = []
-
-    for cls in classes_in_img:
-        cls_mask = (bboxes[:, 5].astype(np.int32) == cls)
-        cls_bboxes = bboxes[cls_mask]
-        while len(cls_bboxes) > 0:
-            max_ind = np.argmax(cls_bboxes[:, 4])
-            best_bbox = cls_bboxes[max_ind]
-            best_bboxes.append(best_bbox)
-            cls_bboxes = np.concatenate([cls_bboxes[: max_ind], cls_bboxes[max_ind + 1:]])
-            iou = iou_xyxy_numpy(best_bbox[np.newaxis, :4], cls_bboxes[:, :4])
-            assert method in ['nms', 'soft-nms']
-            weight = np.ones((len(iou),), dtype=np.float32)
-            if method == 'nms':
-                iou_mask = iou > iou_threshold
-                weight[iou_mask] = 0.0
-            if method == 'soft-nms':
-                weight = np.exp(-(1.0 * iou ** 2 / sigma))
-            cls_bboxes[:, 4] = cls_bboxes[:, 4] * weight
-            score_mask = cls_bboxes[:, 4] > score_threshold
-            cls_bboxes = cls_bboxes[score_mask]
-    return np.array(best_bboxes)
+    return multiclass_nms(np.asarray(bboxes), score_threshold, iou_threshold, sigma=sigma, method=method)
 
 
 def init_seeds(seed=0):
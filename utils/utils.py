@@ -2,6 +2,7 @@ from __future__ import division
 import torch
 import numpy as np
 import cv2
+from utils.nms import nms_torch
 
 
 def nms(bbox, thresh, score=None, limit=None):
@@ -70,7 +71,9 @@ def postprocess(prediction, num_classes, conf_thre=0.7, nms_thre=0.45):
             confidence threshold ranging from 0 to 1,
             which is defined in the config file.
         nms_thre (float):
-            IoU threshold of non-max suppression ranging from 0 to 1.
+            IoU threshold of non-max suppression ranging from 0 to 1. A box is
+            suppressed when its IoU with a higher scoring box is above nms_thre
+            (utils.nms); the former chainer `nms` also suppressed at equality.
 
     Returns:
         output (list of torch tensor):
@@ -84,6 +87,7 @@ def postprocess(prediction, num_classes, conf_thre=0.7, nms_thre=0.45):
     prediction[:, :, :4] = box_corner[:, :, :4]
 
     output = [None for _ in range(len(prediction))]
+    det_list, image_ind_list = [], []
     for i, image_pred in enumerate(prediction):
         # Filter out confidence scores below threshold
         class_pred = torch.max(image_pred[:, 5:5 + num_classes], 1)
@@ -102,21 +106,23 @@ def postprocess(prediction, num_classes, conf_thre=0.7, nms_thre=0.45):
                 image_pred[ind[:, 0], 5 + ind[:, 1]].unsqueeze(1),
                 ind[:, 1].float().unsqueeze(1)
                 ), 1)
-        # Iterate through all predicted classes
-        unique_labels = detections[:, -1].cpu().unique()
-        if prediction.is_cuda:
-            unique_labels = unique_labels.cuda()
-        for c in unique_labels:
-            # Get the detections with the particular class
-            detections_class = detections[detections[:, -1] == c]
-            nms_in = detections_class.cpu().numpy()
-            nms_out_index = nms(
-                nms_in[:, :4], nms_thre, score=nms_in[:, 4]*nms_in[:, 5])
-            detections_class = detections_class[nms_out_index]
-            if output[i] is None:
-                output[i] = detections_class
-            else:
-                output[i] = torch.cat((output[i], detections_class))
+        det_list.append(detections)
+        image_ind_list.append(torch.full((len(detections),), i, dtype=torch.long, device=detections.device))
+
+    if not det_list:
+        return output
+
+    # Class-wise NMS of all images in one call, (image, class) pairs never suppress each other
+    detections = torch.cat(det_list)
+    image_inds = torch.cat(image_ind_list)
+    groups = image_inds * num_classes + detections[:, -1].long()
+    keep, _ = nms_torch(detections[:, :4], detections[:, 4] * detections[:, 5], groups, nms_thre)
+    detections = detections[keep]
+    image_inds = image_inds[keep]
+    for i in range(len(prediction)):
+        detections_img = detections[image_inds == i]
+        if detections_img.size(0):
+            output[i] = detections_img
 
     return output
 
@@ -18,6 +18,7 @@ class Detection(object):
                  weight_path=None,
                  video_path=None,
                  output_dir=None,
+                 nms_method=None,
                  ):
         self.__num_class = cfg.VOC_DATA["NUM"]
         self.__conf_threshold = cfg.VAL["CONF_THRESH"]
@@ -34,6 +35,8 @@ class Detection(object):
         self.__load_model_weights(weight_path)
 
         self.__evalter = Evaluator(self.__model, showatt=False)
+        if nms_method is not None:
+            self.__evalter.nms_method = nms_method
 
     def __load_model_weights(self, weight_path):
         print("loading weight file from : {}".format(weight_path))
@@ -100,6 +103,8 @@ if __name__ == "__main__":
     parser.add_argument('--gpu_id', type=int, default=-1, help='whither use GPU(eg:0,1,2,3,4,5,6,7,8) or CPU(-1)')
     parser.add_argument('--mode', type=str, default='det',
                         help='val or det')
+    parser.add_argument('--nms_method', type=str, default=cfg.VAL["NMS_METHOD"],
+                        help='nms, soft-nms, linear, diou, matrix or matrix-linear')
     opt = parser.parse_args()
     writer = SummaryWriter(logdir=opt.log_val_path + '/event')
     logger = Logger(log_file_name=opt.log_val_path + '/log_video_detection.txt', log_level=logging.DEBUG, logger_name='CIFAR').get_log()
@@ -107,5 +112,6 @@ if __name__ == "__main__":
     Detection(gpu_id=opt.gpu_id,
             weight_path=opt.weight_path,
             video_path=opt.video_path,
-            output_dir=opt.output_dir).Video_detection()
+            output_dir=opt.output_dir,
+            nms_method=opt.nms_method).Video_detection()
 